@@ -6,7 +6,10 @@ from __future__ import division
 from __future__ import print_function
 
 import dill
+import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.base import BaseEstimator, TransformerMixin
+from eden.profiling import PipelineStats
 
 __author__ = "Fabrizio Costa"
 __copyright__ = "Copyright 2015, Fabrizio Costa"
@@ -78,3 +81,687 @@ def fast_hash_vec(vec, bitmask=_bitmask_):
         running_hash ^= hash((running_hash, vec_item, i))
         hash_vec.append(int(running_hash & bitmask) + 1)
     return hash_vec
+
+
+def _segment_starts(*keys):
+    """Return the positions where any of the sorted keys changes value."""
+    size = len(keys[0])
+    if size == 0:
+        return np.zeros(0, dtype=np.int64)
+    change = np.zeros(size, dtype=bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def _segment_ends(starts, size):
+    """Return the last positions of the segments that begin at starts."""
+    if len(starts) == 0:
+        return starts
+    return np.append(starts[1:], size) - 1
+
+
+class FeatureAccumulator(object):
+    """Collect hashed features and assemble them in a CSR matrix.
+
+    Each entry is a (row, block, feature, value) quadruple. Entries are
+    added to the current row, one at a time with append or as arrays with
+    extend. Single entries are staged in lists and moved to typed numpy
+    arrays every buffer_size entries. The block is an arbitrary hashable
+    key, e.g. the (radius, distance) pair that generated the feature:
+    features in the same block are normalized together. Duplicate entries
+    are summed when the matrix is assembled. The entries are ranked in the
+    order in which they are added (see extend_blocks): in each row the
+    blocks are ordered by their first entry, and a feature id that occurs
+    in several blocks of a row takes the value of the last block.
+    """
+
+    def __init__(self, buffer_size=2 ** 16):
+        """Constructor."""
+        self.row = 0
+        self.buffer_size = buffer_size
+        self.block_keys = []
+        self._block_ids = {}
+        self._rows, self._blocks, self._features, self._values = \
+            [], [], [], []
+        self._chunks = []
+        self._n_chunk_entries = 0
+        # the rank of the next entry
+        self._next_rank = 0
+
+    def block_id(self, key):
+        """Return the int id associated to the block key."""
+        block_id = self._block_ids.get(key, None)
+        if block_id is None:
+            block_id = len(self.block_keys)
+            self._block_ids[key] = block_id
+            self.block_keys.append(key)
+        return block_id
+
+    def append(self, key, feature, value):
+        """Add a single entry to the current row."""
+        try:
+            self._blocks.append(self._block_ids[key])
+        except KeyError:
+            self._blocks.append(self.block_id(key))
+        self._rows.append(self.row)
+        self._features.append(feature)
+        self._values.append(value)
+        if len(self._values) >= self.buffer_size:
+            self._flush()
+
+    def extend(self, key, features, values, rows=None):
+        """Add arrays of entries.
+
+        The entries belong to the current row unless an array of rows is
+        given.
+        """
+        self.extend_blocks([key], 0, features, values, rows=rows)
+
+    def extend_blocks(self, keys, blocks, features, values, rows=None,
+                      ranks=None):
+        """Add arrays of entries that belong to several blocks.
+
+        The block key of the i-th entry is keys[blocks[i]]. The entries
+        belong to the current row unless an array of rows is given. The
+        entries are ranked in the order of the arrays, unless an array of
+        non negative ranks is given; in any case they are ranked after the
+        entries added before.
+        """
+        features = np.asarray(features, dtype=np.int64)
+        if len(features) == 0:
+            return
+        self._flush()
+        if ranks is None:
+            ranks = self._next_rank
+            self._next_rank += len(features)
+        else:
+            ranks = self._next_rank + np.asarray(ranks, dtype=np.int64)
+            self._next_rank = int(ranks.max()) + 1
+        if rows is None:
+            rows = np.full(len(features), self.row, dtype=np.int32)
+        block_ids = np.array([self.block_id(key) for key in keys],
+                             dtype=np.int32)
+        blocks = np.broadcast_to(block_ids[blocks], features.shape)
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64),
+                                 features.shape)
+        self._chunks.append((np.asarray(rows, dtype=np.int32),
+                             blocks, features, values, ranks))
+        self._n_chunk_entries += len(values)
+
+    def _flush(self):
+        # the staged entries are ranked in order, as consecutive ints from
+        # the rank stored in the chunk
+        if self._values:
+            self._n_chunk_entries += len(self._values)
+            self._chunks.append((np.array(self._rows, dtype=np.int32),
+                                 np.array(self._blocks, dtype=np.int32),
+                                 np.array(self._features, dtype=np.int64),
+                                 np.array(self._values, dtype=np.float64),
+                                 self._next_rank))
+            self._next_rank += len(self._values)
+            self._rows, self._blocks, self._features, self._values = \
+                [], [], [], []
+
+    def __len__(self):
+        """Number of entries."""
+        return len(self._values) + self._n_chunk_entries
+
+    def arrays(self):
+        """Return the arrays of rows, blocks, features and values."""
+        self._flush()
+        if not self._chunks:
+            return [np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                    np.zeros(0, dtype=np.int64), np.zeros(0)]
+        return [np.concatenate([chunk[i] for chunk in self._chunks])
+                for i in range(4)]
+
+    def _ranks(self):
+        # the rank of each entry, in the order of arrays
+        self._flush()
+        if not any(isinstance(ranks, np.ndarray)
+                   for _, _, _, _, ranks in self._chunks):
+            # insertion order: the ranks are consecutive
+            return np.arange(self._next_rank, dtype=np.int64)
+        return np.concatenate([
+            ranks if isinstance(ranks, np.ndarray)
+            else np.arange(ranks, ranks + len(values), dtype=np.int64)
+            for _, _, _, values, ranks in self._chunks])
+
+    def to_csr(self, n_rows, n_features,
+               inner_normalization=False,
+               normalization=False,
+               block_weights=None,
+               collisions='last',
+               stats=None):
+        """Assemble the entries in a CSR matrix with sorted indices.
+
+        Parameters
+        ----------
+        n_rows : int
+            The number of rows in the matrix.
+
+        n_features : int
+            The number of columns in the matrix.
+
+        inner_normalization : bool (default False)
+            Scale the features of each block in each row to unit norm.
+
+        normalization : bool (default False)
+            Scale each row to unit norm (after the inner normalization).
+
+        block_weights : dict (default None)
+            Dictionary with block keys and weights. If inner_normalization
+            is True the norm of a block with a weight w is sqrt(w).
+
+        collisions : string (default 'last')
+            How the values of a feature id that occurs in several blocks of
+            a row are merged. With 'last' the value of the last block is
+            kept, in the order of the first entry of the blocks of the row;
+            with 'sum' the values are summed.
+
+        stats : PipelineStats (default None)
+            If given, the time of the merge of the duplicate entries, of the
+            normalization and of the assembly of the matrix are recorded,
+            with the number of merged entries (counter duplicate_merges).
+
+        Returns
+        -------
+        data_matrix : csr_matrix, shape = [n_rows, n_features]
+        """
+        return self.feature_blocks(n_rows, stats=stats).to_csr(
+            n_features,
+            inner_normalization=inner_normalization,
+            normalization=normalization,
+            block_weights=block_weights,
+            collisions=collisions,
+            stats=stats)
+
+    def normalized_arrays(self, n_rows,
+                          inner_normalization=False,
+                          normalization=False,
+                          block_weights=None,
+                          collisions='last',
+                          stats=None):
+        """Return the arrays of rows, features and values of the matrix.
+
+        The entries are those of to_csr (same parameters), sorted by row
+        and feature, without building the sparse matrix.
+        """
+        return self.feature_blocks(n_rows, stats=stats).normalized_arrays(
+            inner_normalization=inner_normalization,
+            normalization=normalization,
+            block_weights=block_weights,
+            collisions=collisions,
+            stats=stats)
+
+    def feature_blocks(self, n_rows, stats=None):
+        """Return the entries as FeatureBlocks, with duplicates summed."""
+        stats = stats or _NO_STATS
+        with stats.stage('feature_merge'):
+            rows, blocks, features, values = self.arrays()
+            n_entries = len(values)
+            # the rank of each (row, block) is the rank of its first entry
+            n_blocks = len(self.block_keys)
+            row_blocks = rows.astype(np.int64) * n_blocks + blocks
+            block_ranks = np.full(n_rows * n_blocks, np.iinfo(np.int64).max)
+            np.minimum.at(block_ranks, row_blocks, self._ranks())
+            # sum the duplicate entries of each (row, block, feature)
+            combined = _combined_key(rows, blocks, features)
+            if combined is not None and (values == 1).all():
+                # unit counts: the sum of the duplicates is their number,
+                # and only the keys need to be sorted
+                keys = np.sort(combined[0])
+                starts = _segment_starts(keys)
+                values = np.diff(np.append(starts, len(keys))).astype(
+                    np.float64)
+                rows, blocks, features = [
+                    key.astype(dtype) for key, dtype in
+                    zip(_split_key(keys[starts], combined[1]),
+                        (rows.dtype, blocks.dtype, features.dtype))]
+            else:
+                order = _sort_order(rows, blocks, features)
+                rows, blocks = rows[order], blocks[order]
+                features, values = features[order], values[order]
+                starts = _segment_starts(rows, blocks, features)
+                if len(starts):
+                    values = np.add.reduceat(values, starts)
+                rows, blocks = rows[starts], blocks[starts]
+                features = features[starts]
+            stats.count('duplicate_merges', n_entries - len(values))
+            order = _block_order(rows, blocks, block_ranks[
+                rows.astype(np.int64) * n_blocks + blocks])
+            if order is not None:
+                rows, blocks = rows[order], blocks[order]
+                features, values = features[order], values[order]
+        return FeatureBlocks(rows, blocks, features, values,
+                             list(self.block_keys), n_rows)
+
+
+class FeatureBlocks(object):
+    """Feature vectors kept separated by block, before normalization.
+
+    The entries are (row, block, feature, value) quadruples without
+    duplicates, sorted by row, then by block, in the order in which the
+    blocks of the row were generated, then by feature; the key of the
+    block with id i is block_keys[i]. The matrix of any subset of the
+    blocks, with any normalization and block weights, can be assembled
+    without computing the features again: e.g. the features of a graph
+    vectorizer with small radius and distance are the blocks with small
+    (radius, distance) keys of a vectorizer with large radius and
+    distance.
+
+    >>> features = FeatureAccumulator()
+    >>> features.extend((0, 0), [1, 2], [3.0, 4.0])
+    >>> features.extend((1, 1), [2], [1.0])
+    >>> blocks = features.feature_blocks(n_rows=1)
+    >>> blocks.to_csr(4, keys=[(0, 0)], normalization=True).toarray()
+    array([[0. , 0.6, 0.8, 0. ]])
+    >>> blocks.to_csr(4).toarray()
+    array([[0., 3., 1., 0.]])
+
+    A feature id that occurs in several blocks of a row (a hash collision)
+    takes the value of the last block, unless the values are summed:
+
+    >>> blocks.to_csr(4, collisions='sum').toarray()
+    array([[0., 3., 5., 0.]])
+
+    The unnormalized counts and the norms of the blocks can be stored and
+    normalized later:
+
+    >>> x, norms = blocks.raw_csr(4), blocks.norms()
+    >>> y = normalize(inner_normalize(x, blocks.blocks, norms))
+    >>> z = blocks.to_csr(4, inner_normalization=True, normalization=True)
+    >>> bool(abs(y - z).max() < 1e-12)
+    True
+    """
+
+    def __init__(self, rows, blocks, features, values, block_keys, n_rows):
+        """Constructor."""
+        self.rows = rows
+        self.blocks = blocks
+        self.features = features
+        self.values = values
+        self.block_keys = block_keys
+        self.n_rows = n_rows
+
+    @classmethod
+    def from_csr(cls, data_matrix, blocks, block_keys):
+        """Return the FeatureBlocks of a matrix returned by raw_csr.
+
+        The entries must be stored in the order of raw_csr. blocks is the
+        array of the block ids of the stored entries of the matrix and
+        block_keys the list of the keys of the blocks.
+        """
+        data_matrix = data_matrix.tocsr()
+        rows = np.repeat(np.arange(data_matrix.shape[0], dtype=np.int32),
+                         np.diff(data_matrix.indptr))
+        return cls(rows, np.asarray(blocks, dtype=np.int32),
+                   data_matrix.indices.astype(np.int64),
+                   data_matrix.data.astype(np.float64),
+                   list(block_keys), data_matrix.shape[0])
+
+    def raw_csr(self, n_features):
+        """Return the unnormalized counts as a CSR matrix.
+
+        The matrix stores one entry per (row, block, feature), in the
+        order of the array blocks, so that the block of each stored entry
+        is known: a feature id that occurs in several blocks of a row is
+        stored more than once, in the order of the blocks: merge_duplicates
+        and normalize keep the last one, while any arithmetic operation
+        sums them. Together with blocks, block_keys and norms
+        this is all that is needed to apply any normalization and
+        reweighting later (see inner_normalize, reweight and normalize).
+        """
+        indptr = np.zeros(self.n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.rows, minlength=self.n_rows),
+                  out=indptr[1:])
+        data_matrix = csr_matrix((self.values, self.features, indptr),
+                                 shape=(self.n_rows, n_features))
+        data_matrix.has_canonical_format = False
+        return data_matrix
+
+    def norms(self):
+        """Return the euclidean norm of each block in each row.
+
+        Returns
+        -------
+        norms : array, shape = [n_rows, n_blocks]
+            The norm of the block with id j in row i is norms[i, j].
+        """
+        n_blocks = len(self.block_keys)
+        squares = np.bincount(
+            self.rows.astype(np.int64) * n_blocks + self.blocks,
+            weights=self.values * self.values,
+            minlength=self.n_rows * n_blocks)
+        return np.sqrt(squares).reshape(self.n_rows, n_blocks)
+
+    def select(self, keys):
+        """Return the FeatureBlocks restricted to the blocks with the keys."""
+        keys = set(keys)
+        block_ids = [block_id for block_id, key in enumerate(self.block_keys)
+                     if key in keys]
+        selected = np.isin(self.blocks, block_ids)
+        return FeatureBlocks(self.rows[selected], self.blocks[selected],
+                             self.features[selected], self.values[selected],
+                             self.block_keys, self.n_rows)
+
+    def to_csr(self, n_features,
+               keys=None,
+               inner_normalization=False,
+               normalization=False,
+               block_weights=None,
+               collisions='last',
+               stats=None):
+        """Assemble the blocks with the given keys in a CSR matrix.
+
+        If keys is None all the blocks are used. The other parameters are
+        those of FeatureAccumulator.to_csr.
+        """
+        stats = stats or _NO_STATS
+        rows, features, values = self.normalized_arrays(
+            keys=keys,
+            inner_normalization=inner_normalization,
+            normalization=normalization,
+            block_weights=block_weights,
+            collisions=collisions,
+            stats=stats)
+        n_rows = self.n_rows
+        with stats.stage('sparse_assembly'):
+            indptr = np.zeros(n_rows + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+            if n_features < np.iinfo(np.int32).max:
+                indptr = indptr.astype(np.int32)
+                features = features.astype(np.int32)
+            data_matrix = csr_matrix((values, features, indptr),
+                                     shape=(n_rows, n_features))
+            data_matrix.has_sorted_indices = True
+        return data_matrix
+
+    def normalized_arrays(self,
+                          keys=None,
+                          inner_normalization=False,
+                          normalization=False,
+                          block_weights=None,
+                          collisions='last',
+                          stats=None):
+        """Return the arrays of rows, features and values of the matrix.
+
+        The entries are those of to_csr (same parameters), sorted by row
+        and feature, without building the sparse matrix.
+        """
+        stats = stats or _NO_STATS
+        if collisions not in ('last', 'sum'):
+            raise Exception('ERROR: unknown collisions mode: %s' %
+                            collisions)
+        if keys is not None:
+            return self.select(keys).normalized_arrays(
+                inner_normalization=inner_normalization,
+                normalization=normalization,
+                block_weights=block_weights,
+                collisions=collisions,
+                stats=stats)
+        rows, blocks = self.rows, self.blocks
+        features, values = self.features, self.values
+        n_rows = self.n_rows
+        with stats.stage('normalization'):
+            # inner normalization per block
+            if inner_normalization and len(values):
+                starts = _segment_starts(rows, blocks)
+                group = np.repeat(np.arange(len(starts)),
+                                  np.diff(np.append(starts, len(values))))
+                norms = np.sqrt(np.add.reduceat(values * values, starts))
+                if block_weights is not None:
+                    sqrtw = np.ones(len(self.block_keys))
+                    for block_id, key in enumerate(self.block_keys):
+                        if block_weights.get(key, None) is not None:
+                            sqrtw[block_id] = np.sqrt(block_weights[key])
+                    norms = norms / sqrtw[blocks[starts]]
+                values = values / norms[group]
+            # merge the blocks: the stable sort keeps the entries of a
+            # feature in the order of the blocks
+            order = _sort_order(rows, features)
+            rows, features = rows[order], features[order]
+            values = values[order]
+            starts = _segment_starts(rows, features)
+            if collisions == 'sum':
+                if len(starts):
+                    values = np.add.reduceat(values, starts)
+            else:
+                values = values[_segment_ends(starts, len(values))]
+            rows, features = rows[starts], features[starts]
+            # global normalization
+            if normalization and len(values):
+                norms = np.sqrt(np.bincount(rows, weights=values * values,
+                                            minlength=n_rows))
+                values = values / norms[rows]
+        return rows, features, values
+
+
+def inner_normalize(data_matrix, blocks, norms, block_keys=None,
+                    block_weights=None):
+    """Scale the features of each block in each row to unit norm.
+
+    The vectorized equivalent of the inner_normalization of the
+    vectorizers, applied to a matrix of unnormalized counts.
+
+    Parameters
+    ----------
+    data_matrix : csr_matrix
+        The counts, as returned by FeatureBlocks.raw_csr.
+
+    blocks : array of ints
+        The block id of each stored entry of the matrix.
+
+    norms : array, shape = [n_rows, n_blocks]
+        The norm of each block in each row, as returned by
+        FeatureBlocks.norms.
+
+    block_keys : list (default None)
+        The keys of the blocks, needed only with block_weights.
+
+    block_weights : dict (default None)
+        Dictionary with block keys and weights, as the weights_dict of the
+        vectorizers: the norm of a block with a weight w is sqrt(w) and
+        the blocks whose key is not in the dict, or that have weight 0,
+        are removed.
+
+    Returns
+    -------
+    data_matrix : csr_matrix
+        The scaled matrix, with the same stored entries (those of the
+        removed blocks are 0).
+    """
+    rows = np.repeat(np.arange(data_matrix.shape[0]),
+                     np.diff(data_matrix.indptr))
+    scale = np.zeros(norms.shape)
+    np.divide(1.0, norms, out=scale, where=norms > 0)
+    if block_weights is not None:
+        scale = scale * np.sqrt(_block_array(block_keys, block_weights))
+    return _with_data(data_matrix, data_matrix.data * scale[rows, blocks])
+
+
+def reweight(data_matrix, blocks, block_keys, block_weights):
+    """Multiply the features of each block by the weight of the block.
+
+    The blocks whose key is not in block_weights, or that have weight 0,
+    are removed (their values are set to 0), as the vectorizers do not
+    compute them.
+
+    Parameters
+    ----------
+    data_matrix : csr_matrix
+        The (possibly inner normalized) counts, as returned by
+        FeatureBlocks.raw_csr.
+
+    blocks : array of ints
+        The block id of each stored entry of the matrix.
+
+    block_keys : list
+        The keys of the blocks.
+
+    block_weights : dict
+        Dictionary with block keys and weights.
+
+    Returns
+    -------
+    data_matrix : csr_matrix
+        The scaled matrix, with the same stored entries.
+    """
+    weights = _block_array(block_keys, block_weights)
+    return _with_data(data_matrix, data_matrix.data * weights[blocks])
+
+
+def merge_duplicates(data_matrix, collisions='last'):
+    """Merge the entries of the feature ids stored more than once in a row.
+
+    Of the entries of a feature id stored more than once in a row the last
+    one is kept, as the vectorizers do with a feature id that occurs in
+    several blocks (see FeatureBlocks.raw_csr); with collisions='sum' the
+    entries are summed. The entries equal to 0, as those of the blocks
+    removed by inner_normalize and reweight, are discarded first.
+    """
+    data_matrix = data_matrix.tocsr(copy=True)
+    data_matrix.eliminate_zeros()
+    if collisions == 'sum':
+        data_matrix.sum_duplicates()
+        return data_matrix
+    if collisions != 'last':
+        raise Exception('ERROR: unknown collisions mode: %s' % collisions)
+    rows = np.repeat(np.arange(data_matrix.shape[0]),
+                     np.diff(data_matrix.indptr))
+    order = _sort_order(rows, data_matrix.indices)
+    rows, indices = rows[order], data_matrix.indices[order]
+    ends = _segment_ends(_segment_starts(rows, indices), len(rows))
+    return csr_matrix((data_matrix.data[order][ends],
+                       (rows[ends], indices[ends])),
+                      shape=data_matrix.shape)
+
+
+def normalize(data_matrix, collisions='last'):
+    """Merge the duplicate entries and scale each row to unit norm.
+
+    The vectorized equivalent of the normalization of the vectorizers.
+    The duplicate entries are merged as in merge_duplicates. The rows
+    without entries are left empty.
+    """
+    data_matrix = merge_duplicates(data_matrix, collisions=collisions)
+    data_matrix.eliminate_zeros()
+    rows = np.repeat(np.arange(data_matrix.shape[0]),
+                     np.diff(data_matrix.indptr))
+    norms = np.sqrt(np.bincount(rows, weights=data_matrix.data ** 2,
+                                minlength=data_matrix.shape[0]))
+    if len(rows):
+        data_matrix.data = data_matrix.data / norms[rows]
+    return data_matrix
+
+
+def vstack_feature_blocks(feature_blocks):
+    """Stack a list of FeatureBlocks, the rows of each after the previous.
+
+    The blocks with the same key are merged.
+    """
+    block_keys, block_ids = [], {}
+    rows, blocks, features, values = [], [], [], []
+    offset = 0
+    for part in feature_blocks:
+        remap = np.zeros(len(part.block_keys), dtype=np.int32)
+        for i, key in enumerate(part.block_keys):
+            if key not in block_ids:
+                block_ids[key] = len(block_keys)
+                block_keys.append(key)
+            remap[i] = block_ids[key]
+        rows.append(part.rows + offset)
+        blocks.append(remap[part.blocks])
+        features.append(part.features)
+        values.append(part.values)
+        offset += part.n_rows
+    if not rows:
+        raise Exception('ERROR: something went wrong:\
+            no feature blocks to stack.')
+    rows, blocks, features, values = [np.concatenate(arrays) for arrays
+                                      in (rows, blocks, features, values)]
+    return FeatureBlocks(rows, blocks, features, values, block_keys, offset)
+
+
+def _sort_order(*keys):
+    """Return the stable order that sorts by the first key, then the next.
+
+    The same as np.lexsort(keys[::-1]) for arrays of non negative ints;
+    when their ranges allow it the keys are combined in a single int64
+    key, that is much faster to sort.
+    """
+    if len(keys[0]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # with the index as last key the combined keys are distinct, and the
+    # default sort, faster than the stable one, gives the stable order
+    combined = _combined_key(*(keys + (np.arange(len(keys[0])),)))
+    if combined is not None:
+        return np.argsort(combined[0])
+    combined = _combined_key(*keys)
+    if combined is None:
+        return np.lexsort(keys[::-1])
+    return np.argsort(combined[0], kind='stable')
+
+
+def _block_order(rows, blocks, block_ranks):
+    """Return the order that sorts the blocks of each row by rank.
+
+    The entries are sorted by row and block, block_ranks is the rank of
+    the block of each entry in its row; the entries of a block are kept
+    together and in order. None if the blocks are already sorted.
+    """
+    starts = _segment_starts(rows, blocks)
+    segment_rows, segment_ranks = rows[starts], block_ranks[starts]
+    if ((np.diff(segment_rows) > 0) | (np.diff(segment_ranks) > 0)).all():
+        return None
+    segments = np.lexsort((segment_ranks, segment_rows))
+    sizes = np.diff(np.append(starts, len(rows)))[segments]
+    offsets = starts[segments] - np.cumsum(sizes) + sizes
+    return np.repeat(offsets, sizes) + np.arange(len(rows))
+
+
+def _combined_key(*keys):
+    # the arrays of non negative ints as a single int64 key, in the order
+    # of the first key then the next, and the sizes of the key ranges;
+    # None if the keys do not fit in an int64
+    if len(keys[0]) == 0 or min(int(key.min()) for key in keys) < 0:
+        return None
+    sizes = [int(key.max()) + 1 for key in keys]
+    if np.prod([float(size) for size in sizes]) >= 2 ** 62:
+        return None
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for key, size in zip(keys, sizes):
+        combined *= size
+        combined += key
+    return combined, sizes
+
+
+def _split_key(combined, sizes):
+    # the inverse of _combined_key
+    keys = []
+    for size in sizes[:0:-1]:
+        combined, key = np.divmod(combined, size)
+        keys.append(key)
+    keys.append(combined)
+    return keys[::-1]
+
+
+def _block_array(block_keys, block_weights):
+    # the weight of each block id, 0 for the keys not in the dict
+    return np.array([block_weights.get(key, 0) for key in block_keys],
+                    dtype=np.float64)
+
+
+def _with_data(data_matrix, data):
+    # a copy of the csr matrix with other values
+    data_matrix = csr_matrix((data, data_matrix.indices.copy(),
+                              data_matrix.indptr.copy()),
+                             shape=data_matrix.shape)
+    data_matrix.has_canonical_format = False
+    return data_matrix
+
+
+# stats that record nothing, for the callers that do not profile
+_NO_STATS = PipelineStats(enabled=False)
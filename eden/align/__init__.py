@@ -67,14 +67,14 @@ def stable(rankings, list_a, list_b):
 def init_vec(orig_graph):
     graph = orig_graph.copy()
     for u in graph.nodes():
-        graph.node[u]['vec'] = []
+        graph.nodes[u]['vec'] = []
     return graph
 
 
 def annotate_with_bfs(orig_graph, start, max_depth=20):
     graph = orig_graph.copy()
     for u in graph.nodes():
-        graph.node[u]['vec'].append(1)
+        graph.nodes[u]['vec'].append(1)
 
     visited, queue, dist = set(), [start], dict()
     dist[start] = 0
@@ -84,7 +84,7 @@ def annotate_with_bfs(orig_graph, start, max_depth=20):
             if vertex not in visited:
                 visited.add(vertex)
                 val = max_depth - dist[vertex]
-                graph.node[vertex]['vec'][-1] = val
+                graph.nodes[vertex]['vec'][-1] = val
                 next_nodes = [u for u in graph.neighbors(vertex)
                               if u not in visited]
                 next_dist = dist[vertex] + 1
@@ -181,10 +181,10 @@ def _max_common_subgraph(GA, GB, pairings):
     for i, j in GA.edges():
         ii = matches[i]
         jj = matches[j]
-        li = GA.node[i]['label']
-        lii = GB.node[ii]['label']
-        lj = GA.node[j]['label']
-        ljj = GB.node[jj]['label']
+        li = GA.nodes[i]['label']
+        lii = GB.nodes[ii]['label']
+        lj = GA.nodes[j]['label']
+        ljj = GB.nodes[jj]['label']
         if ((ii, jj) in GB.edges() or (jj, ii) in GB.edges()) and li == lii and lj == ljj:
             node_ids.append(ii)
             node_ids.append(jj)
@@ -342,7 +342,7 @@ def draw_match(GA, GB, pairings, size=10):
     G = nx.disjoint_union(GA, GB)
     for i, jj in enumerate(pairings):
         j = len(GA) + jj
-        if G.node[i]['label'] == G.node[j]['label']:
+        if G.nodes[i]['label'] == G.nodes[j]['label']:
             G.add_edge(i, j, label=i, nesting=True)
     draw_graph(
         G,
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""Provides timing and memory benchmarks of the main functions of EDeN.
+
+Each benchmark prepares its input with the reproducible generators of
+eden.benchmark.generators and is run on a grid of parameters (graph size,
+r, d, nbits). For each case the best wall clock time over a number of
+repeats and the peak memory allocated during one run (as traced by
+tracemalloc) are reported, with the metrics that some benchmarks add
+(e.g. the recall of the approximate similarity search). Reports are json
+files: a report can be
+compared with a baseline report, e.g. one produced before an upgrade,
+and the cases that got slower (or use more memory) than the baseline by
+more than a threshold are listed as regressions.
+
+From the command line:
+
+    python -m eden.benchmark --output report.json
+    python -m eden.benchmark --baseline report.json --threshold 0.2
+
+>>> report = run_benchmarks(filter='transform/path', repeat=1,
+...                         grid=dict(n=[5], size=[10], r=[1], d=[1],
+...                                   nbits=[10]))
+>>> [result['name'] for result in report['results']]
+['transform/path']
+>>> regressions = compare(report, report)
+>>> len(regressions)
+0
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+import numpy as np
+from eden.benchmark import generators
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the grids of parameters: each benchmark is run on the combinations of
+# the parameters that it uses; large_size is the number of nodes of the
+# single graph of the large graph benchmarks
+QUICK_GRID = dict(n=[100], size=[20], r=[2], d=[3], nbits=[16], k=[10],
+                  large_size=[10000], neighborhood=['bfs', 'wl'])
+FULL_GRID = dict(n=[1000], size=[20, 100], r=[1, 3], d=[3, 6],
+                 nbits=[14, 18], k=[10, 100],
+                 large_size=[10000, 100000, 1000000],
+                 neighborhood=['bfs', 'wl'])
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, params):
+    """Register a benchmark.
+
+    The decorated function receives the values of params and returns a
+    pair (run, n_items): run is the function without arguments to time,
+    n_items the number of instances it processes. It can also return a
+    triple (run, n_items, metrics), where metrics is a dict of numbers
+    that are reported with the case.
+    """
+    def register(func):
+        BENCHMARKS[name] = (func, params)
+        return func
+    return register
+
+
+def run_benchmarks(filter=None, grid=None, repeat=3):
+    """Run the benchmarks and return a report.
+
+    Parameters
+    ----------
+    filter : string (default None)
+        If given, run only the benchmarks whose name contains it.
+
+    grid : dict (default None)
+        The values of each parameter (n, size, r, d, nbits, k, large_size,
+        neighborhood). The missing parameters take the values of
+        QUICK_GRID.
+
+    repeat : int (default 3)
+        The number of timed runs of each case: the best time is reported.
+
+    Returns
+    -------
+    report : dict
+        The description of the environment (key 'environment') and the
+        list of results (key 'results').
+    """
+    full_grid = dict(QUICK_GRID)
+    if grid is not None:
+        full_grid.update(grid)
+    results = []
+    for name, (func, params) in BENCHMARKS.items():
+        if filter is not None and filter not in name:
+            continue
+        for values in itertools.product(*[full_grid[p] for p in params]):
+            kwargs = dict(zip(params, values))
+            result = _run_case(name, func, kwargs, repeat)
+            logger.debug(_format_result(result))
+            results.append(result)
+    return dict(environment=_environment(), results=results)
+
+
+def compare(report, baseline, threshold=0.2, min_time=1e-3):
+    """Return the cases of the report that regressed w.r.t. the baseline.
+
+    Parameters
+    ----------
+    report : dict
+        The current report.
+
+    baseline : dict
+        The reference report.
+
+    threshold : float (default 0.2)
+        The relative increase of time or of peak memory that counts as a
+        regression.
+
+    min_time : float (default 0.001)
+        Times below this number of seconds are too noisy to compare and
+        are ignored.
+
+    Returns
+    -------
+    regressions : list of dicts
+        One dict per regressed metric, with the case key, the metric
+        ('time', 'peak_memory' or 'status'), the baseline value, the
+        current value and their ratio.
+    """
+    reference = dict((result['key'], result)
+                     for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        base = reference.get(result['key'], None)
+        if base is None or base['status'] != 'ok':
+            continue
+        if result['status'] != 'ok':
+            regressions.append(dict(key=result['key'], metric='status',
+                                    baseline=base['status'],
+                                    current=result['status'], ratio=None))
+            continue
+        for metric in ('time', 'peak_memory'):
+            if metric == 'time' and base[metric] < min_time:
+                continue
+            ratio = result[metric] / max(base[metric], 1e-12)
+            if ratio > 1 + threshold:
+                regressions.append(dict(key=result['key'], metric=metric,
+                                        baseline=base[metric],
+                                        current=result[metric],
+                                        ratio=ratio))
+    return regressions
+
+
+def save_report(report, filename):
+    """Write a report in a json file."""
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def load_report(filename):
+    """Read a report from a json file."""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def format_report(report, regressions=None):
+    """Return a text table of the results and of the regressions."""
+    lines = [_format_result(result) for result in report['results']]
+    for regression in regressions or []:
+        if regression['metric'] == 'status':
+            lines.append('REGRESSION %s: %s' % (regression['key'],
+                                                regression['current']))
+        else:
+            lines.append('REGRESSION %s: %s %.4g -> %.4g (x%.2f)' % (
+                regression['key'], regression['metric'],
+                regression['baseline'], regression['current'],
+                regression['ratio']))
+    return '\n'.join(lines)
+
+
+# -------------------------------------------------------------------
+# benchmarks
+
+def _vectorize(graphs, n_items, **opts):
+    from eden.graph import Vectorizer
+    vectorizer = Vectorizer(**opts)
+    return lambda: vectorizer.transform(graphs), n_items
+
+
+@benchmark('transform/path', ['n', 'size', 'r', 'd', 'nbits'])
+def _transform_path(n, size, r, d, nbits):
+    graphs = generators.path_graphs(n, size)
+    return _vectorize(graphs, n, r=r, d=d, nbits=nbits)
+
+
+@benchmark('transform/rna', ['n', 'size', 'r', 'd', 'nbits'])
+def _transform_rna(n, size, r, d, nbits):
+    graphs = generators.rna_graphs(n, size)
+    return _vectorize(graphs, n, r=r, d=d, nbits=nbits)
+
+
+@benchmark('transform/molecule', ['n', 'size', 'r', 'd', 'nbits'])
+def _transform_molecule(n, size, r, d, nbits):
+    graphs = generators.molecule_graphs(n, size)
+    return _vectorize(graphs, n, r=r, d=d, nbits=nbits)
+
+
+@benchmark('transform/weighted', ['n', 'size', 'r', 'd', 'nbits'])
+def _transform_weighted(n, size, r, d, nbits):
+    graphs = generators.weighted_graphs(n, size)
+    return _vectorize(graphs, n, r=r, d=d, nbits=nbits)
+
+
+@benchmark('transform/vector', ['n', 'size', 'r', 'd', 'nbits'])
+def _transform_vector(n, size, r, d, nbits):
+    # the vector labels are expensive: use a tenth of the graphs
+    n = max(1, n // 10)
+    graphs = generators.vector_graphs(n, size)
+    return _vectorize(graphs, n, r=r, d=d, nbits=nbits, discrete=False)
+
+
+@benchmark('transform/large_molecule',
+           ['large_size', 'r', 'd', 'nbits', 'neighborhood'])
+def _transform_large_molecule(large_size, r, d, nbits, neighborhood):
+    # a single graph: the time per item is the time per node
+    graphs = generators.molecule_graphs(1, large_size)
+    return _vectorize(graphs, large_size, r=r, d=d, nbits=nbits,
+                      neighborhood=neighborhood)
+
+
+@benchmark('vertex_transform/molecule', ['n', 'size', 'r', 'd', 'nbits'])
+def _vertex_transform_molecule(n, size, r, d, nbits):
+    from eden.graph import Vectorizer
+    graphs = generators.molecule_graphs(n, size)
+    vectorizer = Vectorizer(r=r, d=d, nbits=nbits)
+    return lambda: vectorizer.vertex_transform(graphs), n
+
+
+@benchmark('annotate/molecule', ['n', 'size', 'r', 'd', 'nbits'])
+def _annotate_molecule(n, size, r, d, nbits):
+    from eden.graph import Vectorizer
+    from sklearn.linear_model import SGDClassifier
+    graphs = generators.molecule_graphs(n, size)
+    vectorizer = Vectorizer(r=r, d=d, nbits=nbits)
+    targets = np.arange(n) % 2
+    estimator = SGDClassifier(random_state=1).fit(
+        vectorizer.transform(graphs), targets)
+    return lambda: list(vectorizer.annotate(graphs,
+                                            estimator=estimator)), n
+
+
+@benchmark('sequence/transform', ['n', 'size', 'r', 'd', 'nbits'])
+def _sequence_transform(n, size, r, d, nbits):
+    from eden.sequence import Vectorizer
+    seqs = generators.sequences(n, size)
+    vectorizer = Vectorizer(r=r, d=d, nbits=nbits)
+    return lambda: vectorizer.transform(seqs), n
+
+
+@benchmark('sequence/transform_alphabet', ['n', 'size', 'r', 'd', 'nbits'])
+def _sequence_transform_alphabet(n, size, r, d, nbits):
+    from eden.sequence import Vectorizer
+    seqs = generators.sequences(n, size)
+    vectorizer = Vectorizer(r=r, d=d, nbits=nbits, alphabet='ACGU')
+    return lambda: vectorizer.transform(seqs), n
+
+
+def _similarity_index(n, size, r, d, nbits):
+    # an index of molecule graphs and the vectors of other graphs to query
+    from eden.graph import Vectorizer
+    from eden.index import SimilarityIndex
+    n_queries = max(1, n // 10)
+    graphs = generators.molecule_graphs(n + n_queries, size)
+    data_matrix = Vectorizer(r=r, d=d, nbits=nbits).transform(graphs)
+    index = SimilarityIndex(path=_tempdir())
+    index.add(data_matrix[:n])
+    return index, data_matrix[n:]
+
+
+@benchmark('index/query_exact', ['n', 'size', 'r', 'd', 'nbits', 'k'])
+def _index_query_exact(n, size, r, d, nbits, k):
+    index, queries = _similarity_index(n, size, r, d, nbits)
+    return lambda: index.query(queries, k=k, exact=True), queries.shape[0]
+
+
+@benchmark('index/query_approximate', ['n', 'size', 'r', 'd', 'nbits', 'k'])
+def _index_query_approximate(n, size, r, d, nbits, k):
+    from eden.index import recall_at_k
+    index, queries = _similarity_index(n, size, r, d, nbits)
+    metrics = dict(recall_at_k=recall_at_k(index, queries, k=k))
+    return lambda: index.query(queries, k=k), queries.shape[0], metrics
+
+
+@benchmark('align/match', ['n', 'size'])
+def _align_match(n, size):
+    from eden.align import match
+    # the alignment is quadratic in the size: use fewer pairs
+    n = max(1, n // 20)
+    graphs = generators.molecule_graphs(2 * n, size)
+    pairs = list(zip(graphs[:n], graphs[n:]))
+    return lambda: [match(graph_a, graph_b) for graph_a, graph_b
+                    in pairs], n
+
+
+@benchmark('kk_embedder/transform', ['n', 'size'])
+def _kk_embedder_transform(n, size):
+    from eden.display.graph_layout import KKEmbedder
+    n = max(1, n // 100)
+    graphs = generators.molecule_graphs(n, size)
+    return lambda: [KKEmbedder().transform(graph) for graph in graphs], n
+
+
+@benchmark('io/gspan', ['n', 'size'])
+def _io_gspan(n, size):
+    from eden.io.gspan import eden_to_gspan, load
+    filename = os.path.join(_tempdir(), 'graphs.gspan')
+    eden_to_gspan(generators.molecule_graphs(n, size), filename)
+    return lambda: list(load(filename)), n
+
+
+@benchmark('io/node_link', ['n', 'size'])
+def _io_node_link(n, size):
+    from eden.io.node_link_data import eden_to_node_link_file, load
+    filename = os.path.join(_tempdir(), 'graphs.json')
+    eden_to_node_link_file(generators.molecule_graphs(n, size), filename)
+    return lambda: list(load(filename)), n
+
+
+@benchmark('io/sequence', ['n', 'size'])
+def _io_sequence(n, size):
+    from eden.io.sequence import load
+    filename = os.path.join(_tempdir(), 'sequences.txt')
+    with open(filename, 'w') as f:
+        for seq in generators.sequences(n, size):
+            f.write('%s\n' % seq)
+    return lambda: list(load(filename)), n
+
+
+# -------------------------------------------------------------------
+
+_TEMPDIRS = []
+
+
+def _tempdir():
+    # a directory for the input files of the io benchmarks, removed at the
+    # end of the case
+    path = tempfile.mkdtemp(prefix='eden_benchmark_')
+    _TEMPDIRS.append(path)
+    return path
+
+
+def _case_key(name, kwargs):
+    return '%s[%s]' % (name, ','.join('%s=%s' % (k, kwargs[k])
+                                      for k in sorted(kwargs)))
+
+
+def _run_case(name, func, kwargs, repeat):
+    result = dict(name=name, params=kwargs, key=_case_key(name, kwargs))
+    try:
+        prepared = func(**kwargs)
+        run, n_items = prepared[:2]
+        if len(prepared) > 2:
+            result['metrics'] = prepared[2]
+        # one untimed run to warm up the caches, then the timed runs
+        run()
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result.update(status='ok',
+                      n_items=n_items,
+                      time=min(times),
+                      time_per_item=min(times) / n_items,
+                      peak_memory=peak_memory)
+    except Exception as e:
+        logger.debug('benchmark %s failed' % result['key'], exc_info=True)
+        result.update(status='error: %s: %s' % (type(e).__name__, e))
+    finally:
+        while _TEMPDIRS:
+            shutil.rmtree(_TEMPDIRS.pop(), ignore_errors=True)
+    return result
+
+
+def _format_result(result):
+    if result['status'] != 'ok':
+        return '%-60s %s' % (result['key'], result['status'])
+    line = '%-60s %9.4fs %9.1fus/item %9.2fMB' % (
+        result['key'], result['time'], 1e6 * result['time_per_item'],
+        result['peak_memory'] / 2 ** 20)
+    for name, value in sorted(result.get('metrics', {}).items()):
+        line += ' %s=%.4g' % (name, value)
+    return line
+
+
+def _environment():
+    import networkx
+    import scipy
+    import sklearn
+    from eden import __version__
+    return dict(eden=__version__,
+                python=sys.version.split()[0],
+                numpy=np.__version__,
+                scipy=scipy.__version__,
+                networkx=networkx.__version__,
+                sklearn=sklearn.__version__,
+                platform=platform.platform(),
+                processor=platform.processor(),
+                date=datetime.datetime.now().isoformat())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Run the benchmarks from the command line: python -m eden.benchmark."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import sys
+from eden.benchmark import FULL_GRID, QUICK_GRID
+from eden.benchmark import run_benchmarks, compare
+from eden.benchmark import save_report, load_report, format_report
+from eden.util import configure_logging
+
+logger = logging.getLogger('eden.benchmark')
+
+
+def main(argv=None):
+    """Run the benchmarks, compare with a baseline and write the report.
+
+    The exit status is 1 if there are regressions w.r.t. the baseline.
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m eden.benchmark',
+        description='Timing and peak memory benchmarks of EDeN.')
+    parser.add_argument('--output', help='write the json report here')
+    parser.add_argument('--baseline', help='json report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative increase that is a regression '
+                        '(default 0.2)')
+    parser.add_argument('--filter', default=None,
+                        help='run only the benchmarks whose name '
+                        'contains this string')
+    parser.add_argument('--full', action='store_true',
+                        help='use the full grid of parameters')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs per case (default 3)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='log each case as it completes')
+    args = parser.parse_args(argv)
+    configure_logging(logger, verbosity=2 if args.verbose else 1)
+
+    grid = FULL_GRID if args.full else QUICK_GRID
+    report = run_benchmarks(filter=args.filter, grid=grid,
+                            repeat=args.repeat)
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(report, load_report(args.baseline),
+                              threshold=args.threshold)
+    print(format_report(report, regressions))
+    if args.output is not None:
+        save_report(report, args.output)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
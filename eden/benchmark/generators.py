@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Provides reproducible generators of synthetic graphs and sequences.
+
+All generators take a random_state: the same arguments give the same
+instances, in any process and with any hash seed.
+
+>>> graphs = rna_graphs(n_graphs=2, size=30, random_state=1)
+>>> [g.number_of_nodes() for g in graphs]
+[30, 30]
+>>> any(d.get('nesting', False) for u, v, d in graphs[0].edges(data=True))
+True
+>>> g1 = molecule_graphs(n_graphs=3, size=12, random_state=2)
+>>> g2 = molecule_graphs(n_graphs=3, size=12, random_state=2)
+>>> [sorted(g.edges()) for g in g1] == [sorted(g.edges()) for g in g2]
+True
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import networkx as nx
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def sequences(n_sequences=100, length=100, alphabet='ACGU', random_state=1):
+    """Return a list of random strings.
+
+    Parameters
+    ----------
+    n_sequences : int (default 100)
+        The number of strings.
+
+    length : int (default 100)
+        The length of each string.
+
+    alphabet : string (default 'ACGU')
+        The characters of the strings.
+
+    random_state : int (default 1)
+        The seed of the random number generator.
+
+    Returns
+    -------
+    seqs : list of strings
+    """
+    rng = np.random.RandomState(random_state)
+    alphabet = np.array(list(alphabet))
+    return [''.join(alphabet[rng.randint(len(alphabet), size=length)])
+            for _ in range(n_sequences)]
+
+
+def path_graphs(n_graphs=100, size=100, alphabet='ACGU', random_state=1):
+    """Return path graphs, i.e. sequences as graphs.
+
+    The nodes have the characters of a random string as labels, the edges
+    have the label '-'.
+    """
+    return [_path_graph(seq) for seq in
+            sequences(n_graphs, size, alphabet, random_state)]
+
+
+def rna_graphs(n_graphs=100, size=100, alphabet='ACGU', random_state=1):
+    """Return RNA-like graphs: a backbone path with base pair edges.
+
+    The base pairs are drawn as a random nested (secondary) structure
+    where about a quarter of the nucleotides are paired; the base pair edges
+    have the label '=' and the attribute nesting=True.
+    """
+    rng = np.random.RandomState(random_state)
+    graphs = []
+    for seq in sequences(n_graphs, size, alphabet, random_state):
+        graph = _path_graph(seq)
+        for u, v in _nested_pairs(size, rng):
+            graph.add_edge(u, v, label='=', nesting=True)
+        graphs.append(graph)
+    return graphs
+
+
+def molecule_graphs(n_graphs=100, size=30, random_state=1):
+    """Return molecule-like graphs.
+
+    A random tree of atoms (mostly C, some N, O and S) with bond labels
+    '1' and '2', where about one tenth of the atoms close a ring with a
+    node that is 4 to 6 bonds away.
+    """
+    rng = np.random.RandomState(random_state)
+    atoms = np.array(['C', 'N', 'O', 'S'])
+    atom_p = [0.7, 0.15, 0.1, 0.05]
+    graphs = []
+    for _ in range(n_graphs):
+        graph = nx.Graph()
+        for u, atom in enumerate(rng.choice(atoms, size=size, p=atom_p)):
+            graph.add_node(u, label=str(atom))
+        # attach each atom to a random previous one, with a bias towards
+        # the recent ones to get chains rather than stars
+        for u in range(1, size):
+            v = max(0, u - int(rng.geometric(0.5)))
+            graph.add_edge(u, v, label=_bond(rng))
+        for u in rng.choice(size, size=size // 10, replace=False).tolist():
+            lengths = nx.single_source_shortest_path_length(graph, u,
+                                                            cutoff=6)
+            candidates = sorted(v for v, length in lengths.items()
+                                if length >= 4)
+            if candidates:
+                v = candidates[rng.randint(len(candidates))]
+                graph.add_edge(u, v, label=_bond(rng))
+        graphs.append(graph)
+    return graphs
+
+
+def weighted_graphs(n_graphs=100, size=30, random_state=1):
+    """Return molecule-like graphs with random weights on nodes and edges."""
+    rng = np.random.RandomState(random_state + 1)
+    graphs = molecule_graphs(n_graphs, size, random_state)
+    for graph in graphs:
+        for u in graph.nodes():
+            graph.nodes[u]['weight'] = float(rng.uniform(0.1, 1))
+        for u, v in graph.edges():
+            graph.edges[u, v]['weight'] = float(rng.uniform(0.1, 1))
+    return graphs
+
+
+def vector_graphs(n_graphs=100, size=30, n_dims=8, random_state=1):
+    """Return molecule-like graphs with a real vector label on each node.
+
+    The vectors are in the attribute 'vec', as used by the vectorizer
+    with discrete=False.
+    """
+    rng = np.random.RandomState(random_state + 1)
+    graphs = molecule_graphs(n_graphs, size, random_state)
+    for graph in graphs:
+        for u in graph.nodes():
+            graph.nodes[u]['vec'] = rng.uniform(-1, 1, size=n_dims).tolist()
+    return graphs
+
+
+# -------------------------------------------------------------------
+
+def _path_graph(seq):
+    graph = nx.Graph()
+    for u, char in enumerate(seq):
+        graph.add_node(u, label=char)
+        if u > 0:
+            graph.add_edge(u - 1, u, label='-')
+    return graph
+
+
+def _bond(rng):
+    return '2' if rng.uniform() < 0.15 else '1'
+
+
+def _nested_pairs(size, rng, min_loop=3):
+    # random non crossing pairs (i, j), j - i > min_loop, as in a
+    # secondary structure: a stack of opened positions is closed at
+    # random
+    pairs, opened = [], []
+    for i in range(size):
+        if opened and i - opened[-1] > min_loop and rng.uniform() < 0.3:
+            pairs.append((opened.pop(), i))
+        elif rng.uniform() < 0.3:
+            opened.append(i)
+    return pairs
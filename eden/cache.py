@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""Provides a persistent cache for the feature vectors of graphs.
+
+The feature vector of a graph is stored under a key that is the digest of
+the graph content (labels, weights, vector labels and structure) and of the
+parameters of the vectorizer, so that re-vectorizing the same graph with
+the same parameters, e.g. across experiments or cross validation folds,
+costs a lookup. The digest does not depend on the node ids: the same
+graph with renumbered nodes, e.g. a molecule read from another file, hits
+the cache.
+
+The rows are stored in a sqlite database, which can be shared by several
+processes, with a least recently used eviction policy and a cap on the size
+of the stored data; the total size is kept up to date by triggers, so that
+checking the cap does not scan the table. A small in-memory LRU cache sits
+in front of the database.
+
+Note: with hashing='python' the feature ids of string labels depend on the
+hash seed of the process, which is therefore part of the key: to reuse the
+cache across processes use hashing='stable' or set PYTHONHASHSEED.
+
+>>> import networkx as nx
+>>> from eden.graph import Vectorizer
+>>> graph = nx.path_graph(4)
+>>> for u in graph.nodes():
+...     graph.nodes[u]['label'] = 'C'
+>>> for u, v in graph.edges():
+...     graph.edges[u, v]['label'] = '-'
+>>> keys = ['label']
+>>> renumbered = nx.relabel_nodes(graph, {0: 'a', 1: 'b', 2: 'c', 3: 'd'})
+>>> graph_digest(graph, keys) == graph_digest(renumbered, keys)
+True
+>>> vectorizer = Vectorizer(cache=FeatureCache())
+>>> x = vectorizer.transform([graph, graph])
+>>> vectorizer.cache.hits, vectorizer.cache.misses
+(0, 2)
+>>> y = vectorizer.transform([graph])
+>>> vectorizer.cache.hits, vectorizer.cache.misses
+(1, 2)
+>>> bool(abs(x[0] - y).max() == 0)
+True
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import hashlib
+import os
+import sqlite3
+import time
+from collections import Counter, OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FeatureCache(object):
+    """Store the feature vectors of graphs on disk and in memory.
+
+    Parameters
+    ----------
+    path : string (default None)
+        The sqlite database file. If None only the in-memory cache is used.
+
+    max_size : int (default 2^30)
+        The maximal size in bytes of the rows stored in the database. When
+        it is exceeded the least recently used rows are evicted.
+
+    memory_size : int (default 1024)
+        The number of rows kept in the in-memory cache.
+
+    timeout : float (default 60)
+        The number of seconds a process waits for a database lock held by
+        another process.
+    """
+
+    def __init__(self, path=None, max_size=2 ** 30, memory_size=1024,
+                 timeout=60):
+        """Constructor."""
+        self.path = path
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        """Drop the connection and the in-memory rows when pickled."""
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def get(self, keys):
+        """Return the cached rows of the keys, None for the missing ones."""
+        rows = [self._memory.get(key, None) for key in keys]
+        for key, row in zip(keys, rows):
+            if row is not None:
+                self._memory.move_to_end(key)
+        missing = [key for key, row in zip(keys, rows) if row is None]
+        if missing and self.path is not None:
+            stored = self._select(missing)
+            for i, key in enumerate(keys):
+                if rows[i] is None and key in stored:
+                    rows[i] = stored[key]
+                    self._remember(key, rows[i])
+        n_hits = sum(1 for row in rows if row is not None)
+        self.hits += n_hits
+        self.misses += len(rows) - n_hits
+        return rows
+
+    def put(self, keys, data_matrix):
+        """Store the rows of the data matrix under the keys."""
+        data_matrix = csr_matrix(data_matrix)
+        rows = [data_matrix[i] for i in range(data_matrix.shape[0])]
+        for key, row in zip(keys, rows):
+            self._remember(key, row)
+        if self.path is not None:
+            self._insert(keys, rows)
+
+    def stats(self):
+        """Return a dict with the counters and the size of the cache."""
+        stats = dict(hits=self.hits,
+                     misses=self.misses,
+                     memory_rows=len(self._memory),
+                     stored_rows=0,
+                     stored_size=0)
+        if self.path is not None:
+            with self._connect() as connection:
+                n_rows, = connection.execute(
+                    'SELECT COUNT(*) FROM features').fetchone()
+                size, = connection.execute(
+                    'SELECT size FROM stored_size').fetchone()
+            stats.update(stored_rows=n_rows, stored_size=size)
+        return stats
+
+    def merge(self, other):
+        """Add the hits and misses of other (cache or dict) to these."""
+        if isinstance(other, FeatureCache):
+            other = dict(hits=other.hits, misses=other.misses)
+        self.hits += other['hits']
+        self.misses += other['misses']
+
+    def worker_copy(self):
+        """Return a cache on the same database with zero counters, for a
+        worker process."""
+        cache = copy.copy(self)
+        cache.reset_counters()
+        return cache
+
+    def reset_counters(self):
+        """Set the hits and misses to zero."""
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Remove all rows and reset the counters."""
+        self._memory.clear()
+        self.reset_counters()
+        if self.path is not None:
+            with self._connect() as connection:
+                connection.execute('DELETE FROM features')
+
+    def _remember(self, key, row):
+        self._memory[key] = row
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _connect(self):
+        # one connection per process: connections must not cross a fork
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                logger.debug('WAL journal not available for %s' % self.path)
+            # the rows deleted by INSERT OR REPLACE fire the delete trigger
+            connection.execute('PRAGMA recursive_triggers = ON')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS features ('
+                    'key TEXT PRIMARY KEY, n_features INTEGER, '
+                    'indices BLOB, data BLOB, size INTEGER, '
+                    'last_access REAL)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS features_last_access '
+                    'ON features (last_access)')
+                # the total size of the rows, in a single row table
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS stored_size ('
+                    'id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+                connection.execute(
+                    'INSERT OR IGNORE INTO stored_size (id, size) '
+                    'SELECT 0, COALESCE(SUM(size), 0) FROM features')
+                connection.execute(
+                    'CREATE TRIGGER IF NOT EXISTS features_insert '
+                    'AFTER INSERT ON features BEGIN '
+                    'UPDATE stored_size SET size = size + NEW.size; END')
+                connection.execute(
+                    'CREATE TRIGGER IF NOT EXISTS features_delete '
+                    'AFTER DELETE ON features BEGIN '
+                    'UPDATE stored_size SET size = size - OLD.size; END')
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _select(self, keys):
+        stored = {}
+        now = time.time()
+        with self._connect() as connection:
+            # sqlite limits the number of parameters of a statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                query = 'SELECT key, n_features, indices, data ' \
+                    'FROM features WHERE key IN (%s)' % \
+                    ','.join('?' * len(chunk))
+                for key, n_features, indices, data in \
+                        connection.execute(query, chunk):
+                    indices = np.frombuffer(indices, dtype=np.int64)
+                    data = np.frombuffer(data, dtype=np.float64)
+                    stored[key] = csr_matrix(
+                        (data.copy(), indices.astype(np.int32),
+                         [0, len(data)]), shape=(1, n_features))
+            connection.executemany(
+                'UPDATE features SET last_access = ? WHERE key = ?',
+                [(now, key) for key in stored])
+        return stored
+
+    def _insert(self, keys, rows):
+        now = time.time()
+        records = []
+        for key, row in zip(keys, rows):
+            indices = row.indices.astype(np.int64).tobytes()
+            data = row.data.astype(np.float64).tobytes()
+            records.append((key, row.shape[1], indices, data,
+                            len(indices) + len(data), now))
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO features '
+                '(key, n_features, indices, data, size, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?)', records)
+            self._evict(connection)
+
+    def _evict(self, connection):
+        size, = connection.execute(
+            'SELECT size FROM stored_size').fetchone()
+        if size <= self.max_size:
+            return
+        # remove the least recently used rows down to 90% of the cap
+        excess = size - int(0.9 * self.max_size)
+        evicted = []
+        for key, row_size in connection.execute(
+                'SELECT key, size FROM features ORDER BY last_access'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= row_size
+        connection.executemany('DELETE FROM features WHERE key = ?', evicted)
+        logger.debug('evicted %d rows from %s' % (len(evicted), self.path))
+
+
+def graph_digest(graph, keys, seed='', ids=False):
+    """Return a digest of the content of a graph.
+
+    The digest depends on the attributes and on the structure, and not on
+    the node ids or on the order in which nodes and edges were inserted.
+    The nodes are put in a canonical order by color refinement (as in the
+    Weisfeiler-Lehman test): the color of a node starts from its
+    attributes and is repeatedly combined with the colors of its
+    neighbors and the attributes of the edges to them. Nodes that keep
+    the same color are told apart by giving a new color to one of them,
+    chosen by id, and refining again: when they are symmetric, as the two
+    ends of a path, the choice does not matter. The digest is the one of
+    the whole graph in the canonical order, so that different graphs get
+    different digests.
+
+    Parameters
+    ----------
+    graph : networkx graph
+        The graph.
+
+    keys : list of strings
+        The node and edge attributes that are part of the content.
+
+    seed : string (default '')
+        A string that is hashed together with the graph, e.g. a digest
+        of the parameters of the vectorizer.
+
+    ids : bool (default False)
+        If True the node ids are part of the content, e.g. when they are
+        positions, as with the positional option of the vectorizer.
+
+    Returns
+    -------
+    digest : string
+    """
+    nodes = list(graph.nodes())
+    index = dict((u, i) for i, u in enumerate(nodes))
+    node_codes = [repr(_encode_attributes(attr, keys))
+                  for u, attr in graph.nodes(data=True)]
+    if ids:
+        node_codes = [repr((repr(u), code))
+                      for u, code in zip(nodes, node_codes)]
+    edges = list(graph.edges(data=True))
+    edge_codes = [repr(_encode_attributes(attr, keys))
+                  for u, v, attr in edges]
+    order = _canonical_order(
+        nodes, _ranks(node_codes),
+        [(index[u], index[v], color) for (u, v, attr), color
+         in zip(edges, _ranks(edge_codes))],
+        graph.is_directed())
+    position = dict((i, k) for k, i in enumerate(order))
+    items = []
+    for (u, v, attr), code in zip(edges, edge_codes):
+        source, target = position[index[u]], position[index[v]]
+        if not graph.is_directed():
+            source, target = min(source, target), max(source, target)
+        items.append((source, target, code))
+    items.sort()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(seed.encode('utf-8'))
+    digest.update(repr((graph.is_directed(),
+                        'expanded' in graph.graph)).encode('utf-8'))
+    for i in order:
+        digest.update(repr(node_codes[i]).encode('utf-8'))
+    digest.update(b'|')
+    for item in items:
+        digest.update(repr(item).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# -------------------------------------------------------------------
+
+_REFINEMENT_BUDGET = 2 ** 16
+
+
+def _ranks(items):
+    # the rank of each item among the distinct items, which does not
+    # depend on the order of the items
+    ranks = dict((item, i) for i, item in enumerate(sorted(set(items))))
+    return [ranks[item] for item in items]
+
+
+def _canonical_order(nodes, colors, edges, directed):
+    # the indices of the nodes sorted by their colors after refinement,
+    # with the ties broken one at a time; on large symmetric graphs the
+    # refinement is stopped after _REFINEMENT_BUDGET node colors and the
+    # remaining ties are broken by id
+    neighbors = [[] for _ in nodes]
+    for source, target, color in edges:
+        # in directed graphs the successors and the predecessors differ
+        neighbors[source].append((color, 0, target))
+        neighbors[target].append((color, 1 if directed else 0, source))
+    colors, budget = _refine(colors, neighbors, _REFINEMENT_BUDGET)
+    while budget > 0 and len(set(colors)) < len(nodes):
+        counts = Counter(colors)
+        tied = min(color for color, count in counts.items() if count > 1)
+        chosen = min((i for i, color in enumerate(colors) if color == tied),
+                     key=lambda i: repr(nodes[i]))
+        colors = [2 * color for color in colors]
+        colors[chosen] += 1
+        colors, budget = _refine(colors, neighbors, budget)
+    if len(set(colors)) < len(nodes):
+        return sorted(range(len(nodes)),
+                      key=lambda i: (colors[i], repr(nodes[i])))
+    return sorted(range(len(nodes)), key=colors.__getitem__)
+
+
+def _refine(colors, neighbors, budget):
+    # combine the color of each node with the sorted colors of its
+    # neighbors and of the edges to them, until the number of colors stops
+    # growing or the budget of node colors is spent; return the colors and
+    # the remaining budget
+    colors = _ranks(colors)
+    n_colors = len(set(colors))
+    while budget > 0:
+        budget -= len(colors)
+        refined = _ranks([
+            (colors[i], tuple(sorted((color, direction, colors[j])
+                                     for color, direction, j in items)))
+            for i, items in enumerate(neighbors)])
+        if len(set(refined)) == n_colors:
+            break
+        colors, n_colors = refined, len(set(refined))
+    return colors, budget
+
+
+def _encode_attributes(attr, keys):
+    return tuple(_encode(attr[key]) if key in attr else None for key in keys)
+
+
+def _encode(value):
+    # a text that identifies the value; the repr of numpy arrays is
+    # truncated, so their content is digested
+    if issparse(value):
+        value = csr_matrix(value)
+        return ('sparse', value.shape, _array_digest(value.indices),
+                _array_digest(value.indptr), _array_digest(value.data))
+    if isinstance(value, np.ndarray):
+        return ('array', value.shape, _array_digest(value))
+    return repr(value)
+
+
+def _array_digest(array):
+    array = np.ascontiguousarray(array)
+    return str(array.dtype) + hashlib.blake2b(array.tobytes(),
+                                              digest_size=16).hexdigest()
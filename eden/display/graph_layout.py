@@ -37,7 +37,8 @@ class KKEmbedder(BaseEstimator, ClassifierMixin):
         self.dms = []
 
     def _compute_all_pairs(self, graph, weight=None, normalize=False):
-        lengths = nx.all_pairs_dijkstra_path_length(graph, weight=weight)
+        lengths = dict(nx.all_pairs_dijkstra_path_length(graph,
+                                                         weight=weight))
         max_length = max([max(lengths[i].values()) for i in lengths])
         if normalize:
             for i in lengths:
@@ -111,8 +112,8 @@ class KKEmbedder(BaseEstimator, ClassifierMixin):
         A = np.array([[d2Ex2, d2Exy], [d2Eyx, d2Ey2]])
         B = np.array([[-dEx], [-dEy]])
         X = inv(A).dot(B)
-        dx = X[0]
-        dy = X[1]
+        dx = X[0, 0]
+        dy = X[1, 0]
         return dx, dy
 
     def _update(self, pos=None, lengths=None, weights=None):
@@ -145,7 +146,7 @@ class KKEmbedder(BaseEstimator, ClassifierMixin):
     def _compute_weights(self, graph):
         weights = np.ones((len(graph), len(graph)))
         for u, v in graph.edges():
-            val = graph.edge[u][v].get('weight', 1)
+            val = graph.edges[u, v].get('weight', 1)
             weights[u][v] = val
         return weights
 
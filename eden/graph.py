@@ -5,24 +5,31 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import joblib
 import networkx as nx
-import math
 import numpy as np
-from sklearn import metrics
 from sklearn.cluster import MiniBatchKMeans
-from scipy import stats
 from scipy.sparse import csr_matrix
 from scipy.sparse import vstack
-from collections import defaultdict, deque
-from eden import fast_hash, fast_hash_vec
 from eden import fast_hash_2, fast_hash_3, fast_hash_4
-from eden import AbstractVectorizer
+from eden import AbstractVectorizer, __magic__
+from eden import FeatureAccumulator, vstack_feature_blocks
+from eden import _segment_starts, _segment_ends, _sort_order, _NO_STATS
+from eden.cache import FeatureCache, graph_digest
+from eden.kernel import block_kernel_matrix
+from eden.profiling import PipelineStats, BudgetExceeded
+from eden.hashing import get_hasher, hash_tuples, hash_rows, hash_prefixes
 from eden.util import serialize_dict
+from eden.util import block_pmap
 from itertools import tee
+from toolz import partition_all
 import logging
 logger = logging.getLogger(__name__)
 
+# the blocks of a feature without entries
+_NO_BLOCKS = np.zeros(0, dtype=np.int64)
+
 
 def auto_label(graphs, n_clusters=16, **opts):
     """Label nodes with cluster id.
@@ -61,7 +68,11 @@ def auto_relabel(graphs, n_clusters=16, **opts):
 
 
 def vectorize(graphs, **opts):
-    """Transform real vector labeled, weighted graphs in sparse vectors."""
+    """Transform real vector labeled, weighted graphs in sparse vectors.
+
+    Pass n_jobs and block_size in opts to vectorize blocks of graphs in
+    parallel worker processes.
+    """
     return Vectorizer(**opts).transform(graphs)
 
 
@@ -82,10 +93,27 @@ def annotate(graphs,
     return list(result)
 
 
-def kernel_matrix(graphs, **opts):
-    """Return the kernel matrix."""
-    data_matrix = vectorize(graphs, **opts)
-    return metrics.pairwise.pairwise_kernels(data_matrix, metric='linear')
+def kernel_matrix(graphs, other_graphs=None, tile_size=1000, filename=None,
+                  threshold=None, top_k=None, **opts):
+    """Return the kernel matrix.
+
+    The kernel between graphs and other_graphs (default: graphs) is
+    computed by tiles of tile_size x tile_size entries with n_jobs worker
+    processes; pass filename to write it in a memory-mapped file, or
+    threshold and/or top_k to get a sparse matrix (see
+    eden.kernel.block_kernel_matrix).
+    """
+    vectorizer = Vectorizer(**opts)
+    data_matrix = vectorizer.transform(graphs)
+    other_matrix = None
+    if other_graphs is not None:
+        other_matrix = vectorizer.transform(other_graphs)
+    return block_kernel_matrix(data_matrix, other_matrix,
+                               tile_size=tile_size,
+                               n_jobs=vectorizer.n_jobs,
+                               filename=filename,
+                               threshold=threshold,
+                               top_k=top_k)
 
 # --------------------------------------------------------------------------
 
@@ -112,7 +140,15 @@ class Vectorizer(AbstractVectorizer):
                  key_importance='importance',
                  key_class='class',
                  key_vec='vec',
-                 key_svec='svec'):
+                 key_svec='svec',
+                 n_jobs=1,
+                 block_size=100,
+                 hashing='python',
+                 cache=None,
+                 neighborhood='bfs',
+                 collisions='last',
+                 profile=False,
+                 watchdog=None):
         """Constructor.
 
         Parameters
@@ -185,6 +221,64 @@ class Vectorizer(AbstractVectorizer):
         key_svec : string (default 'svec')
             The key used to indicate the sparse vector label information
             in nodes.
+
+        n_jobs : int (default 1)
+            The number of worker processes used by transform and
+            vertex_transform. If 1 the graphs are processed in the current
+            process. If -1 all available cores are used.
+            Note: with hashing='python' labels are hashed with the builtin
+            hash function, so the workers must share the hash seed of the
+            parent process (this is the case with the default 'fork' start
+            method on Linux; with 'spawn' set the PYTHONHASHSEED environment
+            variable or use hashing='stable').
+
+        block_size : int (default 100)
+            The number of graphs that are sent to a worker process at once
+            when n_jobs is not 1.
+
+        hashing : string (default 'python')
+            The backend used to hash the labels. With 'python' the builtin
+            hash function is used and the feature ids of string labels
+            depend on PYTHONHASHSEED. With 'stable' the feature ids are
+            reproducible across processes and machines (see eden.hashing).
+
+        cache : FeatureCache or string (default None)
+            If not None the feature vectors computed by transform are
+            stored in the cache and graphs that are found in the cache are
+            not processed again. A string is the path of the database of a
+            new FeatureCache (see eden.cache).
+
+        neighborhood : string (default 'bfs')
+            The way the neighborhood of radius r of each vertex is hashed.
+            With 'bfs' the sorted labels of the vertices at each distance
+            from the vertex, found by breadth first search, are hashed.
+            With 'wl' the hashes are computed by iterative refinement
+            (as in the Weisfeiler-Lehman test): at each step the hash of a
+            vertex is combined with the sorted hashes of its neighbors,
+            which costs O(|E|) per step instead of the size of the
+            neighborhoods of all vertices, and scales to large graphs with
+            large radii. The positional option always uses 'bfs'.
+
+        collisions : string (default 'last')
+            How the values of a feature id that is generated by several
+            (radius, distance) blocks of a graph (a hash collision) are
+            merged. With 'last' the feature takes the value of the last
+            block, in the order in which the blocks are first generated
+            when the vertices are visited, as in previous versions. With
+            'sum' the values of the blocks are summed.
+
+        profile : bool (default False)
+            If True the time spent in each stage of the vectorization and
+            the number of graphs, vertices, visited vertices, emitted
+            features and merged duplicate features are recorded in the
+            attribute stats, a PipelineStats (see eden.profiling); the
+            stats of the worker processes are merged in it.
+
+        watchdog : Watchdog (default None)
+            If not None, each graph vectorized by transform is timed and
+            the slow ones, or those over a time or ring size budget, are
+            recorded, logged and optionally dumped and skipped or degraded
+            (see eden.profiling.Watchdog).
         """
         self.name = self.__class__.__name__
         self.__version__ = '1.0.1'
@@ -214,6 +308,15 @@ class Vectorizer(AbstractVectorizer):
         self.key_class = key_class
         self.key_vec = key_vec
         self.key_svec = key_svec
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+        self.hashing = hashing
+        self.cache = _make_cache(cache)
+        self.neighborhood = neighborhood
+        self.collisions = collisions
+        self.profile = profile
+        self.stats = PipelineStats(enabled=profile)
+        self.watchdog = watchdog
 
     def set_params(self, **args):
         """Set the parameters of the vectorizer."""
@@ -239,6 +342,23 @@ class Vectorizer(AbstractVectorizer):
             self.inner_normalization = args['inner_normalization']
         if args.get('positional', None) is not None:
             self.positional = args['positional']
+        if args.get('n_jobs', None) is not None:
+            self.n_jobs = args['n_jobs']
+        if args.get('block_size', None) is not None:
+            self.block_size = args['block_size']
+        if args.get('hashing', None) is not None:
+            self.hashing = args['hashing']
+        if args.get('cache', None) is not None:
+            self.cache = _make_cache(args['cache'])
+        if args.get('neighborhood', None) is not None:
+            self.neighborhood = args['neighborhood']
+        if args.get('collisions', None) is not None:
+            self.collisions = args['collisions']
+        if args.get('profile', None) is not None:
+            self.profile = args['profile']
+            self.stats.enabled = self.profile
+        if args.get('watchdog', None) is not None:
+            self.watchdog = args['watchdog']
 
     def get_params(self):
         """Get parameters for teh vectorizer.
@@ -293,16 +413,228 @@ class Vectorizer(AbstractVectorizer):
         >>> vec_to_hash(v.transform([g])) == vec_to_hash(v.transform([g2]))
         True
         """
+        if self.cache is not None:
+            return self._cached_transform(graphs)
+        return self._transform_graphs(graphs)
+
+    def _transform_graphs(self, graphs):
+        if self.n_jobs == 1:
+            return self._transform_block(graphs)
+        blocks = list(self._merge_reports(
+            block_pmap(_transform_block, self._worker_copy(), graphs,
+                       n_jobs=self.n_jobs, block_size=self.block_size)))
+        if len(blocks) == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        return vstack(blocks, format='csr')
+
+    def transform_iter(self, graphs, block_size=None, return_offsets=False):
+        """Transform a stream of networkx graphs into a stream of matrices.
+
+        The graphs are consumed lazily and the feature vectors are yielded
+        in sparse matrices of block_size rows (the last one can be
+        shorter), in the order of the input, so that arbitrarily long
+        streams can be processed in constant memory, e.g. by partial_fit.
+        If n_jobs is not 1 the blocks are vectorized by worker processes,
+        with at most 2 * n_jobs blocks pending at any time.
+
+        Parameters
+        ----------
+        graphs : iterator over networkx graphs
+            The input graphs.
+
+        block_size : int (default None)
+            The number of graphs in each block. If None, the block_size of
+            the vectorizer is used.
+
+        return_offsets : bool (default False)
+            If True yield pairs (offset, data_matrix) where offset is the
+            position in the input of the graph in the first row.
+
+        Returns
+        -------
+        data_matrices : iterator over csr_matrix, shape = [block_size,
+        n_features]
+
+        >>> import networkx as nx
+        >>> def get_path_graph(length=4):
+        ...     g = nx.path_graph(length)
+        ...     for n,d in g.nodes(data=True):
+        ...         d['label'] = 'C'
+        ...     for a,b,d in g.edges(data=True):
+        ...         d['label'] = '1'
+        ...     return g
+        >>> graphs = (get_path_graph(length) for length in range(2, 7))
+        >>> v = Vectorizer()
+        >>> for offset, x in v.transform_iter(graphs, 2, return_offsets=True):
+        ...     print(offset, x.shape[0])
+        0 2
+        2 2
+        4 1
+        """
+        if block_size is None:
+            block_size = self.block_size
+        if self.n_jobs == 1:
+            blocks = (self.transform(list(block))
+                      for block in partition_all(block_size, graphs))
+        elif self.cache is None:
+            blocks = self._merge_reports(
+                block_pmap(_transform_block, self._worker_copy(), graphs,
+                           n_jobs=self.n_jobs, block_size=block_size))
+        else:
+            # the cache is shared with the worker processes
+            blocks = self._merge_reports(
+                block_pmap(_cached_transform_block, self._worker_copy(),
+                           graphs,
+                           n_jobs=self.n_jobs, block_size=block_size))
+        offset = 0
+        for data_matrix in blocks:
+            if return_offsets:
+                yield offset, data_matrix
+            else:
+                yield data_matrix
+            offset += data_matrix.shape[0]
+
+    def _cached_transform(self, graphs, transform_graphs=None):
+        if transform_graphs is None:
+            transform_graphs = self._transform_graphs
+        graphs = list(graphs)
+        if len(graphs) == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        seed = self._cache_seed()
+        # the vertex types are read on graphs that are already expanded
+        attributes = [self.key_label, self.key_weight, self.key_nesting,
+                      self.key_vec, self.key_svec, 'node', 'edge']
+        keys = [graph_digest(graph, attributes, seed, ids=self.positional)
+                for graph in graphs]
+        rows = self.cache.get(keys)
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            data_matrix = transform_graphs([graphs[i] for i in missing])
+            self.cache.put([keys[i] for i in missing], data_matrix)
+            for j, i in enumerate(missing):
+                rows[i] = data_matrix[j]
+        return vstack(rows, format='csr')
+
+    def _cache_seed(self):
+        # the parameters that determine the feature vector of a graph
+        weights = None
+        if self.weights_dict is not None:
+            weights = sorted(self.weights_dict.items())
+        params = (self.__version__, self.r, self.d, self.min_r, self.min_d,
+                  self.nbits, self.normalization, self.inner_normalization,
+                  self.positional, self.discrete, weights,
+                  self.key_label, self.key_weight, self.key_nesting,
+                  self.key_vec, self.key_svec, self.hashing,
+                  self.neighborhood, self.collisions)
+        if self.hashing == 'python':
+            # the hash of string labels depends on the hash seed
+            params += (hash(__magic__),)
+        return repr(params)
+
+    def _transform_block(self, graphs):
+        return self._to_csr(*self._accumulate(graphs))
+
+    def _accumulate(self, graphs):
         instance_id = None
-        feature_rows = []
+        features = FeatureAccumulator()
         for instance_id, graph in enumerate(graphs):
             self._test_goodness(graph)
-            feature_rows.append(self._transform(graph))
+            features.row = instance_id
+            self._transform(graph, features)
         if instance_id is None:
             raise Exception('ERROR: something went wrong:\
                 no graphs are present in current iterator.')
-        data_matrix = self._convert_dict_to_sparse_matrix(feature_rows)
-        return data_matrix
+        return features, instance_id + 1
+
+    def transform_blocks(self, graphs):
+        """Transform a list of networkx graphs into FeatureBlocks.
+
+        The features are kept separated by (radius, distance) block and
+        are not normalized, so that the data matrix of any vectorizer with
+        smaller r and d (and otherwise the same parameters) can be
+        assembled from them with assemble, without processing the graphs
+        again. This makes a search over r, d, min_r, min_d, weights_dict
+        and the normalization cost one vectorization, with the largest r
+        and d, plus one assembly per configuration. The blocks excluded by
+        the weights_dict of this vectorizer are not computed.
+        The unnormalized counts (raw_csr) and the norms of the blocks in
+        each row (norms) can also be stored, and normalized and reweighted
+        later with eden.inner_normalize, eden.reweight, eden.normalize and
+        eden.merge_duplicates.
+
+        Parameters
+        ----------
+        graphs : list[graphs]
+            The input list of networkx graphs.
+
+        Returns
+        -------
+        feature_blocks : FeatureBlocks
+            The features of the graphs, one row per graph.
+
+        >>> import networkx as nx
+        >>> def get_path_graph(length=4):
+        ...     g = nx.path_graph(length)
+        ...     for n,d in g.nodes(data=True):
+        ...         d['label'] = 'C'
+        ...     for a,b,d in g.edges(data=True):
+        ...         d['label'] = '1'
+        ...     return g
+        >>> graphs = [get_path_graph(length) for length in range(2, 7)]
+        >>> blocks = Vectorizer(r=3, d=3).transform_blocks(graphs)
+        >>> small = Vectorizer(r=1, d=2, min_d=1)
+        >>> x = small.assemble(blocks)
+        >>> bool(abs(x - small.transform(graphs)).max() < 1e-12)
+        True
+        """
+        if self.n_jobs == 1:
+            return self._feature_blocks_block(graphs)
+        parts = list(self._merge_reports(
+            block_pmap(_feature_blocks_block, self._worker_copy(), graphs,
+                       n_jobs=self.n_jobs, block_size=self.block_size)))
+        return vstack_feature_blocks(parts)
+
+    def _feature_blocks_block(self, graphs):
+        features, n_rows = self._accumulate(graphs)
+        return features.feature_blocks(n_rows, stats=self.stats)
+
+    def assemble(self, feature_blocks):
+        """Assemble the data matrix of this vectorizer from FeatureBlocks.
+
+        Only the (radius, distance) blocks of this vectorizer are used,
+        normalized according to its parameters. The feature blocks must be
+        computed by transform_blocks with a vectorizer that has the same
+        parameters, except for r and d that can be larger and min_r,
+        min_d, weights_dict, normalization and inner_normalization that
+        can be anything (provided that weights_dict does not exclude
+        blocks needed here).
+
+        Parameters
+        ----------
+        feature_blocks : FeatureBlocks
+            The output of transform_blocks.
+
+        Returns
+        -------
+        data_matrix : csr_matrix, shape = [n_samples, n_features]
+            The matrix that transform would return.
+        """
+        weights = self.weights_dict
+        keys = [(radius, distance)
+                for radius, distance in feature_blocks.block_keys
+                if self.min_r <= radius <= self.r
+                if self.min_d <= distance <= self.d
+                if weights is None or weights.get((radius, distance), 0) != 0]
+        return feature_blocks.to_csr(
+            self.feature_size,
+            keys=keys,
+            inner_normalization=self.inner_normalization,
+            normalization=self.normalization,
+            block_weights=self.weights_dict,
+            collisions=self.collisions,
+            stats=self.stats)
 
     def vertex_transform(self, graphs):
         """Transform a list of networkx graphs into a list of sparse matrices.
@@ -322,6 +654,46 @@ class Vectorizer(AbstractVectorizer):
             Vector representation of each vertex in the input graphs.
 
         """
+        if self.n_jobs == 1:
+            return self._vertex_transform_block(graphs)
+        blocks = self._merge_reports(
+            block_pmap(_vertex_transform_block, self._worker_copy(),
+                       graphs,
+                       n_jobs=self.n_jobs, block_size=self.block_size))
+        return [data_matrix for block in blocks for data_matrix in block]
+
+    def _worker_copy(self):
+        # the vectorizer sent to the worker processes, with its own stats,
+        # watchdog and cache counters
+        if not self._reports():
+            return self
+        vectorizer = copy.copy(self)
+        vectorizer.stats = PipelineStats(enabled=self.stats.enabled)
+        if self.watchdog is not None:
+            vectorizer.watchdog = self.watchdog.worker_copy()
+        if self.cache is not None:
+            vectorizer.cache = self.cache.worker_copy()
+        return vectorizer
+
+    def _reports(self):
+        return self.stats.enabled or self.watchdog is not None or \
+            self.cache is not None
+
+    def _merge_reports(self, results):
+        # unpack the results of the worker processes and add their stats,
+        # watchdog records and cache counters to those of the vectorizer
+        # (see _with_reports)
+        for result in results:
+            if self._reports():
+                result, stats, records, cache_counters = result
+                self.stats.merge(stats)
+                if self.watchdog is not None:
+                    self.watchdog.merge(records)
+                if self.cache is not None:
+                    self.cache.merge(cache_counters)
+            yield result
+
+    def _vertex_transform_block(self, graphs):
         matrix_list = []
         for instance_id, graph in enumerate(graphs):
             self._test_goodness(graph)
@@ -331,29 +703,52 @@ class Vectorizer(AbstractVectorizer):
             matrix_list.append(data_matrix)
         return matrix_list
 
+    def incremental(self, graph, estimator=None):
+        """Return an IncrementalVectorizer for a graph that will be edited.
+
+        Parameters
+        ----------
+        graph : networkx graph
+            The graph to vectorize.
+
+        estimator : scikit-learn linear predictor (default None)
+            If given, the decision function of the estimator is kept
+            up to date analytically.
+
+        Returns
+        -------
+        incremental_vectorizer : IncrementalVectorizer
+        """
+        return IncrementalVectorizer(self, graph, estimator=estimator)
+
+    def scorer(self, estimator):
+        """Return a LinearScorer that applies a linear estimator to graphs.
+
+        Parameters
+        ----------
+        estimator : scikit-learn linear predictor
+            A fitted estimator with the attributes coef_ and intercept_,
+            trained on the feature vectors of this vectorizer.
+
+        Returns
+        -------
+        linear_scorer : LinearScorer
+        """
+        return LinearScorer(estimator, vectorizer=self)
+
     def _test_goodness(self, graph):
         if graph.number_of_nodes() == 0:
             raise Exception('ERROR: something went wrong, empty graph.')
 
-    def _convert_dict_to_sparse_matrix(self, feature_rows):
-        if len(feature_rows) == 0:
+    def _to_csr(self, features, n_rows):
+        if n_rows == 0:
             raise Exception('ERROR: something went wrong, empty features.')
-        data, row, col = [], [], []
-        for i, feature_row in enumerate(feature_rows):
-            if len(feature_row) == 0:
-                # case of empty feature set for a specific instance
-                row.append(i)
-                col.append(0)
-                data.append(0)
-            else:
-                for feature in feature_row:
-                    row.append(i)
-                    col.append(feature)
-                    data.append(feature_row[feature])
-        shape = (max(row) + 1, self.feature_size)
-        data_matrix = csr_matrix((data, (row, col)),
-                                 shape=shape, dtype=np.float64)
-        return data_matrix
+        return features.to_csr(n_rows, self.feature_size,
+                               inner_normalization=self.inner_normalization,
+                               normalization=self.normalization,
+                               block_weights=self.weights_dict,
+                               collisions=self.collisions,
+                               stats=self.stats)
 
     def _init_weight_preprocessing(self, graph):
         graph.graph['weighted'] = False
@@ -372,141 +767,296 @@ class Vectorizer(AbstractVectorizer):
                 if graph.nodes[u].get(self.key_weight, False) is False:
                     graph.nodes[u][self.key_weight] = 1
 
-    def _graph_preprocessing(self, original_graph):
-        graph = _edge_to_vertex_transform(original_graph)
-        self._weight_preprocessing(graph)
-        _label_preprocessing(graph,
-                             key_label=self.key_label,
-                             bitmask=self.bitmask)
-        self._compute_distant_neighbours(graph, max(self.r, self.d) * 2)
-        self._compute_neighborhood_graph_hash_cache(graph)
-        if graph.graph.get('weighted', False):
-            self._compute_neighborhood_graph_weight_cache(graph)
+    def _graph_preprocessing(self, original_graph, weighted=None):
+        key_vec, key_svec = None, None
+        if not self.discrete:
+            key_vec, key_svec = self.key_vec, self.key_svec
+        stats = self.stats
+        graph = _compact_graph(original_graph,
+                               key_label=self.key_label,
+                               key_weight=self.key_weight,
+                               key_nesting=self.key_nesting,
+                               key_vec=key_vec,
+                               key_svec=key_svec,
+                               bitmask=self.bitmask,
+                               positional=self.positional,
+                               hasher=get_hasher(self.hashing),
+                               weighted=weighted,
+                               stats=stats)
+        stats.count('graphs')
+        stats.count('vertices', graph.n_vertices)
+        if self.neighborhood == 'bfs' or self.positional:
+            max_depth = max(self.r, self.d) * 2
+        elif self.neighborhood == 'wl':
+            # the rings are needed only to find the pairs at distance d,
+            # unless they are needed for the weights of the neighborhoods
+            max_depth = self.d * 2
+            if graph.weighted:
+                max_depth = max(self.r, self.d) * 2
+        else:
+            raise Exception('ERROR: unknown neighborhood mode: %s' %
+                            self.neighborhood)
+        with stats.stage('ring_index'):
+            self._compute_distant_neighbours(graph, max_depth)
+        if self.watchdog is not None:
+            self.watchdog.check(graph.ring_index)
+        if stats.enabled:
+            stats.count('bfs_visited', sum(len(node_set) for _, node_set
+                                           in graph.ring_index))
+        with stats.stage('neighborhood_hashing'):
+            if self.neighborhood == 'wl' and not self.positional:
+                self._compute_neighborhood_graph_hash_wl(graph)
+            else:
+                self._compute_neighborhood_graph_hash_cache(graph)
+        if self.watchdog is not None:
+            self.watchdog.check()
+        if graph.weighted:
+            with stats.stage('weight_preprocessing'):
+                self._compute_neighborhood_graph_weight_cache(graph)
         return graph
 
-    def _transform(self, original_graph):
+    def _transform(self, original_graph, features):
+        # collect all features for all vertices in the current row
+        # of the accumulator, grouped by (radius, distance)
+        if self.watchdog is not None:
+            return self._watched_transform(original_graph, features)
         graph = self._graph_preprocessing(original_graph)
-        # collect all features for all vertices for each label_index
-        feature_list = defaultdict(lambda: defaultdict(float))
-        for v in graph.nodes():
-            # only for vertices of type 'node', i.e. not for the 'edge' type
-            if graph.nodes[v].get('node', False):
-                self._transform_vertex(graph, v, feature_list)
-        _clean_graph(graph)
-        return self._normalization(feature_list)
-
-    def _update_feature_list(self, node_feature_list, feature_list):
-        for radius_dist_key in node_feature_list:
-            for feature in node_feature_list[radius_dist_key]:
-                val = node_feature_list[radius_dist_key][feature]
-                feature_list[radius_dist_key][feature] += val
-
-    def _transform_vertex(self, graph, vertex_v, feature_list):
+        self._transform_roots(graph, graph.roots, features)
+
+    def _watched_transform(self, original_graph, features):
+        # the instance is vectorized with its own stats, to report the
+        # time of each stage; the budgets are checked during preprocessing,
+        # before any feature is emitted
+        watchdog, stats = self.watchdog, self.stats
+        self.stats = PipelineStats()
+        action, reason = None, None
+        watchdog.start()
+        try:
+            try:
+                graph = self._graph_preprocessing(original_graph)
+            except BudgetExceeded as e:
+                action, reason = watchdog.on_budget, str(e)
+                graph = None
+            if graph is not None:
+                self._transform_roots(graph, graph.roots, features)
+            elif action == 'degrade':
+                degraded = copy.copy(self)
+                degraded.r, degraded.d = self.min_r, self.min_d
+                degraded.watchdog = None
+                degraded._transform(original_graph, features)
+        finally:
+            instance_stats, self.stats = self.stats, stats
+            if stats.enabled:
+                stats.merge(instance_stats)
+        watchdog.stop(original_graph, instance_stats, action, reason)
+
+    def _transform_roots(self, graph, roots, features, rows=None):
+        # emit the features rooted in the vertices roots, in the given rows
+        # of the accumulator (default: the current row); the vector labels
+        # are processed one vertex at a time
+        if rows is None:
+            rows = [features.row] * len(roots)
+        with self.stats.stage('pair_emission'):
+            if self.discrete:
+                self._emit_pairs(graph, roots, features, rows)
+                return
+            n_features = len(features) if self.stats.enabled else 0
+            self._compute_vertex_caches(graph)
+            for row, v in zip(rows, roots):
+                features.row = row
+                self._transform_vertex(graph, v, features)
+            if self.stats.enabled:
+                self.stats.count('features_emitted',
+                                 len(features) - n_features)
+
+    def _emit_pairs(self, graph, roots, features, rows):
+        # the features of all the pairs of vertices at a (radius, distance)
+        # are hashed at once
+        root_index = np.asarray(graph.root_index, dtype=np.int64)
+        # the vertices in the rings around w are paired with the root v,
+        # where w is v itself or the second endpoint of a nesting edge of v,
+        # in the order in which they are visited
+        sources = [(v, v, 1, row) for v, row in zip(roots, rows)]
+        if graph.has_nesting:
+            sources = []
+            for v, row in zip(roots, rows):
+                sources.append((v, v, 1, row))
+                sources.extend(
+                    (v, w, connection_weight, row)
+                    for w, connection_weight
+                    in self._find_second_endpoint_of_nesting_edge(graph, v))
+        if not sources:
+            return
+        source_v, source_w, source_cw, source_row = [
+            np.array(column) for column in zip(*sources)]
+        source_cw = source_cw.astype(np.float64)
+        # all the pairs of each (radius, distance) block
+        blocks = []
+        for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
+            if distance >= len(graph.ring_index):
+                break
+            ring_indptr, ring_vertices = graph.ring_index[distance]
+            w_index = root_index[source_w]
+            counts = ring_indptr[w_index + 1] - ring_indptr[w_index]
+            total = counts.sum()
+            offsets = ring_indptr[w_index] - np.cumsum(counts) + counts
+            starts = np.repeat(offsets, counts)
+            vertex_u = ring_vertices[starts + np.arange(total)]
+            source = np.repeat(np.arange(len(source_w)), counts)
+            selected = graph.is_node[vertex_u]
+            source, vertex_u = source[selected], vertex_u[selected]
+            u_index = root_index[vertex_u]
+            v_index = root_index[source_v[source]]
+            for radius in range(self.min_r * 2, (self.r + 1) * 2, 2):
+                # Note: to be compatible with external radius, distance
+                # we need to revert to r/2 and d/2
+                radius_dist_key = (radius / 2, distance / 2)
+                if self.weights_dict is not None and \
+                        self.weights_dict.get(radius_dist_key, 0) == 0:
+                    continue
+                valid = (radius < graph.root_hash_length[v_index]) & \
+                    (radius < graph.root_hash_length[u_index])
+                blocks.append((radius_dist_key, radius, distance,
+                               source[valid], v_index[valid],
+                               u_index[valid]))
+        if not blocks:
+            return
+        sizes = [len(block[3]) for block in blocks]
+        radius = np.repeat([block[1] for block in blocks], sizes)
+        distance = np.repeat([block[2] for block in blocks], sizes)
+        block_id = np.repeat(np.arange(len(blocks)), sizes)
+        source, v_index, u_index = [np.concatenate([block[i]
+                                                    for block in blocks])
+                                    for i in (3, 4, 5)]
+        # feature as a pair of neighborhoods at a radius, distance
+        # canonicalization of pair of neighborhoods
+        v_hash = graph.root_hash[v_index, radius]
+        u_hash = graph.root_hash[u_index, radius]
+        feature = hash_tuples([np.minimum(v_hash, u_hash),
+                               np.maximum(v_hash, u_hash),
+                               radius, distance], self.bitmask)
+        # half features are those that ignore the central vertex v
+        # the reason to have those is to help model the context
+        # independently from the identity of the vertex itself
+        half_feature = hash_tuples([u_hash, radius, distance], self.bitmask)
+        value = source_cw[source]
+        half_value = value
+        if graph.weighted:
+            weight_u = graph.root_weight[u_index, radius]
+            half_value = value * weight_u
+            value = value * (graph.root_weight[v_index, radius] + weight_u)
+            # Note: add a feature only if the value is not 0
+            selected = value != 0
+            feature, half_feature = feature[selected], half_feature[selected]
+            value, half_value = value[selected], half_value[selected]
+            source, block_id = source[selected], block_id[selected]
+        row = source_row[source]
+        # the features of a source are generated by distance, then radius,
+        # as the blocks
+        rank = source * len(blocks) + block_id
+        self.stats.count('features_emitted', 2 * len(feature))
+        features.extend_blocks([block[0] for block in blocks],
+                               np.concatenate((block_id, block_id)),
+                               np.concatenate((feature, half_feature)),
+                               np.concatenate((value, half_value)),
+                               rows=np.concatenate((row, row)),
+                               ranks=np.concatenate((rank, rank)))
+
+    def _transform_vertex(self, graph, vertex_v, features):
         if self.discrete:
-            # for all distances
-            root_dist_dict = graph.nodes[vertex_v]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in root_dist_dict:
-                    node_set = root_dist_dict[distance]
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph, vertex_v, vertex_u,
-                                distance, feature_list)
-            self._transform_vertex_nesting(graph, vertex_v, feature_list)
+            self._transform_vertex_rings(graph, vertex_v, features)
+            self._transform_vertex_nesting(graph, vertex_v, features)
         else:
-            node_feature_list = defaultdict(lambda: defaultdict(float))
-            # for all distances
-            root_dist_dict = graph.nodes[vertex_v]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in root_dist_dict:
-                    node_set = root_dist_dict[distance]
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph,
-                                vertex_v,
-                                vertex_u,
-                                distance,
-                                node_feature_list)
-            self._transform_vertex_nesting(
-                graph,
-                vertex_v,
-                node_feature_list)
-            node_feature_list = self._add_vector_labes(
-                graph,
-                vertex_v,
-                node_feature_list)
-            self._update_feature_list(
-                node_feature_list,
-                feature_list)
-            node_sparse_feature_list = self._add_sparse_vector_labes(
-                graph,
-                vertex_v,
-                node_feature_list)
-            self._update_feature_list(
-                node_sparse_feature_list,
-                feature_list)
-
-    def _add_vector_labes(self, graph, vertex_v, node_feature_list):
+            node_features = FeatureAccumulator()
+            self._transform_vertex_rings(graph, vertex_v, node_features)
+            self._transform_vertex_nesting(graph, vertex_v, node_features)
+            _, blocks, node_feature_ids, node_values = node_features.arrays()
+            for block_id, r_d_key in enumerate(node_features.block_keys):
+                in_block = blocks == block_id
+                feature_ids, values = self._add_vector_labes(
+                    graph,
+                    vertex_v,
+                    node_feature_ids[in_block],
+                    node_values[in_block])
+                features.extend(r_d_key, feature_ids, values)
+                feature_ids, values = self._add_sparse_vector_labes(
+                    graph,
+                    vertex_v,
+                    feature_ids,
+                    values)
+                features.extend(r_d_key, feature_ids, values)
+
+    def _transform_vertex_rings(self, graph, vertex_v, features,
+                                connection_weight=1, vertex_w=None):
+        # pair vertex_v with all vertices at distance d from vertex_w
+        # (vertex_w is vertex_v itself unless we follow a nesting edge)
+        if vertex_w is None:
+            vertex_w = vertex_v
+        root_w = graph.root_index[vertex_w]
+        rings = graph.remote_neighbours
+        is_node = graph.is_node_list
+        # for all distances
+        for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
+            if distance < len(rings):
+                indptr, indices = rings[distance]
+                node_set = indices[indptr[root_w]:indptr[root_w + 1]]
+                for vertex_u in node_set:
+                    if is_node[vertex_u]:
+                        self._transform_vertex_pair(
+                            graph, vertex_v, vertex_u,
+                            distance, features,
+                            connection_weight=connection_weight)
+
+    def _add_vector_labes(self, graph, vertex_v, feature_ids, values):
         # add the vector with an offset given by the feature, multiplied by val
-        vec = graph.nodes[vertex_v].get(self.key_vec, None)
+        vec = graph.vec[vertex_v]
         if vec:
-            vec_feature_list = defaultdict(lambda: defaultdict(float))
-            for radius_dist_key in node_feature_list:
-                for feature in node_feature_list[radius_dist_key]:
-                    val = node_feature_list[radius_dist_key][feature]
-                    for i, vec_val in enumerate(vec):
-                        key = (feature + i) % self.bitmask
-                        vec_feature_list[radius_dist_key][key] += val * vec_val
-            node_feature_list = vec_feature_list
-        return node_feature_list
-
-    def _add_sparse_vector_labes(self, graph, vertex_v, node_feature_list):
+            vec = np.asarray(vec, dtype=np.float64)
+            offsets = np.arange(len(vec))
+            feature_ids = (feature_ids[:, None] + offsets) % self.bitmask
+            values = values[:, None] * vec
+            feature_ids, values = feature_ids.ravel(), values.ravel()
+        return feature_ids, values
+
+    def _add_sparse_vector_labes(self, graph, vertex_v, feature_ids, values):
         # add the vector with a feature resulting from hashing
         # the discrete labeled graph sparse encoding with the sparse vector
         # feature, the val is then multiplied.
-        svec = graph.nodes[vertex_v].get(self.key_svec, None)
+        svec = graph.svec[vertex_v]
         if svec:
-            vec_feature_list = defaultdict(lambda: defaultdict(float))
-            for radius_dist_key in node_feature_list:
-                for feature in node_feature_list[radius_dist_key]:
-                    val = node_feature_list[radius_dist_key][feature]
-                    for i in svec:
-                        vec_val = svec[i]
-                        key = fast_hash_2(feature, i, self.bitmask)
-                        vec_feature_list[radius_dist_key][key] += val * vec_val
-            node_feature_list = vec_feature_list
-        return node_feature_list
-
-    def _transform_vertex_nesting(self, graph, vertex_v, feature_list):
+            svec_ids = list(svec)
+            svec_values = np.array([svec[i] for i in svec_ids],
+                                   dtype=np.float64)
+            feature_ids = np.array(
+                [fast_hash_2(feature, i, self.bitmask)
+                 for feature in feature_ids.tolist() for i in svec_ids],
+                dtype=np.int64)
+            values = (values[:, None] * svec_values).ravel()
+        return feature_ids, values
+
+    def _transform_vertex_nesting(self, graph, vertex_v, features):
         # find all vertices, if any, that are second point of nesting edge
         endpoints = self._find_second_endpoint_of_nesting_edge(graph, vertex_v)
         for endpoint, connection_weight in endpoints:
             # for all vertices at distance d from each such second endpoint
-            endpoint_dist_dict = graph.nodes[endpoint]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in endpoint_dist_dict:
-                    node_set = endpoint_dist_dict[distance]
-                    # for all nodes u at distance distance from endpoint
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph, vertex_v, vertex_u,
-                                distance, feature_list,
-                                connection_weight=connection_weight)
+            self._transform_vertex_rings(graph, vertex_v, features,
+                                         connection_weight=connection_weight,
+                                         vertex_w=endpoint)
 
     def _find_second_endpoint_of_nesting_edge(self, graph, vertex_v):
         endpoints = []
+        if not graph.has_nesting:
+            return endpoints
+        adjacency = graph.adjacency
         # find all neighbors
-        for u in graph.neighbors(vertex_v):
+        for u in adjacency[vertex_v]:
             # test for type
-            if graph.nodes[u].get(self.key_nesting, False):
+            if graph.is_nesting_list[u]:
                 # if type is nesting
                 # find endpoint that is not original vertex_v
-                vertices = [j for j in graph.neighbors(u) if j != vertex_v]
+                vertices = [j for j in adjacency[u] if j != vertex_v]
                 assert(len(vertices) == 1)
-                connection_weight = graph.nodes[u].get(self.key_weight, 1)
+                connection_weight = graph.nesting_weight[u]
                 endpoints.append((vertices[0], connection_weight))
         return endpoints
 
@@ -515,7 +1065,7 @@ class Vectorizer(AbstractVectorizer):
                                vertex_v,
                                vertex_u,
                                distance,
-                               feature_list,
+                               features,
                                connection_weight=1):
         cw = connection_weight
         # for all radii
@@ -530,7 +1080,7 @@ class Vectorizer(AbstractVectorizer):
                                                   vertex_u,
                                                   radius,
                                                   distance,
-                                                  feature_list,
+                                                  features,
                                                   connection_weight=cw)
 
     def _transform_vertex_pair_valid(self,
@@ -539,20 +1089,18 @@ class Vectorizer(AbstractVectorizer):
                                      vertex_u,
                                      radius,
                                      distance,
-                                     feature_list,
+                                     features,
                                      connection_weight=1):
         cw = connection_weight
         # we need to revert to r/2 and d/2
         radius_dist_key = (radius / 2, distance / 2)
         # reweight using external weight dictionary
-        len_v = len(graph.nodes[vertex_v]['neigh_graph_hash'])
-        len_u = len(graph.nodes[vertex_u]['neigh_graph_hash'])
-        if radius < len_v and radius < len_u:
+        vertex_v_labels = graph.neigh_graph_hash[vertex_v]
+        vertex_u_labels = graph.neigh_graph_hash[vertex_u]
+        if radius < len(vertex_v_labels) and radius < len(vertex_u_labels):
             # feature as a pair of neighborhoods at a radius,distance
             # canonicalization of pair of neighborhoods
-            vertex_v_labels = graph.nodes[vertex_v]['neigh_graph_hash']
             vertex_v_hash = vertex_v_labels[radius]
-            vertex_u_labels = graph.nodes[vertex_u]['neigh_graph_hash']
             vertex_u_hash = vertex_u_labels[radius]
             if vertex_v_hash < vertex_u_hash:
                 first_hash, second_hash = (vertex_v_hash, vertex_u_hash)
@@ -565,171 +1113,149 @@ class Vectorizer(AbstractVectorizer):
             # independently from the identity of the vertex itself
             half_feature = fast_hash_3(vertex_u_hash,
                                        radius, distance, self.bitmask)
-            if graph.graph.get('weighted', False) is False:
-                feature_list[radius_dist_key][feature] += cw
-                feature_list[radius_dist_key][half_feature] += cw
+            if not graph.weighted:
+                features.append(radius_dist_key, feature, cw)
+                features.append(radius_dist_key, half_feature, cw)
             else:
-                weight_v = graph.nodes[vertex_v]['neigh_graph_weight']
-                weight_u = graph.nodes[vertex_u]['neigh_graph_weight']
+                weight_v = graph.neigh_graph_weight[vertex_v]
+                weight_u = graph.neigh_graph_weight[vertex_u]
                 weight_vu_radius = weight_v[radius] + weight_u[radius]
                 val = cw * weight_vu_radius
                 # Note: add a feature only if the value is not 0
                 if val != 0:
-                    feature_list[radius_dist_key][feature] += val
+                    features.append(radius_dist_key, feature, val)
                     half_val = cw * weight_u[radius]
-                    feature_list[radius_dist_key][half_feature] += half_val
-
-    def _normalization(self, feature_list):
-        # inner normalization per radius-distance
-        feature_vector = {}
-        for r_d_key in feature_list:
-            features = feature_list[r_d_key]
-            norm = 0
-            for count in features.values():
-                norm += count * count
-            sqrt_norm = math.sqrt(norm)
-            if self.weights_dict is not None:
-                # reweight using external weight dictionary
-                if self.weights_dict.get(r_d_key, None) is not None:
-                    sqrtw = math.sqrt(self.weights_dict[r_d_key])
-                    sqrt_norm = sqrt_norm / sqrtw
-            for feature_id, count in features.items():
-                if self.inner_normalization:
-                    feature_vector_value = float(count) / sqrt_norm
-                else:
-                    feature_vector_value = count
-                feature_vector[feature_id] = feature_vector_value
-        # global normalization
-        if self.normalization:
-            normalized_feature_vector = {}
-            total_norm = 0.0
-            for value in feature_vector.values():
-                total_norm += value * value
-            sqrt_total_norm = math.sqrt(float(total_norm))
-            for feature_id, value in list(feature_vector.items()):
-                feature_vector_value = value / sqrt_total_norm
-                normalized_feature_vector[feature_id] = feature_vector_value
-            return normalized_feature_vector
-        else:
-            return feature_vector
+                    features.append(radius_dist_key, half_feature, half_val)
 
     def _compute_neighborhood_graph_hash_cache(self, graph):
-        assert (len(graph) > 0), 'ERROR: Empty graph'
-        for u in graph.nodes():
-            if graph.nodes[u].get('node', False):
-                self._compute_neighborhood_graph_hash(u, graph)
-
-    def _compute_neighborhood_graph_hash(self, root, graph):
-        # list all hashed labels at increasing distances
-        hash_list = []
-        # for all distances
-        root_dist_dict = graph.nodes[root]['remote_neighbours']
-        for node_set in root_dist_dict.keys():
-            # create a list of hashed labels
-            hash_label_list = []
-            for v in root_dist_dict[node_set]:
-                # compute the vertex hashed label by hashing the hlabel
-                # field
-                # with the degree of the vertex (obtained as the size of
-                # the adjacency dictionary for the vertex v)
-                # or, in case positional is set, using the relative
-                # position of the vertex v w.r.t. the root vertex
-                if self.positional:
-                    vhlabel = fast_hash_2(
-                        graph.nodes[v]['hlabel'], root - v)
-                else:
-                    vhlabel = fast_hash_2(
-                        graph.nodes[v]['hlabel'], len(graph[v]))
-                hash_label_list.append(vhlabel)
-            # sort it
-            hash_label_list.sort()
-            # hash it
-            hashed_nodes_at_distance_d_in_neighborhood = fast_hash(
-                hash_label_list)
-            hash_list.append(hashed_nodes_at_distance_d_in_neighborhood)
+        assert (graph.n_vertices > 0), 'ERROR: Empty graph'
+        n_roots = len(graph.roots)
+        roots = np.array(graph.roots, dtype=np.int64)
+        if not self.positional:
+            # the hashed label of a vertex combines the hlabel field with
+            # the degree of the vertex, it does not depend on the root and
+            # it is computed only once
+            degree = np.diff(graph.indptr)
+            vertex_hlabel = hash_tuples([graph.hlabel, degree])
+        # gather the node sets of all roots at all distances, the row of
+        # the root at distance k is k * n_roots + root
+        n_dist = len(graph.ring_index)
+        offsets = np.cumsum([0] + [len(node_set) for _, node_set
+                                   in graph.ring_index])
+        indptr = np.concatenate([[0]] + [ring_indptr[1:] + offset
+                                         for (ring_indptr, _), offset
+                                         in zip(graph.ring_index, offsets)])
+        node_set = np.concatenate([node_set for _, node_set
+                                   in graph.ring_index])
+        sizes = np.diff(indptr)
+        row = np.repeat(np.arange(n_dist * n_roots), sizes)
+        if self.positional:
+            # hash the hlabel field together with the relative position
+            # of the vertex w.r.t. the root vertex
+            ids = graph.ids
+            delta = ids[roots[row % n_roots]] - ids[node_set]
+            labels = hash_tuples([graph.hlabel[node_set], delta])
+        else:
+            labels = vertex_hlabel[node_set]
+        # hash the sorted hashed labels of each node set
+        labels = labels[np.lexsort((labels, row))]
+        ring_hashes = hash_rows(labels, indptr).reshape(n_dist, n_roots)
+        # the rings of a root are empty after the first empty one
+        n_rings = np.count_nonzero(sizes.reshape(n_dist, n_roots), axis=0)
         # hash the sequence of hashes of the node set at increasing
         # distances into a list of features
-        hash_neighborhood = fast_hash_vec(hash_list)
-        graph.nodes[root]['neigh_graph_hash'] = hash_neighborhood
+        graph.root_hash = hash_prefixes(ring_hashes.T, n_rings)
+        graph.root_hash_length = n_rings
+
+    def _compute_neighborhood_graph_hash_wl(self, graph):
+        assert (graph.n_vertices > 0), 'ERROR: Empty graph'
+        n_vertices = graph.n_vertices
+        roots = np.array(graph.roots, dtype=np.int64)
+        degree = np.diff(graph.indptr)
+        # the hash at radius 0 is the hashed label of the vertex combined
+        # with its degree, as in the breadth first search mode
+        labels = hash_tuples([graph.hlabel, degree])
+        # the neighbors of each vertex, excluding the nesting vertices
+        rows = np.repeat(np.arange(n_vertices), degree)
+        neighbors = graph.indices
+        selected = ~graph.is_nesting[neighbors]
+        rows, neighbors = rows[selected], neighbors[selected]
+        indptr = np.zeros(n_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_vertices), out=indptr[1:])
+        n_radii = self.r * 2 + 1
+        neigh_hash = np.zeros((len(roots), n_radii), dtype=np.int64)
+        neigh_hash[:, 0] = labels[roots]
+        for radius in range(1, n_radii):
+            # the hash at radius k + 1 combines the hash at radius k with
+            # the sorted hashes at radius k of the neighbors
+            values = labels[neighbors]
+            values = values[np.lexsort((values, rows))]
+            labels = hash_tuples([labels, hash_rows(values, indptr)])
+            neigh_hash[:, radius] = labels[roots]
+        graph.root_hash = neigh_hash
+        graph.root_hash_length = np.full(len(roots), n_radii)
 
     def _compute_neighborhood_graph_weight_cache(self, graph):
-        assert (len(graph) > 0), 'ERROR: Empty graph'
-        for u in graph.nodes():
-            if graph.nodes[u].get('node', False):
-                self._compute_neighborhood_graph_weight(u, graph)
-
-    def _compute_neighborhood_graph_weight(self, root, graph):
-        # list all nodes at increasing distances
-        # at each distance
+        # for all roots and all distances
         # compute the arithmetic mean weight on nodes
         # compute the geometric mean weight on edges
         # compute the product of the two
-        # make a list of the neighborhood_graph_weight at every distance
-        neighborhood_graph_weight_list = []
-        w = graph.nodes[root][self.key_weight]
-        node_weight_list = np.array([w], dtype=np.float64)
-        node_average = node_weight_list[0]
-        edge_weight_list = np.array([1], dtype=np.float64)
-        edge_average = edge_weight_list[0]
-        # for all distances
-        root_dist_dict = graph.nodes[root]['remote_neighbours']
-        for dist in root_dist_dict.keys():
-            # extract array of weights at given dist
-            weight_array_at_d = np.array([graph.nodes[v][self.key_weight]
-                                          for v in root_dist_dict[dist]],
-                                         dtype=np.float64)
-            if dist % 2 == 0:  # nodes
-                node_weight_list = np.concatenate(
-                    (node_weight_list, weight_array_at_d))
-                node_average = np.mean(node_weight_list)
-            else:  # edges
-                edge_weight_list = np.concatenate(
-                    (edge_weight_list, weight_array_at_d))
-                edge_average = stats.gmean(edge_weight_list)
-            weight = node_average * edge_average
-            neighborhood_graph_weight_list.append(weight)
-        graph.nodes[root]['neigh_graph_weight'] = \
-            neighborhood_graph_weight_list
-
-    def _single_vertex_breadth_first_visit(self, graph, root, max_depth):
-        # the map associates to each distance value ( from 1:max_depth )
-        # the list of ids of the vertices at that distance from the root
-        dist_list = {}
-        visited = set()  # use a set as we can end up exploring few nodes
-        # q is the queue containing the frontier to be expanded in the BFV
-        q = deque()
-        q.append(root)
-        # the map associates to each vertex id the distance from the root
-        dist = {}
-        dist[root] = 0
-        visited.add(root)
-        # add vertex at distance 0
-        dist_list[0] = set()
-        dist_list[0].add(root)
-        while len(q) > 0:
-            # extract the current vertex
-            u = q.popleft()
-            d = dist[u] + 1
-            if d <= max_depth:
-                # iterate over the neighbors of the current vertex
-                for v in graph.neighbors(u):
-                    if v not in visited:
-                        # skip nesting edge-nodes
-                        if not graph.nodes[v].get(self.key_nesting, False):
-                            dist[v] = d
-                            visited.add(v)
-                            q.append(v)
-                            if d in dist_list:
-                                dist_list[d].add(v)
-                            else:
-                                dist_list[d] = set()
-                                dist_list[d].add(v)
-        graph.nodes[root]['remote_neighbours'] = dist_list
+        # Note: the means are computed incrementally from the running sums
+        # of the weights (of the log weights for the geometric mean)
+        assert (graph.n_vertices > 0), 'ERROR: Empty graph'
+        n_roots = len(graph.roots)
+        weight = graph.weight
+        node_weight_sum = weight[graph.roots].copy()
+        node_count = np.ones(n_roots)
+        node_average = node_weight_sum.copy()
+        edge_log_weight_sum = np.zeros(n_roots)
+        edge_count = np.ones(n_roots)
+        edge_average = np.ones(n_roots)
+        # Note: the weights beyond the last ring are those of the last ring
+        # (the neighborhood hashes of the 'wl' mode extend up to radius r)
+        n_radii = max(len(graph.ring_index), self.r * 2 + 1)
+        neigh_graph_weight = np.zeros((n_roots, n_radii))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for dist, (ring_indptr, node_set) in enumerate(graph.ring_index):
+                sizes = np.diff(ring_indptr)
+                row = np.repeat(np.arange(n_roots), sizes)
+                # extract array of weights at given dist
+                weight_at_d = weight[node_set]
+                if dist % 2 == 0:  # nodes
+                    node_weight_sum += np.bincount(
+                        row, weights=weight_at_d, minlength=n_roots)
+                    node_count += sizes
+                    node_average = node_weight_sum / node_count
+                else:  # edges
+                    edge_log_weight_sum += np.bincount(
+                        row, weights=np.log(weight_at_d), minlength=n_roots)
+                    edge_count += sizes
+                    edge_average = np.exp(edge_log_weight_sum / edge_count)
+                neigh_graph_weight[:, dist:] = \
+                    (node_average * edge_average)[:, None]
+        graph.root_weight = neigh_graph_weight
 
     def _compute_distant_neighbours(self, graph, max_depth):
-        for n in graph.nodes():
-            if graph.nodes[n].get('node', False):
-                self._single_vertex_breadth_first_visit(graph, n, max_depth)
+        graph.ring_index = _ring_index(graph, max_depth)
+
+    def _compute_vertex_caches(self, graph):
+        # python lists of the rings and of the hashes and weights of the
+        # neighborhoods, for the stages that visit one vertex at a time
+        if getattr(graph, 'remote_neighbours', None) is not None:
+            return
+        graph.remote_neighbours = [(ring_indptr.tolist(), node_set.tolist())
+                                   for ring_indptr, node_set
+                                   in graph.ring_index]
+        graph.neigh_graph_hash = [None] * graph.n_vertices
+        for root, hash_list, length in zip(graph.roots,
+                                           graph.root_hash.tolist(),
+                                           graph.root_hash_length.tolist()):
+            graph.neigh_graph_hash[root] = hash_list[:length]
+        if graph.weighted:
+            graph.neigh_graph_weight = [None] * graph.n_vertices
+            for root, weight_list in zip(graph.roots,
+                                         graph.root_weight.tolist()):
+                graph.neigh_graph_weight[root] = weight_list
 
     def annotate(self,
                  graphs,
@@ -737,7 +1263,8 @@ class Vectorizer(AbstractVectorizer):
                  reweight=1.0,
                  threshold=None,
                  scale=1,
-                 vertex_features=False):
+                 vertex_features=False,
+                 block_size=None):
         """Return graphs with extra attributes: importance and features.
 
         Given a list of networkx graphs, if the given estimator is not None and
@@ -778,6 +1305,12 @@ class Vectorizer(AbstractVectorizer):
             created for each node that contains a CRS scipy sparse vector,
             and an attribute with key 'vector' is created that contains a
             python dictionary to store the key, values pairs.
+
+        block_size : int (default None)
+            The number of graphs that are annotated together: the vertex
+            feature vectors of all the graphs in a block are stacked in a
+            single matrix, so that the estimator is called once per block.
+            If None, the block_size of the vectorizer is used.
         """
         self.estimator = estimator
         self.reweight = reweight
@@ -785,24 +1318,56 @@ class Vectorizer(AbstractVectorizer):
         self.scale = scale
         self.vertex_features = vertex_features
 
-        for graph in graphs:
-            annotated_graph = self._annotate(graph)
-            yield annotated_graph
+        if block_size is None:
+            block_size = self.block_size
+        for block in partition_all(block_size, graphs):
+            for annotated_graph in self._annotate_block(block):
+                yield annotated_graph
 
     def _annotate(self, original_graph):
+        return self._annotate_block([original_graph])[0]
+
+    def _annotate_block(self, original_graphs):
         # pre-processing phase: compute caches
-        graph_dict = original_graph.graph
-        graph = self._graph_preprocessing(original_graph)
-        # extract per vertex feature representation
-        data_matrix = self._compute_vertex_based_features(graph)
-        # add or update weight and importance information
-        graph = self._annotate_importance(graph, data_matrix)
-        # add or update label information
-        if self.vertex_features:
-            graph = self._annotate_vector(graph, data_matrix)
-        annotated_graph = _revert_edge_to_vertex_transform(graph)
-        annotated_graph.graph = graph_dict
-        return annotated_graph
+        graph_dicts, graphs = [], []
+        features = FeatureAccumulator()
+        offsets = [0]
+        for original_graph in original_graphs:
+            graph_dicts.append(original_graph.graph)
+            graph = _edge_to_vertex_transform(original_graph)
+            self._weight_preprocessing(graph)
+            # extract per vertex feature representation, one row per vertex
+            # of type 'node' in the rows of the graph in the stacked matrix
+            compact_graph = self._graph_preprocessing(graph)
+            n_roots = len(compact_graph.roots)
+            self._transform_roots(compact_graph, compact_graph.roots,
+                                  features,
+                                  rows=range(offsets[-1],
+                                             offsets[-1] + n_roots))
+            graphs.append(graph)
+            offsets.append(offsets[-1] + n_roots)
+        data_matrix = self._to_csr(features, offsets[-1])
+        # a single call to the estimator for all the vertices of the block
+        graph_sizes = np.repeat([len(graph) for graph in graphs],
+                                np.diff(offsets))
+        predictions, margins = self._compute_predictions_and_margins(
+            graph_sizes, data_matrix)
+        if self.threshold is not None:
+            margins[margins < self.threshold] = self.threshold
+        annotated_graphs = []
+        for i, graph in enumerate(graphs):
+            start, stop = offsets[i], offsets[i + 1]
+            # add or update weight and importance information
+            graph = self._annotate_importance(graph,
+                                              predictions[start:stop],
+                                              margins[start:stop])
+            # add or update label information
+            if self.vertex_features:
+                graph = self._annotate_vector(graph, data_matrix[start:stop])
+            annotated_graph = _revert_edge_to_vertex_transform(graph)
+            annotated_graph.graph = graph_dicts[i]
+            annotated_graphs.append(annotated_graph)
+        return annotated_graphs
 
     def _annotate_vector(self, graph, data_matrix):
         # annotate graph structure with vertex importance
@@ -818,57 +1383,50 @@ class Vectorizer(AbstractVectorizer):
                 vertex_id += 1
         return graph
 
-    def _compute_predictions_and_margins(self, graph, data_matrix):
-        def _null_estimator_case(graph, data_matrix):
+    def _compute_predictions_and_margins(self, graph_sizes, data_matrix):
+        # graph_sizes[i] is the number of vertices of the (expanded) graph
+        # of the vertex in the i-th row of data_matrix
+        def _null_estimator_case(graph_sizes, data_matrix):
             # if we do not provide an estimator then consider default margin of
             # 1/float(len(graph)) for all vertices
-            n = len(graph)
             m = data_matrix.shape[0]
-            importances = np.array([1 / n] * m, dtype=np.float64)
+            importances = 1 / np.asarray(graph_sizes, dtype=np.float64)
             predictions = np.array([1] * m)
             return predictions, importances
 
-        def _binary_classifier_case(graph, data_matrix):
+        def _binary_classifier_case(graph_sizes, data_matrix):
             predictions = self.estimator.predict(data_matrix)
             importances = self.estimator.decision_function(data_matrix)
             return predictions, importances
 
-        def _regression_case(graph, data_matrix):
+        def _regression_case(graph_sizes, data_matrix):
             predicted_score = self.estimator.predict(data_matrix)
-            p = [1 if v >= 0 else -1 for v in predicted_score]
-            predictions = np.array(p)
+            predictions = np.where(predicted_score >= 0, 1, -1)
             return predictions, predicted_score
 
-        def _multiclass_case(graph, data_matrix):
+        def _multiclass_case(graph_sizes, data_matrix):
             # when prediction is multiclass, use as importance the max
             # prediction
-            n = len(graph)
             predictions = self.estimator.predict(data_matrix)
             predicted_score = self.estimator.decision_function(data_matrix)
             ids = np.argmax(predicted_score, axis=1)
-            s = [row[col] for row, col in zip(predicted_score, ids)]
-            scores = np.array(s)
-            b = [self.estimator.intercept_[id] for id in ids]
-            intercepts = np.array(b)
-            importances = scores - intercepts + intercepts / n
+            scores = predicted_score[np.arange(len(ids)), ids]
+            intercepts = np.asarray(self.estimator.intercept_)[ids]
+            importances = scores - intercepts + intercepts / graph_sizes
             return predictions, importances
 
         if self.estimator is None:
-            return _null_estimator_case(graph, data_matrix)
+            return _null_estimator_case(graph_sizes, data_matrix)
         if self.estimator.__class__.__name__ in ['SGDRegressor']:
-            return _regression_case(graph, data_matrix)
+            return _regression_case(graph_sizes, data_matrix)
         else:
             data_dim = self.estimator.intercept_.shape[0]
             if data_dim > 1:
-                return _multiclass_case(graph, data_matrix)
+                return _multiclass_case(graph_sizes, data_matrix)
             else:
-                return _binary_classifier_case(graph, data_matrix)
+                return _binary_classifier_case(graph_sizes, data_matrix)
 
-    def _annotate_importance(self, graph, data_matrix):
-        predictions, margins = self._compute_predictions_and_margins(
-            graph, data_matrix)
-        if self.threshold is not None:
-            margins[margins < self.threshold] = self.threshold
+    def _annotate_importance(self, graph, predictions, margins):
         # annotate graph structure with vertex importance
         vertex_id = 0
         for v in graph.nodes():
@@ -897,25 +1455,885 @@ class Vectorizer(AbstractVectorizer):
         return graph
 
     def _compute_vertex_based_features(self, graph):
-        feature_rows = []
-        for v in graph.nodes():
-            # only for vertices of type 'node', i.e. not for the 'edge' type
-            if graph.nodes[v].get('node', False):
-                feature_list = defaultdict(lambda: defaultdict(float))
-                self._transform_vertex(graph, v, feature_list)
-                feature_rows.append(self._normalization(feature_list))
-        data_matrix = self._convert_dict_to_sparse_matrix(feature_rows)
-        return data_matrix
+        # one row per vertex of type 'node', i.e. not for the 'edge' type
+        features = FeatureAccumulator()
+        self._transform_roots(graph, graph.roots, features,
+                              rows=range(len(graph.roots)))
+        return self._to_csr(features, len(graph.roots))
+
+
+class IncrementalVectorizer(object):
+    """Keep the feature vector of a graph up to date under local edits.
+
+    The feature vector of a graph is the normalized sum of the features
+    rooted in each node. The raw contribution of each root is stored, so
+    that after an edit only the roots within distance r + d of the edited
+    nodes are recomputed, on the subgraph that surrounds them: the cost
+    of an update depends on the size of the edit and not on the size of
+    the graph.
+
+    If an estimator is given, its decision function is updated without
+    assembling the feature vector: for each (radius, distance) block the
+    dot product with the coefficients and the cross products with the
+    other blocks are kept, which is all that is needed to apply the inner
+    and global normalization to the score. A feature id generated by
+    several blocks takes the value of the last block (see the collisions
+    option of Vectorizer): the blocks are ordered as the vectorizer
+    generates them, and the squared norm and the dot product of the
+    features whose last block is each block are kept as well.
+
+    Graphs that are subject to the positional option or that have already
+    been subject to the edge to vertex transformation are recomputed from
+    scratch at each update.
+
+    >>> import networkx as nx
+    >>> graph = nx.path_graph(30)
+    >>> for u in graph.nodes():
+    ...     graph.nodes[u]['label'] = 'C'
+    >>> for u, v in graph.edges():
+    ...     graph.edges[u, v]['label'] = '-'
+    >>> vectorizer = Vectorizer(complexity=2)
+    >>> incremental_vectorizer = vectorizer.incremental(graph)
+    >>> graph.nodes[15]['label'] = 'N'
+    >>> graph.add_edge(15, 30, label='=')
+    >>> graph.nodes[30]['label'] = 'O'
+    >>> x = incremental_vectorizer.update(graph, [15, 30])
+    >>> bool(abs(x - vectorizer.transform([graph])).max() < 1e-9)
+    True
+
+    The number of (radius, distance) blocks is not limited:
+
+    >>> vectorizer = Vectorizer(complexity=8)
+    >>> incremental_vectorizer = vectorizer.incremental(graph)
+    >>> graph.nodes[5]['label'] = 'S'
+    >>> x = incremental_vectorizer.update(graph, [5])
+    >>> bool(abs(x - vectorizer.transform([graph])).max() < 1e-9)
+    True
+
+    A graph can lose all its features and grow back:
+
+    >>> graph = nx.path_graph(2)
+    >>> for u in graph.nodes():
+    ...     graph.nodes[u]['label'] = 'A'
+    >>> graph.edges[0, 1]['label'] = '-'
+    >>> vectorizer = Vectorizer(r=2, d=3, min_r=1)
+    >>> incremental_vectorizer = vectorizer.incremental(graph)
+    >>> graph.remove_node(1)
+    >>> x = incremental_vectorizer.update(graph, [1])
+    >>> x.nnz
+    0
+    >>> graph.add_edge(0, 1, label='-')
+    >>> graph.nodes[1]['label'] = 'A'
+    >>> x = incremental_vectorizer.update(graph, [0, 1])
+    >>> bool(abs(x - vectorizer.transform([graph])).max() < 1e-9)
+    True
+    """
+
+    def __init__(self, vectorizer, graph, estimator=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        vectorizer : Vectorizer
+            The vectorizer that defines the features.
+
+        graph : networkx graph
+            The graph to vectorize.
+
+        estimator : scikit-learn linear predictor (default None)
+            A binary classifier or a regressor with the attributes coef_
+            and intercept_.
+        """
+        self.vectorizer = vectorizer
+        v = vectorizer
+        self.block_keys = [(radius / 2, distance / 2)
+                           for distance in range(v.min_d * 2, (v.d + 1) * 2, 2)
+                           for radius in range(v.min_r * 2, (v.r + 1) * 2, 2)]
+        self._block_ids = dict((key, i)
+                               for i, key in enumerate(self.block_keys))
+        self._sqrtw = np.ones(len(self.block_keys))
+        if v.weights_dict is not None:
+            for i, key in enumerate(self.block_keys):
+                if v.weights_dict.get(key, None) is not None:
+                    self._sqrtw[i] = np.sqrt(v.weights_dict[key])
+        self.coef, self.intercept = None, 0.0
+        if estimator is not None:
+            coef = np.asarray(estimator.coef_, dtype=np.float64)
+            if coef.ndim == 2:
+                if coef.shape[0] != 1:
+                    raise Exception('ERROR: only binary classifiers and \
+                        regressors are supported.')
+                coef = coef[0]
+            self.coef = coef
+            self.intercept = float(np.ravel(estimator.intercept_)[0])
+        self._rebuild(graph)
+
+    def update(self, graph, nodes):
+        """Update the features after an edit of the graph.
+
+        Parameters
+        ----------
+        graph : networkx graph
+            The edited graph (it can be the same object, edited in place).
+
+        nodes : iterable of nodes
+            The nodes that were added, removed or whose attributes were
+            changed, and the endpoints of the edges that were added,
+            removed or whose attributes were changed.
+
+        Returns
+        -------
+        data_matrix : csr_matrix, shape = [1, n_features]
+            The feature vector of the edited graph.
+        """
+        self._update(graph, nodes)
+        return self.transform()
+
+    def update_score(self, graph, nodes):
+        """Update the features after an edit and return the score delta.
+
+        The parameters are the same as in update. The difference of the
+        decision function of the estimator after and before the edit is
+        returned.
+        """
+        score = self.decision_function()
+        self._update(graph, nodes)
+        return self.decision_function() - score
+
+    def transform(self):
+        """Return the feature vector of the current graph."""
+        v = self.vectorizer
+        scale = self._block_scale()
+        feature_ids, blocks, values = self._sorted_entries()
+        values = values * scale[blocks]
+        starts = _segment_starts(feature_ids)
+        if v.collisions == 'sum':
+            if len(starts):
+                values = np.add.reduceat(values, starts)
+        else:
+            values = values[_segment_ends(starts, len(values))]
+        feature_ids = feature_ids[starts]
+        if v.normalization and len(values):
+            values /= np.sqrt(values.dot(values))
+        indptr = np.array([0, len(values)])
+        return csr_matrix((values, feature_ids, indptr),
+                          shape=(1, v.feature_size))
+
+    def decision_function(self):
+        """Return the decision function of the estimator on the graph."""
+        if self.coef is None:
+            raise Exception('ERROR: no estimator was given.')
+        scale = self._block_scale()
+        if self.vectorizer.collisions == 'sum':
+            score = np.dot(self._dot, scale)
+            squared_norm = scale.dot(self._gram).dot(scale)
+        else:
+            score = np.dot(self._last_dot, scale)
+            squared_norm = (scale * scale).dot(self._last_squares)
+        if self.vectorizer.normalization:
+            total_norm = np.sqrt(max(squared_norm, 0))
+            if total_norm > 0:
+                score /= total_norm
+        return score + self.intercept
+
+    def _block_scale(self):
+        # the factor applied to each block by the inner normalization
+        norms = np.sqrt(np.maximum(np.diag(self._gram), 0))
+        scale = np.zeros(len(self.block_keys))
+        present = norms > 0
+        if self.vectorizer.inner_normalization:
+            scale[present] = self._sqrtw[present] / norms[present]
+        else:
+            scale[present] = 1
+        return scale
+
+    def _sorted_entries(self):
+        # the arrays of features, blocks and values of the entries, sorted
+        # by feature and then in the order of the blocks
+        n_blocks = len(self.block_keys)
+        keys = np.fromiter(self._entries.keys(), dtype=np.int64,
+                           count=len(self._entries))
+        values = np.fromiter(self._entries.values(), dtype=np.float64,
+                             count=len(self._entries))
+        feature_ids, blocks = keys // n_blocks, keys % n_blocks
+        order = _sort_order(feature_ids, self._block_rank[blocks])
+        return feature_ids[order], blocks[order], values[order]
+
+    def _order_blocks(self, graph):
+        # rank the blocks in the order in which the vectorizer generates
+        # them: the blocks of the first root, in order, then the new
+        # blocks of the next root and so on
+        n_blocks = len(self.block_keys)
+        n_present = np.count_nonzero(self._block_counts)
+        seen = np.zeros(n_blocks, dtype=bool)
+        ordered = []
+        for u in graph.nodes():
+            if len(ordered) == n_present:
+                break
+            contribution = self._contributions.get(u, None)
+            if contribution is None:
+                continue
+            blocks = contribution[0]
+            for block in blocks[_segment_starts(blocks)].tolist():
+                if not seen[block]:
+                    seen[block] = True
+                    ordered.append(block)
+        ordered += np.flatnonzero(~seen).tolist()
+        block_rank = np.empty(n_blocks, dtype=np.int64)
+        block_rank[ordered] = np.arange(n_blocks)
+        if (block_rank != self._block_rank).any():
+            # the last block of the features changed
+            self._block_rank = block_rank
+            feature_ids, blocks, values = self._sorted_entries()
+            last = _segment_ends(_segment_starts(feature_ids), len(values))
+            feature_ids, blocks = feature_ids[last], blocks[last]
+            values = values[last]
+            # without entries bincount returns ints: the sums are floats
+            self._last_squares = np.bincount(
+                blocks, weights=values * values,
+                minlength=n_blocks).astype(np.float64)
+            if self.coef is not None:
+                self._last_dot = np.bincount(
+                    blocks, weights=self.coef[feature_ids] * values,
+                    minlength=n_blocks).astype(np.float64)
+
+    def _last_values(self, table, counts):
+        # the last block of each row of a (feature, block) table that has
+        # entries, and its value
+        ranked = np.where(counts > 0, self._block_rank + 1, 0)
+        last = np.argmax(ranked, axis=1)
+        return last, table[np.arange(len(table)), last]
+
+    def _rebuild(self, graph):
+        v = self.vectorizer
+        self._incremental = not v.positional and \
+            'expanded' not in graph.graph
+        self._adjacency = dict((u, set(graph.adj[u])) for u in graph.nodes())
+        self._weighted_items = set()
+        self._has_nesting = False
+        for u, attr in graph.nodes(data=True):
+            if attr.get(v.key_weight, False):
+                self._weighted_items.add((u,))
+        for u, w, attr in graph.edges(data=True):
+            if attr.get(v.key_weight, False):
+                self._weighted_items.add(frozenset((u, w)))
+            if attr.get(v.key_nesting, False):
+                self._has_nesting = True
+        n_blocks = len(self.block_keys)
+        # raw value and number of entries of each (feature, block),
+        # indexed by feature * n_blocks + block, and array of the blocks
+        # of each feature
+        self._entries = {}
+        self._entry_counts = {}
+        self._feature_blocks = {}
+        self._gram = np.zeros((n_blocks, n_blocks))
+        self._dot = np.zeros(n_blocks)
+        # the rank of each block, the number of entries of each block in
+        # the contributions and, for each block, the squared norm and the
+        # dot product of the features whose last block it is
+        self._block_rank = np.arange(n_blocks)
+        self._block_counts = np.zeros(n_blocks, dtype=np.int64)
+        self._last_squares = np.zeros(n_blocks)
+        self._last_dot = np.zeros(n_blocks)
+        self._contributions = self._compute_contributions(graph,
+                                                          graph.nodes())
+        self._apply(self._contributions.values(), 1)
+        self._order_blocks(graph)
+
+    def _update(self, graph, nodes):
+        nodes = set(nodes)
+        v = self.vectorizer
+        # roots within distance r + d of the edit, before and after it
+        depth = v.r + v.d + (1 if self._has_nesting else 0)
+        affected = _ball(self._adjacency,
+                         [u for u in nodes if u in self._adjacency], depth)
+        # the removal of a node changes the degree of its neighbors
+        affected |= _ball(self._adjacency,
+                          [u for u in nodes
+                           if u in self._adjacency and u not in graph],
+                          depth + 1)
+        weighted = bool(self._weighted_items)
+        self._update_items(graph, nodes)
+        if not self._incremental or \
+                weighted != bool(self._weighted_items):
+            self._rebuild(graph)
+            return
+        depth = v.r + v.d + (1 if self._has_nesting else 0)
+        affected |= _ball(graph.adj, [u for u in nodes if u in graph], depth)
+        old = [self._contributions.pop(u) for u in affected
+               if u in self._contributions]
+        self._apply(old, -1)
+        roots = [u for u in affected if u in graph]
+        if roots:
+            # the labels and degrees of the vertices within distance
+            # r + d + 1 determine the features of the roots
+            subgraph = graph.subgraph(_ball(graph.adj, roots, depth + 1))
+            new = self._compute_contributions(subgraph, roots)
+            self._contributions.update(new)
+            self._apply(new.values(), 1)
+        self._order_blocks(graph)
+
+    def _update_items(self, graph, nodes):
+        # keep the adjacency and the set of weighted nodes and edges in sync
+        v = self.vectorizer
+        for u in nodes:
+            for w in self._adjacency.pop(u, ()):
+                if w in self._adjacency:
+                    self._adjacency[w].discard(u)
+                self._weighted_items.discard(frozenset((u, w)))
+            self._weighted_items.discard((u,))
+        for u in nodes:
+            if u not in graph:
+                continue
+            neighbors = set(graph.adj[u])
+            self._adjacency[u] = neighbors
+            if graph.nodes[u].get(v.key_weight, False):
+                self._weighted_items.add((u,))
+            for w in neighbors:
+                self._adjacency.setdefault(w, set()).add(u)
+                attr = graph.edges[u, w]
+                if attr.get(v.key_weight, False):
+                    self._weighted_items.add(frozenset((u, w)))
+                if attr.get(v.key_nesting, False):
+                    self._has_nesting = True
+
+    def _compute_contributions(self, graph, nodes):
+        # raw features rooted in each node, as arrays of (block, feature,
+        # value) in the order of the blocks, indexed by node
+        nodes = list(nodes)
+        if len(nodes) == 0:
+            return {}
+        v = self.vectorizer
+        compact = v._graph_preprocessing(
+            graph, weighted=bool(self._weighted_items))
+        index = dict((u, i) for i, u in enumerate(graph.nodes()))
+        nodes = [u for u in nodes if compact.root_index[index[u]] >= 0]
+        features = FeatureAccumulator()
+        v._transform_roots(compact, [index[u] for u in nodes], features,
+                           rows=range(len(nodes)))
+        feature_blocks = features.feature_blocks(len(nodes))
+        block_ids = np.array([self._block_ids[key]
+                              for key in feature_blocks.block_keys] + [0])
+        blocks = block_ids[feature_blocks.blocks]
+        feature_ids, values = feature_blocks.features, feature_blocks.values
+        bounds = np.searchsorted(feature_blocks.rows,
+                                 np.arange(len(nodes) + 1))
+        contributions = {}
+        for row, u in enumerate(nodes):
+            selected = slice(bounds[row], bounds[row + 1])
+            contributions[u] = (blocks[selected], feature_ids[selected],
+                                values[selected])
+        return contributions
+
+    def _apply(self, contributions, sign):
+        # add (sign=1) or remove (sign=-1) contributions from the totals
+        contributions = list(contributions)
+        if not contributions:
+            return
+        n_blocks = len(self.block_keys)
+        blocks, feature_ids, values = [np.concatenate(arrays) for arrays
+                                       in zip(*contributions)]
+        if len(values) == 0:
+            return
+        self._block_counts += sign * np.bincount(blocks, minlength=n_blocks)
+        keys, inverse = np.unique(feature_ids * n_blocks + blocks,
+                                  return_inverse=True)
+        deltas = sign * np.bincount(inverse.ravel(), weights=values,
+                                    minlength=len(keys))
+        count_deltas = sign * np.bincount(inverse.ravel(),
+                                          minlength=len(keys))
+        changed, rows = np.unique(keys // n_blocks, return_inverse=True)
+        # dense (feature, block) tables of the values and of the numbers of
+        # entries of the changed features before and after the update
+        old = np.zeros((len(changed), n_blocks))
+        old_counts = np.zeros((len(changed), n_blocks), dtype=np.int64)
+        old_blocks = [self._feature_blocks.get(feature, _NO_BLOCKS)
+                      for feature in changed.tolist()]
+        old_rows = np.repeat(np.arange(len(changed)),
+                             [len(blocks) for blocks in old_blocks])
+        old_blocks = np.concatenate(old_blocks)
+        old_keys = changed[old_rows] * n_blocks + old_blocks
+        old[old_rows, old_blocks] = [self._entries[key]
+                                     for key in old_keys.tolist()]
+        old_counts[old_rows, old_blocks] = [self._entry_counts[key]
+                                            for key in old_keys.tolist()]
+        new, new_counts = old.copy(), old_counts.copy()
+        new[rows.ravel(), keys % n_blocks] += deltas
+        new_counts[rows.ravel(), keys % n_blocks] += count_deltas
+        # without entries the value is 0, without rounding errors
+        new[new_counts == 0] = 0
+        # write back the changed features
+        new_rows, new_blocks = np.nonzero(new_counts)
+        for key in old_keys.tolist():
+            del self._entries[key]
+            del self._entry_counts[key]
+        new_keys = (changed[new_rows] * n_blocks + new_blocks).tolist()
+        self._entries.update(zip(new_keys,
+                                 new[new_rows, new_blocks].tolist()))
+        self._entry_counts.update(zip(
+            new_keys, new_counts[new_rows, new_blocks].tolist()))
+        bounds = np.searchsorted(new_rows, np.arange(len(changed) + 1))
+        for row, feature in enumerate(changed.tolist()):
+            if bounds[row] < bounds[row + 1]:
+                self._feature_blocks[feature] = \
+                    new_blocks[bounds[row]:bounds[row + 1]]
+            else:
+                self._feature_blocks.pop(feature, None)
+        # update the cross products of the blocks and the dot products
+        # with the coefficients using only the changed features
+        self._gram += new.T.dot(new) - old.T.dot(old)
+        old_last, old_values = self._last_values(old, old_counts)
+        new_last, new_values = self._last_values(new, new_counts)
+        self._last_squares += np.bincount(
+            new_last, weights=new_values * new_values, minlength=n_blocks)
+        self._last_squares -= np.bincount(
+            old_last, weights=old_values * old_values, minlength=n_blocks)
+        if self.coef is not None:
+            self._dot += self.coef[changed].dot(new - old)
+            coef = self.coef[changed]
+            self._last_dot += np.bincount(
+                new_last, weights=coef * new_values, minlength=n_blocks)
+            self._last_dot -= np.bincount(
+                old_last, weights=coef * old_values, minlength=n_blocks)
+
+
+class LinearScorer(object):
+    """Compute the decision function of a linear model on graphs.
+
+    The coefficients of a fitted linear estimator are stored in a dense
+    table indexed by feature id. The features of a block of graphs are
+    hashed in flat arrays, normalized as in Vectorizer.transform and
+    multiplied by the coefficients: the sparse data matrix is never
+    assembled and the estimator is not called, which removes most of the
+    per-request overhead when few graphs are scored at a time.
+
+    >>> import networkx as nx
+    >>> from sklearn.linear_model import SGDClassifier
+    >>> def get_path_graph(length=4):
+    ...     g = nx.path_graph(length)
+    ...     for n,d in g.nodes(data=True):
+    ...         d['label'] = 'C' if n % 3 else 'N'
+    ...     for a,b,d in g.edges(data=True):
+    ...         d['label'] = '1'
+    ...     return g
+    >>> graphs = [get_path_graph(length) for length in range(2, 12)]
+    >>> vectorizer = Vectorizer(complexity=2)
+    >>> x = vectorizer.transform(graphs)
+    >>> estimator = SGDClassifier(random_state=1).fit(x, [0, 1] * 5)
+    >>> scorer = vectorizer.scorer(estimator)
+    >>> scores = scorer.decision_function(graphs)
+    >>> bool(np.allclose(scores, estimator.decision_function(x)))
+    True
+    >>> bool((scorer.predict(graphs) == estimator.predict(x)).all())
+    True
+    """
+
+    def __init__(self, estimator, vectorizer=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        estimator : scikit-learn linear predictor or EdenEstimator
+            A fitted estimator with the attributes coef_ and intercept_,
+            or an EdenEstimator/EdenRegressor, whose model and vectorizer
+            are used.
+
+        vectorizer : Vectorizer (default None)
+            The vectorizer that was used to train the estimator. It is
+            required unless the estimator is an EdenEstimator or an
+            EdenRegressor.
+        """
+        if hasattr(estimator, 'model') and hasattr(estimator, 'vectorizer'):
+            if vectorizer is None:
+                vectorizer = estimator.vectorizer
+            estimator = estimator.model
+        if vectorizer is None:
+            raise Exception('ERROR: the vectorizer is not specified.')
+        self.vectorizer = vectorizer
+        coef = np.asarray(estimator.coef_, dtype=np.float64)
+        # one column per output (one for binary classifiers and regressors)
+        self.coef = np.ascontiguousarray(np.atleast_2d(coef).T)
+        if self.coef.shape[0] != vectorizer.feature_size:
+            raise Exception('ERROR: the estimator has %d features, the \
+                vectorizer %d' % (self.coef.shape[0],
+                                  vectorizer.feature_size))
+        self.intercept = np.ravel(
+            np.asarray(estimator.intercept_, dtype=np.float64))
+        self.classes_ = getattr(estimator, 'classes_', None)
+
+    def decision_function(self, graphs):
+        """Return the decision function of the estimator on the graphs.
+
+        Returns
+        -------
+        scores : array, shape = [n_graphs] or [n_graphs, n_classes]
+            The signed distances to the hyperplanes, as computed by the
+            decision_function of a classifier or by the predict function
+            of a regressor.
+        """
+        blocks = [self._score_block(block, vertex=False)[0]
+                  for block in partition_all(self.vectorizer.block_size,
+                                             graphs)]
+        if not blocks:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        return self._ravel(np.concatenate(blocks))
+
+    def predict(self, graphs):
+        """Return the predicted class, or the score for regressors."""
+        scores = self.decision_function(graphs)
+        if self.classes_ is None:
+            return scores
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[np.argmax(scores, axis=1)]
+
+    def vertex_decision_function(self, graphs):
+        """Return the decision function on the vector of each vertex.
+
+        The vector of a vertex encodes the features rooted in the vertex,
+        as in Vectorizer.vertex_transform. The scores are the importance
+        values used by Vectorizer.annotate.
+
+        Returns
+        -------
+        scores_list : list of arrays, shape = [n_graphs, [n_nodes]]
+        """
+        scores_list = []
+        for block in partition_all(self.vectorizer.block_size, graphs):
+            scores, offsets = self._score_block(block, vertex=True)
+            scores_list.extend(self._ravel(scores[start:stop])
+                               for start, stop
+                               in zip(offsets[:-1], offsets[1:]))
+        return scores_list
+
+    def _score_block(self, graphs, vertex):
+        # hash the features of the graphs (or of the vertices of the
+        # graphs) in the rows of an accumulator and multiply the
+        # normalized entries with the coefficients
+        v = self.vectorizer
+        features = FeatureAccumulator()
+        offsets = [0]
+        for graph in graphs:
+            v._test_goodness(graph)
+            if vertex:
+                graph = v._graph_preprocessing(graph)
+                n_roots = len(graph.roots)
+                v._transform_roots(graph, graph.roots, features,
+                                   rows=range(offsets[-1],
+                                              offsets[-1] + n_roots))
+                offsets.append(offsets[-1] + n_roots)
+            else:
+                features.row = len(offsets) - 1
+                v._transform(graph, features)
+                offsets.append(offsets[-1] + 1)
+        n_rows = offsets[-1]
+        rows, feature_ids, values = features.normalized_arrays(
+            n_rows,
+            inner_normalization=v.inner_normalization,
+            normalization=v.normalization,
+            block_weights=v.weights_dict,
+            collisions=v.collisions,
+            stats=v.stats)
+        coef = self.coef[feature_ids]
+        scores = np.empty((n_rows, self.coef.shape[1]))
+        for i in range(self.coef.shape[1]):
+            scores[:, i] = np.bincount(rows, weights=values * coef[:, i],
+                                       minlength=n_rows)
+        return scores + self.intercept, offsets
+
+    def _ravel(self, scores):
+        if self.coef.shape[1] == 1:
+            return scores[:, 0]
+        return scores
 
 
 # -------------------------------------------------------------------
 
-def _label_preprocessing(graph,
-                         key_label='label',
-                         bitmask=2 ** 20 - 1):
-    for n in graph.nodes():
-        label = graph.nodes[n][key_label]
-        graph.nodes[n]['hlabel'] = int(hash(label) & bitmask) + 1
+def _make_cache(cache):
+    if isinstance(cache, str):
+        return FeatureCache(cache)
+    return cache
+
+
+def _ball(adjacency, sources, depth):
+    # nodes within depth hops of the sources
+    visited = set(sources)
+    frontier = list(visited)
+    for i in range(depth):
+        next_frontier = []
+        for u in frontier:
+            for w in adjacency[u]:
+                if w not in visited:
+                    visited.add(w)
+                    next_frontier.append(w)
+        frontier = next_frontier
+        if not frontier:
+            break
+    return visited
+
+
+def _with_reports(vectorizer, result):
+    # in a worker process, send the stats, the watchdog records and the
+    # cache counters back with each result and reset them, so that each
+    # block is counted once
+    if not vectorizer._reports():
+        return result
+    stats = vectorizer.stats.as_dict()
+    vectorizer.stats.reset()
+    records = None
+    if vectorizer.watchdog is not None:
+        records = vectorizer.watchdog.as_dict()
+        vectorizer.watchdog.reset()
+    cache_counters = None
+    if vectorizer.cache is not None:
+        cache = vectorizer.cache
+        cache_counters = dict(hits=cache.hits, misses=cache.misses)
+        cache.reset_counters()
+    return result, stats, records, cache_counters
+
+
+def _transform_block(vectorizer, graphs):
+    return _with_reports(vectorizer, vectorizer._transform_block(graphs))
+
+
+def _feature_blocks_block(vectorizer, graphs):
+    return _with_reports(vectorizer,
+                         vectorizer._feature_blocks_block(graphs))
+
+
+def _cached_transform_block(vectorizer, graphs):
+    return _with_reports(vectorizer, vectorizer._cached_transform(
+        graphs, vectorizer._transform_block))
+
+
+def _vertex_transform_block(vectorizer, graphs):
+    return _with_reports(vectorizer,
+                         vectorizer._vertex_transform_block(graphs))
+
+
+class _CompactGraph(object):
+    """Array based representation of an edge to vertex expanded graph.
+
+    Vertices are identified by their position in the arrays. The adjacency
+    is stored in CSR format (indptr, indices), the hashed labels in hlabel
+    and the vertex types in the boolean masks is_node, is_edge and
+    is_nesting. The roots of the features are the vertices of type 'node':
+    roots lists them and root_index maps a vertex to its position in roots
+    (or -1). The python lists in adjacency, is_node_list and is_nesting_list
+    mirror the arrays for the stages that visit single vertices. The caches
+    computed during preprocessing (ring_index, neigh_graph_hash,
+    neigh_graph_weight) are stored as attributes.
+    """
+
+    def __init__(self, indptr, indices, hlabel, is_node, is_edge,
+                 is_nesting, weight=None, nesting_weight=None,
+                 ids=None, vec=None, svec=None):
+        self.n_vertices = len(hlabel)
+        self.indptr = indptr
+        self.indices = indices
+        self.hlabel = hlabel
+        self.is_node = is_node
+        self.is_edge = is_edge
+        self.is_nesting = is_nesting
+        self.weighted = weight is not None
+        self.weight = weight
+        self.nesting_weight = nesting_weight
+        self.has_nesting = bool(is_nesting.any())
+        self.ids = ids
+        self.vec = vec
+        self.svec = svec
+        self.roots = np.flatnonzero(is_node).tolist()
+        self.root_index = np.full(self.n_vertices, -1, dtype=np.int64)
+        self.root_index[self.roots] = np.arange(len(self.roots))
+        self.root_index = self.root_index.tolist()
+        indptr_list = indptr.tolist()
+        indices_list = indices.tolist()
+        self.adjacency = [indices_list[indptr_list[i]:indptr_list[i + 1]]
+                          for i in range(self.n_vertices)]
+        self.is_node_list = is_node.tolist()
+        self.is_nesting_list = is_nesting.tolist()
+
+
+def _compact_graph(graph,
+                   key_label='label',
+                   key_weight='weight',
+                   key_nesting='nesting',
+                   key_vec=None,
+                   key_svec=None,
+                   bitmask=2 ** 20 - 1,
+                   positional=False,
+                   hasher=None,
+                   weighted=None,
+                   stats=None):
+    """Build the _CompactGraph of a networkx graph.
+
+    The edge to vertex transformation is performed directly on the arrays:
+    the vertices of type 'node' are followed by one vertex of type 'edge'
+    for each edge that is not a self loop. Graphs that have already been
+    subject to the edge to vertex transformation are used as they are.
+    The input graph is not modified. Labels are hashed with the hasher
+    (default: the 'python' backend of eden.hashing). If weighted is None
+    the graph is weighted when at least one vertex or edge has a weight.
+    The time of the expansion, of the label hashing and of the weight
+    preprocessing are recorded in stats, if given.
+    """
+    if hasher is None:
+        hasher = get_hasher()
+    stats = stats or _NO_STATS
+    with stats.stage('edge_to_vertex'):
+        indptr, indices, attributes, is_node, is_edge, ids = \
+            _expand_graph(graph, positional)
+    n_vertices = len(attributes)
+
+    with stats.stage('label_hashing'):
+        # hash each distinct label only once
+        label_hash_cache = {}
+        hlabel = np.empty(n_vertices, dtype=np.int64)
+        for i, attr in enumerate(attributes):
+            label = attr[key_label]
+            label_hash = label_hash_cache.get(label, None)
+            if label_hash is None:
+                label_hash = hasher.label(label, bitmask)
+                label_hash_cache[label] = label_hash
+            hlabel[i] = label_hash
+
+    with stats.stage('weight_preprocessing'):
+        # if at least one vertex or edge is weighted then ensure that all
+        # vertices and edges are weighted in this case use a default
+        # weight of 1 if the weight attribute is missing
+        weight = None
+        weights = [attr.get(key_weight, False) for attr in attributes]
+        if weighted is None:
+            weighted = any(weights)
+        if weighted:
+            weights = [1 if w is False else w for w in weights]
+            weight = np.array(weights, dtype=np.float64)
+            nesting_weight = weights
+        else:
+            nesting_weight = [attr.get(key_weight, 1)
+                              for attr in attributes]
+    is_nesting = [bool(attr.get(key_nesting, False)) for attr in attributes]
+
+    vec, svec = None, None
+    if key_vec is not None:
+        vec = [attr.get(key_vec, None) for attr in attributes]
+    if key_svec is not None:
+        svec = [attr.get(key_svec, None) for attr in attributes]
+    return _CompactGraph(indptr, indices, hlabel,
+                         is_node=np.array(is_node, dtype=bool),
+                         is_edge=np.array(is_edge, dtype=bool),
+                         is_nesting=np.array(is_nesting, dtype=bool),
+                         weight=weight,
+                         nesting_weight=nesting_weight,
+                         ids=ids,
+                         vec=vec,
+                         svec=svec)
+
+
+def _expand_graph(graph, positional=False):
+    # the CSR adjacency, the attributes and the types of the vertices of
+    # the edge to vertex transformation of the graph
+    vertices = list(graph.nodes())
+    index = dict((u, i) for i, u in enumerate(vertices))
+    attributes = [graph.nodes[u] for u in vertices]
+    sources, targets = [], []
+    if 'expanded' in graph.graph:
+        for u, v in graph.edges():
+            sources.append(index[u])
+            targets.append(index[v])
+        is_node = [bool(attr.get('node', False)) for attr in attributes]
+        is_edge = [bool(attr.get('edge', False)) for attr in attributes]
+        ids = vertices
+    else:
+        n_nodes = len(vertices)
+        edges = [(u, v, attr)
+                 for u, v, attr in graph.edges(data=True) if u != v]
+        for i, (u, v, attr) in enumerate(edges):
+            sources.extend((n_nodes + i, n_nodes + i))
+            targets.extend((index[u], index[v]))
+            attributes.append(attr)
+        is_node = [True] * n_nodes + [False] * len(edges)
+        is_edge = [False] * n_nodes + [True] * len(edges)
+        ids = None
+        if positional:
+            # edge vertices are numbered after the largest node id
+            w = 1 + max(vertices)
+            ids = vertices + list(range(w, w + len(edges)))
+    if ids is not None:
+        ids = np.array(ids, dtype=np.int64)
+    n_vertices = len(attributes)
+
+    # adjacency in CSR format
+    sources = np.array(sources, dtype=np.int32)
+    targets = np.array(targets, dtype=np.int32)
+    rows = np.concatenate((sources, targets))
+    cols = np.concatenate((targets, sources))
+    order = np.argsort(rows, kind='stable')
+    indices = cols[order]
+    indptr = np.zeros(n_vertices + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_vertices), out=indptr[1:])
+    return indptr, indices, attributes, is_node, is_edge, ids
+
+
+def _ring_index(graph, max_depth):
+    """Compute the vertices at distance 0..max_depth from each root.
+
+    All roots are expanded at once: the frontier is a flat array of
+    (root, vertex) pairs that is moved one step further by gathering the
+    neighbors of all its vertices from the CSR adjacency arrays. Since a
+    neighbor of a vertex at distance d - 1 is at distance d - 2, d - 1 or d,
+    only the two previous rings need to be checked to discard the vertices
+    that have already been visited. Vertices of type nesting are never
+    entered.
+    Return a list with one pair (indptr, indices) per distance: the vertices
+    at that distance from the i-th root (in the order of graph.roots) are
+    indices[indptr[i]:indptr[i + 1]], sorted. The list stops at the largest
+    distance that is reached by at least one root.
+    """
+    n_roots, n_vertices = len(graph.roots), graph.n_vertices
+    indptr, indices = graph.indptr, graph.indices
+    degree = np.diff(indptr)
+    is_nesting = graph.is_nesting
+
+    def make_ring(keys):
+        # keys are sorted codes root * n_vertices + vertex
+        rows, vertices = np.divmod(keys, n_vertices)
+        ring_indptr = np.zeros(n_roots + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_roots), out=ring_indptr[1:])
+        return ring_indptr, vertices
+
+    keys = np.arange(n_roots, dtype=np.int64) * n_vertices + \
+        np.array(graph.roots, dtype=np.int64)
+    previous_keys = [np.array([], dtype=np.int64), keys]
+    ring_index = [make_ring(keys)]
+    for d in range(1, max_depth + 1):
+        rows, vertices = np.divmod(keys, n_vertices)
+        # gather all the neighbors of the vertices in the frontier
+        counts = degree[vertices]
+        total = counts.sum()
+        if total == 0:
+            break
+        starts = np.repeat(indptr[vertices] - np.cumsum(counts) + counts,
+                           counts)
+        neighbors = indices[starts + np.arange(total)]
+        rows = np.repeat(rows, counts)
+        # skip nesting edge-nodes
+        selected = ~is_nesting[neighbors]
+        keys = np.sort(rows[selected] * n_vertices + neighbors[selected])
+        if len(keys) > 1:
+            keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+        # discard the vertices that have been visited at a smaller distance
+        for visited_keys in previous_keys:
+            if len(visited_keys) and len(keys):
+                pos = np.searchsorted(visited_keys, keys)
+                pos[pos == len(visited_keys)] = 0
+                keys = keys[visited_keys[pos] != keys]
+        if len(keys) == 0:
+            break
+        ring_index.append(make_ring(keys))
+        previous_keys = [previous_keys[1], keys]
+    return ring_index
 
 
 def _edge_to_vertex_transform(original_graph):
@@ -974,11 +2392,6 @@ def _revert_edge_to_vertex_transform(original_graph):
 
 
 def _clean_graph(graph):
+    # the preprocessing keeps its data in _CompactGraph, only the mark of
+    # the transformation is left on the graph
     graph.graph.pop('expanded', None)
-    for n in graph.nodes():
-        if graph.nodes[n].get('node', False):
-            # remove stale information
-            graph.nodes[n].pop('remote_neighbours', None)
-            graph.nodes[n].pop('neigh_graph_hash', None)
-            graph.nodes[n].pop('neigh_graph_weight', None)
-            graph.nodes[n].pop('hlabel', None)
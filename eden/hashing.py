@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+"""Provides the hashing backends used to compute the feature ids.
+
+Feature ids are obtained by hashing tuples of integers (label hashes,
+radius, distance, ...) with the same function that the builtin hash uses
+for tuples of ints in CPython >= 3.8 (an xxHash based 64 bit mixer). This
+module implements that function on numpy arrays, so that whole arrays of
+tuples can be hashed at once, and the results are identical to the scalar
+functions fast_hash, fast_hash_2, ... in eden.
+
+Only the hash of strings (and of objects containing strings) is randomized
+across interpreter runs (see PYTHONHASHSEED), so the backends differ in the
+way labels are hashed:
+
+- 'python': labels are hashed with the builtin hash function. This is the
+  historical behaviour: feature ids of string labels change across
+  processes unless PYTHONHASHSEED is set.
+
+- 'stable': labels are hashed with a seeded blake2b digest of their text,
+  feature ids are then reproducible across processes and machines.
+
+The array functions check at import time that they reproduce the builtin
+hash of int tuples; on interpreters where this is not the case (Python < 3.8
+or 32 bit builds) they fall back to the builtin hash, and feature ids are
+reproducible across processes but not across platforms.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import numpy as np
+from eden import fast_hash, fast_hash_vec
+from eden import _bitmask_
+
+import logging
+logger = logging.getLogger(__name__)
+
+_XXPRIME_1 = np.uint64(11400714785074694791)
+_XXPRIME_2 = np.uint64(14029467366897019727)
+_XXPRIME_5 = np.uint64(2870177450012600261)
+_XXLEN_MASK = 2870177450012600261 ^ 3527539
+_MINUS_ONE = np.uint64(2 ** 64 - 1)
+_MODULUS = np.uint64(2 ** 61 - 1)
+_ROTATE_LEFT = np.uint64(31)
+_ROTATE_RIGHT = np.uint64(33)
+_RUNNING_HASH_SEED = 0xAAAAAAAA
+# below this number of tuples the builtin hash is faster than numpy
+_MIN_ARRAY_SIZE = 100
+
+
+def hash_tuples(columns, bitmask=_bitmask_):
+    """Hash the tuples formed by the i-th elements of the columns.
+
+    Equivalent to [fast_hash_k(*t, bitmask=bitmask) for t in zip(*columns)].
+
+    Parameters
+    ----------
+    columns : list of array-like of int
+        The columns, all of the same length.
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64
+    """
+    columns = [np.asarray(col, dtype=np.int64) for col in columns]
+    if not _NATIVE or len(columns[0]) < _MIN_ARRAY_SIZE:
+        columns = [col.tolist() for col in columns]
+        return np.array([fast_hash(t, bitmask) for t in zip(*columns)],
+                        dtype=np.int64)
+    return _mask(_tuple_hash(columns), bitmask)
+
+
+def hash_rows(values, indptr, bitmask=_bitmask_):
+    """Hash the variable length rows of a CSR-like layout.
+
+    Equivalent to [fast_hash(values[indptr[i]:indptr[i + 1]], bitmask)
+    for i in range(len(indptr) - 1)].
+
+    Parameters
+    ----------
+    values : array-like of int
+        The concatenation of the rows.
+
+    indptr : array-like of int
+        Row i is values[indptr[i]:indptr[i + 1]].
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64
+    """
+    values = np.asarray(values, dtype=np.int64)
+    indptr = np.asarray(indptr, dtype=np.int64)
+    if not _NATIVE or len(indptr) <= _MIN_ARRAY_SIZE:
+        values = values.tolist()
+        return np.array([fast_hash(values[start:end], bitmask)
+                         for start, end
+                         in zip(indptr[:-1].tolist(), indptr[1:].tolist())],
+                        dtype=np.int64)
+    lengths = np.diff(indptr)
+    # process the rows from the longest to the shortest, so that the rows
+    # that are still active at step j are a prefix
+    order = np.argsort(-lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    starts = indptr[:-1][order]
+    lanes = _int_hash(values)
+    acc = np.full(len(order), _XXPRIME_5, dtype=np.uint64)
+    max_length = sorted_lengths[0] if len(order) else 0
+    for j in range(max_length):
+        n_active = np.searchsorted(-sorted_lengths, -j, side='left')
+        acc[:n_active] = _round(acc[:n_active], lanes[starts[:n_active] + j])
+    acc = _finalize(acc, sorted_lengths.astype(np.uint64))
+    hashes = np.empty(len(order), dtype=np.int64)
+    hashes[order] = _mask(acc, bitmask)
+    return hashes
+
+
+def hash_prefixes(matrix, lengths, bitmask=_bitmask_):
+    """Compute the running hash of each row of a matrix.
+
+    Equivalent to fast_hash_vec(matrix[i, :lengths[i]], bitmask) for each
+    row i; entries beyond the length of the row are set to 0.
+
+    Parameters
+    ----------
+    matrix : array-like of int, shape = [n_rows, n_cols]
+        The values to hash.
+
+    lengths : array-like of int, shape = [n_rows]
+        The number of valid entries in each row.
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64, shape = [n_rows, n_cols]
+    """
+    matrix = np.asarray(matrix, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    hashes = np.zeros(matrix.shape, dtype=np.int64)
+    if not _NATIVE or len(matrix) < _MIN_ARRAY_SIZE:
+        for i, (row, length) in enumerate(zip(matrix.tolist(),
+                                              lengths.tolist())):
+            hashes[i, :length] = fast_hash_vec(row[:length], bitmask)
+        return hashes
+    running_hash = np.full(len(matrix), _RUNNING_HASH_SEED, dtype=np.int64)
+    for j in range(matrix.shape[1]):
+        active = lengths > j
+        position = np.full(len(matrix), j, dtype=np.int64)
+        updated = running_hash ^ _tuple_hash(
+            [running_hash, matrix[:, j], position]).view(np.int64)
+        running_hash = np.where(active, updated, running_hash)
+        hashes[:, j] = np.where(active,
+                                _mask(running_hash.view(np.uint64), bitmask),
+                                0)
+    return hashes
+
+
+def hash_windows(items, width, bitmask=_bitmask_):
+    """Compute the running hash of the window of items at each position.
+
+    Equivalent to fast_hash_vec(items[i:i + width], bitmask) for each
+    position i, as the rows of a matrix; the entries of the windows that
+    go beyond the end of items are set to 0. All the windows are hashed
+    at once, one offset at a time.
+
+    Parameters
+    ----------
+    items : string or sequence of hashable objects
+        The items to hash, e.g. the characters of a sequence.
+
+    width : int
+        The size of the windows.
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64, shape = [len(items), width]
+    """
+    n_items = len(items)
+    hashes = np.zeros((n_items, width), dtype=np.int64)
+    if not _NATIVE or n_items < _MIN_ARRAY_SIZE:
+        for i in range(n_items):
+            row = fast_hash_vec(items[i:i + width], bitmask)
+            hashes[i, :len(row)] = row
+        return hashes
+    lanes = _item_lanes(items)
+    running_hash = np.full(n_items, _RUNNING_HASH_SEED, dtype=np.int64)
+    for j in range(min(width, n_items)):
+        # the windows that have an item at offset j
+        n_active = n_items - j
+        running_hash[:n_active] = _running_step(running_hash[:n_active],
+                                                lanes[j:], j)
+        hashes[:n_active, j] = _mask(running_hash[:n_active].view(np.uint64),
+                                     bitmask)
+    return hashes
+
+
+def hash_symbol_windows(symbols, alphabet, width, bitmask=_bitmask_):
+    """Compute hash_windows for a sequence encoded as symbol indices.
+
+    Equivalent to hash_windows([alphabet[s] for s in symbols], width,
+    bitmask). The running hash of a window only depends on its items: the
+    running hashes of all the kmers over the alphabet are computed once
+    in tables, and the windows of up to k items, where len(alphabet)^k
+    is at most 2^20, are hashed by looking up their kmer, as an integer
+    code in base len(alphabet). The longer windows go on from there with
+    array hashing.
+
+    Parameters
+    ----------
+    symbols : array-like of int
+        The index in the alphabet of each item.
+
+    alphabet : string or sequence of hashable objects
+        The distinct items, e.g. the characters 'ACGU' or their codes in a
+        hashing backend.
+
+    width : int
+        The size of the windows.
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64, shape = [len(symbols), width]
+    """
+    symbols = np.asarray(symbols, dtype=np.int64)
+    if not _NATIVE:
+        return hash_windows([alphabet[s] for s in symbols.tolist()], width,
+                            bitmask)
+    n_items = len(symbols)
+    hashes = np.zeros((n_items, width), dtype=np.int64)
+    lanes = _item_lanes(alphabet)
+    size = len(lanes)
+    codes = np.zeros(n_items, dtype=np.int64)
+    running_hash = np.full(n_items, _RUNNING_HASH_SEED, dtype=np.int64)
+    for j in range(min(width, n_items)):
+        n_active = n_items - j
+        if size ** (j + 1) <= _MAX_KMER_TABLE_SIZE:
+            codes[:n_active] = codes[:n_active] * size + symbols[j:]
+            running_hash[:n_active] = _kmer_table(lanes, j + 1)[
+                codes[:n_active]]
+        else:
+            running_hash[:n_active] = _running_step(
+                running_hash[:n_active], lanes[symbols[j:]], j)
+        hashes[:n_active, j] = _mask(running_hash[:n_active].view(np.uint64),
+                                     bitmask)
+    return hashes
+
+
+def hash_kmers(alphabet, k, bitmask=_bitmask_):
+    """Compute the running hash of all the kmers over an alphabet.
+
+    The i-th entry is fast_hash_vec(kmer, bitmask)[-1] for the kmer of k
+    items whose indices in the alphabet are the digits of i in base
+    len(alphabet), the first item being the most significant digit; it is
+    the hash of the kmer in the column k - 1 of hash_symbol_windows.
+
+    Parameters
+    ----------
+    alphabet : string or sequence of hashable objects
+        The distinct items.
+
+    k : int
+        The size of the kmers.
+
+    bitmask : int (default 2^32 - 1)
+        The mask applied to the hash values.
+
+    Returns
+    -------
+    hashes : array of int64, shape = [len(alphabet)^k]
+    """
+    if not _NATIVE:
+        size = len(alphabet)
+        kmers = np.zeros((size ** k, k), dtype=np.int64)
+        codes = np.arange(size ** k)
+        for j in range(k - 1, -1, -1):
+            codes, kmers[:, j] = np.divmod(codes, size)
+        return np.array([fast_hash_vec([alphabet[s] for s in kmer],
+                                       bitmask)[-1]
+                         for kmer in kmers.tolist()], dtype=np.int64)
+    table = _kmer_table(_item_lanes(alphabet), k)
+    return _mask(table.view(np.uint64), bitmask)
+
+
+class Hasher(object):
+    """Hash labels according to the selected backend.
+
+    Parameters
+    ----------
+    hashing : string (default 'python')
+        The backend: 'python' uses the builtin hash function, 'stable' a
+        seeded blake2b digest of the label text.
+
+    seed : int (default 0)
+        The seed of the 'stable' backend.
+    """
+
+    def __init__(self, hashing='python', seed=0):
+        """Constructor."""
+        if hashing not in ('python', 'stable'):
+            raise Exception('ERROR: unknown hashing backend: %s' % hashing)
+        self.hashing = hashing
+        self.seed = seed
+        self._key = (seed % 2 ** 64).to_bytes(8, 'little')
+
+    def label(self, label, bitmask):
+        """Return the hash of a label in [1, bitmask + 1]."""
+        if self.hashing == 'python':
+            return int(hash(label) & bitmask) + 1
+        if isinstance(label, np.generic):
+            label = label.item()
+        if not isinstance(label, str):
+            label = repr(label)
+        digest = hashlib.blake2b(label.encode('utf-8'),
+                                 digest_size=8,
+                                 key=self._key).digest()
+        return int(int.from_bytes(digest, 'little') & bitmask) + 1
+
+    def encode(self, seq, bitmask=_bitmask_):
+        """Return the list of the hashes of the items of seq.
+
+        With the 'python' backend the items are returned unchanged, since
+        the builtin hash is applied to them when they are combined.
+        """
+        if self.hashing == 'python':
+            return seq
+        cache = {}
+        codes = []
+        for item in seq:
+            code = cache.get(item, None)
+            if code is None:
+                code = self.label(item, bitmask)
+                cache[item] = code
+            codes.append(code)
+        return codes
+
+
+_hashers = {}
+
+
+def get_hasher(hashing='python'):
+    """Return the shared Hasher for the backend."""
+    hasher = _hashers.get(hashing, None)
+    if hasher is None:
+        hasher = Hasher(hashing)
+        _hashers[hashing] = hasher
+    return hasher
+
+
+# -------------------------------------------------------------------
+
+def _int_hash(values):
+    # hash of python ints: sign(x) * (|x| mod 2**61 - 1), with -1 -> -2
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0 or (values.min() >= 0 and values.max() < _MODULUS):
+        # small non negative ints are their own hash
+        return values.view(np.uint64)
+    negative = values < 0
+    magnitude = values.view(np.uint64)
+    magnitude = np.where(negative, ~magnitude + np.uint64(1), magnitude)
+    hashes = (magnitude % _MODULUS).view(np.int64)
+    hashes = np.where(negative, -hashes, hashes)
+    hashes = np.where(hashes == -1, -2, hashes)
+    return hashes.view(np.uint64)
+
+
+def _item_lanes(items):
+    # the builtin hash of each item, as used in the hash of a tuple
+    if isinstance(items, str):
+        # hash each distinct character once
+        chars, inverse = np.unique(
+            np.frombuffer(items.encode('utf-32-le'), dtype=np.uint32),
+            return_inverse=True)
+        char_hashes = np.array([hash(chr(c)) for c in chars.tolist()],
+                               dtype=np.int64)
+        return char_hashes[inverse.ravel()].view(np.uint64)
+    return np.array([hash(item) for item in items],
+                    dtype=np.int64).view(np.uint64)
+
+
+def _running_step(running_hash, lanes, offset):
+    # the running hashes after the items with the given lanes at offset
+    acc = np.full(len(running_hash), _XXPRIME_5, dtype=np.uint64)
+    acc = _round(acc, _int_hash(running_hash))
+    acc = _round(acc, lanes)
+    acc = _round(acc, np.full(len(running_hash), offset, dtype=np.uint64))
+    acc = _finalize(acc, np.uint64(3))
+    return running_hash ^ acc.view(np.int64)
+
+
+# the largest number of entries of a table of kmers
+_MAX_KMER_TABLE_SIZE = 2 ** 20
+
+_kmer_tables = {}
+
+
+def _kmer_table(lanes, k):
+    # the running hashes of all the kmers of k items over the alphabet
+    # with the given lanes, indexed by the kmer code in base len(lanes)
+    key = (lanes.tobytes(), k)
+    table = _kmer_tables.get(key, None)
+    if table is None:
+        if k == 0:
+            table = np.full(1, _RUNNING_HASH_SEED, dtype=np.int64)
+        else:
+            prefixes = _kmer_table(lanes, k - 1)
+            table = _running_step(np.repeat(prefixes, len(lanes)),
+                                  np.tile(lanes, len(prefixes)), k - 1)
+        _kmer_tables[key] = table
+    return table
+
+
+def _round(acc, lane):
+    acc = acc + lane * _XXPRIME_2
+    acc = (acc << _ROTATE_LEFT) | (acc >> _ROTATE_RIGHT)
+    return acc * _XXPRIME_1
+
+
+def _finalize(acc, lengths):
+    acc = acc + (lengths ^ np.uint64(_XXLEN_MASK))
+    acc[acc == _MINUS_ONE] = 1546275796
+    return acc
+
+
+def _tuple_hash(columns):
+    acc = np.full(len(columns[0]), _XXPRIME_5, dtype=np.uint64)
+    for col in columns:
+        acc = _round(acc, _int_hash(col))
+    return _finalize(acc, np.uint64(len(columns)))
+
+
+def _mask(acc, bitmask):
+    return (acc & np.uint64(bitmask)).astype(np.int64) + 1
+
+
+def _check_native():
+    # verify that the numpy implementation reproduces the builtin hash
+    rnd = np.random.RandomState(42)
+    columns = [rnd.randint(-2 ** 62, 2 ** 62, size=64, dtype=np.int64),
+               rnd.randint(-3, 3, size=64).astype(np.int64),
+               rnd.randint(0, 2 ** 32, size=64, dtype=np.int64)]
+    columns[0][:3] = [-1, 0, np.iinfo(np.int64).min]
+    expected = [hash(t) for t in zip(*[col.tolist() for col in columns])]
+    try:
+        with np.errstate(over='ignore'):
+            computed = _tuple_hash(columns).view(np.int64).tolist()
+    except Exception:
+        return False
+    return computed == expected
+
+
+_NATIVE = _check_native()
+if not _NATIVE:
+    logger.debug('array hashing falls back to the builtin hash function')
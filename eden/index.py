@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""Provides a similarity search index over sparse feature vectors.
+
+The vectors are kept in a FeatureStore (see eden.store). The exact top k
+cosine query scans the stored shards with the tiled kernel computation of
+eden.kernel. The approximate query uses locality sensitive hashing: each
+vector is summarized by a signature of random hyperplane (SimHash) bits,
+the signature is split in bands and the vectors that share at least one
+band with the query are the candidates, that are then ranked by their
+exact cosine similarity. The random hyperplanes are derived from the
+feature ids with a hash function, so no projection matrix is stored.
+
+>>> import networkx as nx
+>>> from eden.graph import Vectorizer
+>>> def get_path_graph(length=4):
+...     g = nx.path_graph(length)
+...     for n,d in g.nodes(data=True):
+...         d['label'] = 'C'
+...     for a,b,d in g.edges(data=True):
+...         d['label'] = '1'
+...     return g
+>>> graphs = [get_path_graph(length) for length in range(2, 30)]
+>>> vectorizer = Vectorizer()
+>>> index = SimilarityIndex()
+>>> index.extend(vectorizer.transform_iter(graphs, block_size=10))
+>>> len(index)
+28
+>>> queries = vectorizer.transform([get_path_graph(10)])
+>>> ids, scores = index.query(queries, k=3, exact=True)
+>>> ids[0].tolist()
+[8, 9, 7]
+>>> ids, scores = index.query(queries, k=1)
+>>> ids[0].tolist()
+[8]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+from eden.hashing import hash_tuples
+from eden.kernel import block_kernel_matrix
+from eden.store import FeatureStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+_PARAMS = 'index.json'
+
+
+class SimilarityIndex(object):
+    """Index of sparse vectors for top k cosine similarity queries.
+
+    Parameters
+    ----------
+    path : string (default None)
+        The directory of the index. If it contains an index, the index is
+        opened and new vectors are appended to it. If None, a temporary
+        directory is used.
+
+    n_bands : int (default 16)
+        The number of bands of the signatures. More bands give more
+        candidates, i.e. higher recall and slower queries.
+
+    band_size : int (default 8)
+        The number of bits in each band. Longer bands give fewer and more
+        similar candidates.
+
+    seed : int (default 0)
+        The seed of the random hyperplanes.
+    """
+
+    def __init__(self, path=None, n_bands=16, band_size=8, seed=0):
+        """Constructor."""
+        if path is None:
+            path = tempfile.mkdtemp(prefix='eden_index_')
+        self.path = path
+        params_path = os.path.join(path, _PARAMS)
+        if os.path.exists(params_path):
+            with open(params_path) as f:
+                params = json.load(f)
+            n_bands, band_size = params['n_bands'], params['band_size']
+            seed = params['seed']
+        if band_size > 62:
+            raise Exception('ERROR: band_size must be at most 62.')
+        self.n_bands = n_bands
+        self.band_size = band_size
+        self.seed = seed
+        self.store = FeatureStore(os.path.join(path, 'vectors'))
+        if not os.path.exists(params_path):
+            with open(params_path, 'w') as f:
+                json.dump(dict(n_bands=n_bands, band_size=band_size,
+                               seed=seed), f)
+        self._norms = [self._load(i, 'norms')
+                       for i in range(len(self.store.shards))]
+        self._bands = [self._load(i, 'bands')
+                       for i in range(len(self.store.shards))]
+        self._sorted_bands = None
+
+    def __len__(self):
+        """Number of indexed vectors."""
+        return len(self.store)
+
+    def add(self, data_matrix):
+        """Add the rows of a sparse matrix to the index.
+
+        Returns
+        -------
+        ids : array of int
+            The ids of the added rows.
+        """
+        data_matrix = csr_matrix(data_matrix)
+        start = len(self.store)
+        if data_matrix.shape[0] == 0:
+            return np.arange(start, start)
+        self.store.append(data_matrix)
+        shard = len(self.store.shards) - 1
+        norms = np.sqrt(np.asarray(
+            data_matrix.multiply(data_matrix).sum(axis=1)).ravel())
+        bands = self._signature_bands(data_matrix)
+        np.save(self._file_name(shard, 'norms'), norms)
+        np.save(self._file_name(shard, 'bands'), bands)
+        self._norms.append(norms)
+        self._bands.append(bands)
+        self._sorted_bands = None
+        return np.arange(start, len(self.store))
+
+    def extend(self, data_matrices):
+        """Add the rows of each matrix of an iterable (e.g. transform_iter)."""
+        for data_matrix in data_matrices:
+            if isinstance(data_matrix, tuple):
+                # pairs (offset, data_matrix) from transform_iter
+                data_matrix = data_matrix[1]
+            self.add(data_matrix)
+
+    def query(self, data_matrix, k=10, exact=False, tile_size=1000,
+              n_jobs=1):
+        """Return the k most similar indexed vectors to each query row.
+
+        Parameters
+        ----------
+        data_matrix : sparse matrix, shape = [n_queries, n_features]
+            The query vectors.
+
+        k : int (default 10)
+            The number of neighbors.
+
+        exact : bool (default False)
+            If True all the indexed vectors are scanned, otherwise only
+            the candidates found by locality sensitive hashing are ranked.
+
+        tile_size, n_jobs : int
+            The tiles and the number of processes used by the exact scan.
+
+        Returns
+        -------
+        ids : array of int, shape = [n_queries, k]
+            The ids of the neighbors by decreasing cosine similarity,
+            padded with -1 when there are fewer than k results.
+
+        scores : array of float, shape = [n_queries, k]
+            The cosine similarities (0 for the padding).
+        """
+        data_matrix = csr_matrix(data_matrix, dtype=np.float64)
+        queries = _normalize(data_matrix)
+        if exact:
+            return self._exact_query(queries, k, tile_size, n_jobs)
+        return self._approximate_query(queries, k)
+
+    def _exact_query(self, queries, k, tile_size, n_jobs):
+        n_queries = queries.shape[0]
+        ids = np.zeros((n_queries, 0), dtype=np.int64)
+        scores = np.zeros((n_queries, 0))
+        offsets = np.cumsum([0] + [shard['n_rows']
+                                   for shard in self.store.shards])
+        for shard, offset in enumerate(offsets[:-1]):
+            # one shard at a time, normalized to unit norm
+            rows = _normalize(self.store.rows(offset, offsets[shard + 1]))
+            kernel = block_kernel_matrix(queries, rows, tile_size=tile_size,
+                                         n_jobs=n_jobs, top_k=k).tocoo()
+            shard_ids, shard_scores = _to_dense(
+                kernel.row, kernel.col + offset, kernel.data, n_queries, k)
+            ids, scores = _merge(ids, scores, shard_ids, shard_scores, k)
+        return _pad(ids, scores, k)
+
+    def _approximate_query(self, queries, k, chunk_size=100):
+        n_queries = queries.shape[0]
+        if len(self) == 0 or n_queries == 0:
+            return _pad(np.zeros((n_queries, 0), dtype=np.int64),
+                        np.zeros((n_queries, 0)), k)
+        sorted_keys, sorted_ids = self._get_sorted_bands()
+        norms = np.concatenate(self._norms)
+        ids, scores = [], []
+        for start in range(0, n_queries, chunk_size):
+            chunk = queries[start:start + chunk_size]
+            n_rows = chunk.shape[0]
+            # the (query, candidate) pairs that share at least one band
+            query_bands = self._signature_bands(chunk)
+            pairs = []
+            for band in range(self.n_bands):
+                keys = sorted_keys[band]
+                lower = np.searchsorted(keys, query_bands[:, band], 'left')
+                upper = np.searchsorted(keys, query_bands[:, band], 'right')
+                counts = upper - lower
+                positions = np.repeat(lower - np.cumsum(counts) + counts,
+                                      counts) + np.arange(counts.sum())
+                offsets = np.repeat(np.arange(n_rows) * len(self), counts)
+                pairs.append(offsets + sorted_ids[band][positions])
+            rows, candidates = np.divmod(np.unique(np.concatenate(pairs)),
+                                         len(self))
+            # rank the candidates by their exact cosine similarity
+            unique_candidates, columns = np.unique(candidates,
+                                                   return_inverse=True)
+            similarities = chunk.dot(
+                self.store.take(unique_candidates).T).toarray()
+            similarities = similarities[rows, columns.ravel()] / \
+                _safe(norms[candidates])
+            chunk_ids, chunk_scores = _to_dense(rows, candidates,
+                                                similarities, n_rows, k)
+            ids.append(chunk_ids)
+            scores.append(chunk_scores)
+        return _pad(np.vstack(ids), np.vstack(scores), k)
+
+    def _get_sorted_bands(self):
+        # for each band the sorted keys and the ids of the vectors
+        if self._sorted_bands is None:
+            bands = np.concatenate(self._bands)
+            order = np.argsort(bands, axis=0, kind='stable')
+            self._sorted_bands = (
+                np.take_along_axis(bands, order, axis=0).T.copy(),
+                order.T.copy())
+        return self._sorted_bands
+
+    def _signature_bands(self, data_matrix):
+        # sign of the projections on the random hyperplanes, packed in
+        # one int per band
+        n_bits = self.n_bands * self.band_size
+        features, columns = np.unique(data_matrix.indices,
+                                      return_inverse=True)
+        compact = csr_matrix((data_matrix.data, columns.ravel(),
+                              data_matrix.indptr),
+                             shape=(data_matrix.shape[0], len(features)))
+        projections = compact.dot(self._hyperplanes(features, n_bits))
+        bits = (np.asarray(projections) > 0).astype(np.int64)
+        bits = bits.reshape(-1, self.n_bands, self.band_size)
+        return (bits << np.arange(self.band_size)).sum(axis=2)
+
+    def _hyperplanes(self, features, n_bits):
+        # the +1/-1 coordinates of the hyperplanes for the given features,
+        # 32 random bits from each hash
+        n_words = (n_bits + 31) // 32
+        words = np.column_stack([
+            hash_tuples([features, np.full(len(features), self.seed),
+                         np.full(len(features), word)]) - 1
+            for word in range(n_words)])
+        bits = (words[:, :, None] >> np.arange(32)) & 1
+        bits = bits.reshape(len(features), n_words * 32)[:, :n_bits]
+        return (2 * bits - 1).astype(np.float64)
+
+    def _file_name(self, shard, kind):
+        return os.path.join(self.path, '%s_%06d.npy' % (kind, shard))
+
+    def _load(self, shard, kind):
+        return np.load(self._file_name(shard, kind), mmap_mode='r')
+
+
+def recall_at_k(index, data_matrix, k=10):
+    """Return the recall of the approximate query w.r.t. the exact one.
+
+    The recall is the average fraction of the exact k nearest neighbors
+    that are found by the approximate query.
+    """
+    exact_ids, _ = index.query(data_matrix, k=k, exact=True)
+    ids, _ = index.query(data_matrix, k=k)
+    found, total = 0, 0
+    for exact_row, row in zip(exact_ids, ids):
+        exact_row = exact_row[exact_row >= 0]
+        found += len(np.intersect1d(exact_row, row))
+        total += len(exact_row)
+    if total == 0:
+        return 1.0
+    return found / total
+
+
+# -------------------------------------------------------------------
+
+def _normalize(data_matrix):
+    norms = np.sqrt(np.asarray(
+        data_matrix.multiply(data_matrix).sum(axis=1)).ravel())
+    data_matrix = data_matrix.copy()
+    data_matrix.data /= np.repeat(_safe(norms), np.diff(data_matrix.indptr))
+    return data_matrix
+
+
+def _safe(norms):
+    return np.where(norms > 0, norms, 1)
+
+
+def _to_dense(rows, ids, scores, n_rows, k):
+    # the k entries of each row with the largest scores, in k columns
+    order = np.lexsort((ids, -scores, rows))
+    rows, ids, scores = rows[order], ids[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    selected = rank < k
+    rows, ids, scores, rank = \
+        rows[selected], ids[selected], scores[selected], rank[selected]
+    dense_ids = np.full((n_rows, k), -1, dtype=np.int64)
+    dense_scores = np.full((n_rows, k), -np.inf)
+    dense_ids[rows, rank] = ids
+    dense_scores[rows, rank] = scores
+    return dense_ids, dense_scores
+
+
+def _merge(ids, scores, other_ids, other_scores, k):
+    ids = np.hstack((ids, other_ids))
+    scores = np.hstack((scores, other_scores))
+    # the stable sort keeps the smaller ids first among equal scores
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    return (np.take_along_axis(ids, order, axis=1),
+            np.take_along_axis(scores, order, axis=1))
+
+
+def _pad(ids, scores, k):
+    n_rows = ids.shape[0]
+    padded_ids = np.full((n_rows, k), -1, dtype=np.int64)
+    padded_scores = np.zeros((n_rows, k))
+    width = min(k, ids.shape[1])
+    padded_ids[:, :width] = ids[:, :width]
+    padded_scores[:, :width] = np.where(ids[:, :width] >= 0,
+                                        scores[:, :width], 0)
+    return padded_ids, padded_scores
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Provides reading of FASTA files through a memory map.
+
+The records are located in the memory mapped file, so that the sequence
+of a record can be read in pieces, without loading the file: a whole
+chromosome can be scanned with eden.sequence.Vectorizer.scan using a
+bounded amount of memory.
+
+>>> import os, tempfile
+>>> filename = os.path.join(tempfile.mkdtemp(), 'seqs.fa')
+>>> with open(filename, 'w') as f:
+...     _ = f.write('>seq1 first\\nACGU\\nACG\\n>seq2\\nGGCC\\n')
+>>> list(load(filename))
+[('seq1 first', 'ACGUACG'), ('seq2', 'GGCC')]
+>>> [(header, list(pieces)) for header, pieces
+...  in load_mmap(filename, piece_size=3)]
+[('seq1 first', ['ACG', 'UAC', 'G']), ('seq2', ['GGC', 'C'])]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import os
+from eden.util import read
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def load(input):
+    """Yield the (header, sequence) pairs of the records of a FASTA source.
+
+    The source can be a file path, a URL or a list of lines, as for the
+    other loaders (see eden.util.read). The pairs can be vectorized with
+    eden.sequence.Vectorizer. To read long sequences from a file in
+    bounded memory use load_mmap.
+
+    >>> list(load(['>seq1', 'AC GU', '>seq2', 'GG']))
+    [('seq1', 'ACGU'), ('seq2', 'GG')]
+    """
+    header, pieces = None, []
+    for line in read(input):
+        line = line.strip()
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(pieces)
+            header, pieces = line[1:].strip(), []
+        elif header is not None:
+            # the lines before the first header are skipped
+            pieces.append(''.join(line.split()))
+    if header is not None:
+        yield header, ''.join(pieces)
+
+
+def load_mmap(filename, piece_size=2 ** 20):
+    """Yield the records of a FASTA file as (header, pieces) pairs.
+
+    The file is memory mapped and the sequence of each record is yielded
+    lazily as an iterator over consecutive strings of piece_size
+    characters (the last one can be shorter), without the line breaks.
+    The pieces of a record must be consumed before moving to the next
+    record.
+
+    Parameters
+    ----------
+    filename : string
+        The path of the FASTA file (only local files can be memory
+        mapped).
+
+    piece_size : int (default 2^20)
+        The number of characters of each piece of sequence.
+
+    Returns
+    -------
+    records : iterator over pairs (header, pieces)
+        The header is the line after '>', pieces an iterator over strings.
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # the lines before the first header are skipped
+            start = 0 if data[:1] == b'>' else data.find(b'\n>') + 1
+            if start == 0 and data[:1] != b'>':
+                return
+            while True:
+                header_end = data.find(b'\n', start)
+                if header_end < 0:
+                    header_end = len(data)
+                header = data[start + 1:header_end].decode().strip()
+                end = data.find(b'\n>', header_end)
+                end = len(data) if end < 0 else end + 1
+                yield header, _pieces(data, header_end + 1, end, piece_size)
+                if end >= len(data):
+                    break
+                start = end
+        finally:
+            data.close()
+
+
+# -------------------------------------------------------------------
+
+def _pieces(data, start, end, piece_size):
+    # the characters of data[start:end], except the white space, in
+    # strings of piece_size characters
+    buffered, n_buffered = [], 0
+    for offset in range(start, end, piece_size):
+        chunk = data[offset:min(offset + piece_size, end)]
+        buffered.append(chunk.translate(None, b' \t\r\n').decode())
+        n_buffered += len(buffered[-1])
+        if n_buffered >= piece_size:
+            text = ''.join(buffered)
+            n_pieces = len(text) // piece_size
+            for i in range(n_pieces):
+                yield text[i * piece_size:(i + 1) * piece_size]
+            buffered = [text[n_pieces * piece_size:]]
+            n_buffered = len(buffered[0])
+    text = ''.join(buffered)
+    if text:
+        yield text
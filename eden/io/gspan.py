@@ -79,7 +79,7 @@ def gspan_to_networkx(header, lines):
             attribute_str = ' '.join(tokens[3:])
             if attribute_str.strip():
                 attribute_dict = json.loads(attribute_str)
-                graph.node[id].update(attribute_dict)
+                graph.nodes[id].update(attribute_dict)
         # process edges
         elif fc == 'e':
             src = int(tokens[1])
@@ -89,7 +89,7 @@ def gspan_to_networkx(header, lines):
             attribute_str = ' '.join(tokens[4:])
             if attribute_str.strip():
                 attribute_dict = json.loads(attribute_str)
-                graph.edge[src, dst].update(attribute_dict)
+                graph.edges[src, dst].update(attribute_dict)
         else:
             logger.debug('line begins with unrecognized code: %s' % fc)
     if graph.number_of_nodes() == 0:
@@ -110,8 +110,8 @@ def eden_to_gspan(graphs, filename):
         for i, graph in enumerate(graphs):
             f.write('t #  %s\n' % i)
 
-            for node, data in graph.nodes_iter(data=True):
+            for node, data in graph.nodes(data=True):
                 f.write('v %s %s\n' % (node, data['label']))
 
-            for src, dst, data in graph.edges_iter(data=True):
+            for src, dst, data in graph.edges(data=True):
                 f.write('e %s %s %s\n' % (src, dst, data['label']))
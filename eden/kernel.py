@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Provides the tiled computation of large linear kernel matrices.
+
+The kernel matrix K = X Y^T between the rows of two sparse data matrices is
+computed one tile of tile_size x tile_size entries at a time, so that the
+peak memory does not depend on the number of instances. The row blocks of
+the result can be computed by a pool of worker processes. The result is
+either a dense array (optionally memory-mapped on a file) or a sparse
+matrix that keeps only the entries above a threshold and/or the k largest
+entries of each row.
+
+>>> import numpy as np
+>>> from scipy.sparse import random
+>>> x = random(50, 30, density=0.2, format='csr', random_state=1)
+>>> k = block_kernel_matrix(x, tile_size=16)
+>>> bool(np.allclose(k, x.dot(x.T).toarray()))
+True
+>>> k = block_kernel_matrix(x, x[:5], tile_size=16, top_k=2)
+>>> k.shape, int(k.getnnz(axis=1).max())
+((50, 5), 2)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+from eden.util import block_pmap
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def block_kernel_matrix(data_matrix, other_matrix=None,
+                        tile_size=1000,
+                        n_jobs=1,
+                        filename=None,
+                        threshold=None,
+                        top_k=None):
+    """Compute the linear kernel between the rows of two matrices by tiles.
+
+    Parameters
+    ----------
+    data_matrix : sparse matrix, shape = [n_samples, n_features]
+        The instances on the rows of the kernel matrix.
+
+    other_matrix : sparse matrix, shape = [n_others, n_features]
+        The instances on the columns of the kernel matrix (e.g. a database
+        that is queried with data_matrix). If None, data_matrix is used.
+
+    tile_size : int (default 1000)
+        The number of rows and columns of a tile. The memory used by each
+        process for the tiles is about 8 * tile_size * tile_size bytes.
+        The dense output without a file is computed in blocks of
+        tile_size rows, i.e. 8 * tile_size * n_others bytes per process,
+        which grows with other_matrix, and is then copied in the output;
+        with a file the tiles are written directly in it.
+
+    n_jobs : int (default 1)
+        The number of worker processes. If -1 all available cores are
+        used.
+
+    filename : string (default None)
+        If given, the dense kernel matrix is written in a memory-mapped
+        file of float64, that is returned as a numpy.memmap.
+
+    threshold : float (default None)
+        If given, only the entries greater or equal than the threshold are
+        kept and a sparse matrix is returned. With a threshold <= 0 the
+        zero entries are kept too, as explicit zeros: the sparse matrix
+        is then as large as the dense output (or larger), and top_k or
+        the dense output are preferable.
+
+    top_k : int (default None)
+        If given, only the top_k largest non zero entries of each row are
+        kept and a sparse matrix is returned.
+
+    Returns
+    -------
+    kernel_matrix : array or csr_matrix, shape = [n_samples, n_others]
+    """
+    data_matrix = csr_matrix(data_matrix)
+    if other_matrix is None:
+        other_matrix = data_matrix
+    other_matrix = csr_matrix(other_matrix)
+    if data_matrix.shape[1] != other_matrix.shape[1]:
+        raise Exception('ERROR: the matrices have %d and %d features' %
+                        (data_matrix.shape[1], other_matrix.shape[1]))
+    sparse_output = threshold is not None or top_k is not None
+    if sparse_output and filename is not None:
+        raise Exception('ERROR: filename is used only for dense output.')
+    shape = (data_matrix.shape[0], other_matrix.shape[0])
+    if filename is not None:
+        # allocate the file, the workers write their rows in it
+        np.memmap(filename, dtype=np.float64, mode='w+', shape=shape).flush()
+    task = _KernelTask(data_matrix, other_matrix, tile_size,
+                       filename, threshold, top_k)
+    starts = range(0, shape[0], tile_size)
+    if n_jobs == 1:
+        blocks = (task.compute(start) for start in starts)
+    else:
+        blocks = (block[0] for block in
+                  block_pmap(_compute_row_block, task, starts,
+                             n_jobs=n_jobs, block_size=1))
+    if sparse_output:
+        blocks = list(blocks)
+        if len(blocks) == 0:
+            return csr_matrix(shape)
+        return vstack(blocks, format='csr')
+    if filename is not None:
+        for block in blocks:
+            pass
+        return np.memmap(filename, dtype=np.float64, mode='r+', shape=shape)
+    kernel_matrix = np.empty(shape)
+    for start, block in zip(starts, blocks):
+        kernel_matrix[start:start + block.shape[0]] = block
+    return kernel_matrix
+
+
+class _KernelTask(object):
+    """The computation of one block of rows of the kernel matrix."""
+
+    def __init__(self, data_matrix, other_matrix, tile_size,
+                 filename, threshold, top_k):
+        self.data_matrix = data_matrix
+        self.other_matrix = other_matrix
+        self.tile_size = tile_size
+        self.filename = filename
+        self.threshold = threshold
+        self.top_k = top_k
+
+    def compute(self, start):
+        rows = self.data_matrix[start:start + self.tile_size]
+        n_rows, n_others = rows.shape[0], self.other_matrix.shape[0]
+        if self.threshold is None and self.top_k is None:
+            return self._dense(start, rows)
+        # keep the selected entries of each tile, and the top_k of the
+        # entries seen so far
+        row_ids, col_ids, values = [np.zeros(0, dtype=np.int64)] * 2 + \
+            [np.zeros(0)]
+        for col_start in range(0, n_others, self.tile_size):
+            tile = self._tile(rows, col_start)
+            if self.threshold is not None:
+                tile_rows, tile_cols = np.nonzero(tile >= self.threshold)
+            else:
+                tile_rows, tile_cols = np.nonzero(tile)
+            row_ids = np.concatenate((row_ids, tile_rows))
+            col_ids = np.concatenate((col_ids, tile_cols + col_start))
+            values = np.concatenate((values, tile[tile_rows, tile_cols]))
+            if self.top_k is not None:
+                row_ids, col_ids, values = _top_k(row_ids, col_ids, values,
+                                                  self.top_k)
+        return csr_matrix((values, (row_ids, col_ids)),
+                          shape=(n_rows, n_others))
+
+    def _dense(self, start, rows):
+        n_rows, n_others = rows.shape[0], self.other_matrix.shape[0]
+        if self.filename is not None:
+            output = np.memmap(self.filename, dtype=np.float64, mode='r+',
+                               shape=(self.data_matrix.shape[0], n_others))
+            block = output[start:start + n_rows]
+        else:
+            block = np.empty((n_rows, n_others))
+        for col_start in range(0, n_others, self.tile_size):
+            tile = self._tile(rows, col_start)
+            block[:, col_start:col_start + tile.shape[1]] = tile
+        if self.filename is not None:
+            output.flush()
+            return None
+        return block
+
+    def _tile(self, rows, col_start):
+        cols = self.other_matrix[col_start:col_start + self.tile_size]
+        return rows.dot(cols.T).toarray()
+
+
+def _compute_row_block(task, starts):
+    return [task.compute(start) for start in starts]
+
+
+def _top_k(row_ids, col_ids, values, k):
+    # keep the k largest values of each row (ties broken by column)
+    order = np.lexsort((col_ids, -values, row_ids))
+    row_ids, col_ids, values = row_ids[order], col_ids[order], values[order]
+    starts = np.searchsorted(row_ids, row_ids, side='left')
+    rank = np.arange(len(row_ids)) - starts
+    selected = rank < k
+    return row_ids[selected], col_ids[selected], values[selected]
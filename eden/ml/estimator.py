@@ -7,19 +7,20 @@ from __future__ import print_function
 
 import numpy as np
 from eden.graph import Vectorizer
-from eden.util import timeit
+from eden.kernel import block_kernel_matrix
+from eden.util import timeit, block_pmap
 from sklearn.base import BaseEstimator, ClassifierMixin, RegressorMixin
 from sklearn.linear_model import SGDClassifier
 from sklearn.linear_model import SGDRegressor
 from sklearn.linear_model import Perceptron
 from sklearn.cluster import MiniBatchKMeans
-from sklearn import metrics
 from sklearn.model_selection import learning_curve
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
 import multiprocessing as mp
 from eden.ml.estimator_utils import balance, subsample, paired_shuffle
 import random
+from toolz import concat
 import logging
 
 logger = logging.getLogger()
@@ -71,10 +72,16 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
         return x
 
     @timeit
-    def kernel_matrix(self, graphs):
-        """kernel_matrix."""
+    def kernel_matrix(self, graphs, other_graphs=None, **opts):
+        """kernel_matrix.
+
+        The options are passed to eden.kernel.block_kernel_matrix.
+        """
         x = self.transform(graphs)
-        return metrics.pairwise.pairwise_kernels(x, metric='linear')
+        y = None
+        if other_graphs is not None:
+            y = self.transform(other_graphs)
+        return block_kernel_matrix(x, y, **opts)
 
     def fit(self, graphs, targets, randomize=True):
         """fit."""
@@ -137,19 +144,30 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
 
     @timeit
     def model_selection(self, graphs, targets,
-                        n_iter=30, subsample_size=None):
-        """model_selection_randomized."""
+                        n_iter=30, subsample_size=None, single_pass=True):
+        """model_selection_randomized.
+
+        If single_pass is True the graphs are vectorized only once, with
+        the largest r and d, and the data matrix of each sampled
+        configuration is assembled from the features kept separated by
+        (radius, distance) (see eden.graph.Vectorizer.transform_blocks).
+        """
         param_distr = {"r": list(range(1, 5)), "d": list(range(0, 10))}
         if subsample_size:
             graphs, targets = subsample(
                 graphs, targets, subsample_size=subsample_size)
 
-        pool = mp.Pool()
-        scores = pool.map(_eval, [(graphs, targets, param_distr)] * n_iter)
-        pool.close()
-        pool.join()
+        if single_pass:
+            scores = _single_pass_scores(graphs, targets, param_distr,
+                                         n_iter)
+        else:
+            pool = mp.Pool()
+            scores = pool.map(_eval,
+                              [(graphs, targets, param_distr)] * n_iter)
+            pool.close()
+            pool.join()
 
-        best_params = max(scores)[1]
+        best_params = max(scores, key=lambda score: score[0])[1]
         logger.debug("Best parameters:\n%s" % (best_params))
         self = EdenEstimator(**best_params)
         return self
@@ -223,10 +241,16 @@ class EdenRegressor(BaseEstimator, RegressorMixin):
         return x
 
     @timeit
-    def kernel_matrix(self, graphs):
-        """kernel_matrix."""
+    def kernel_matrix(self, graphs, other_graphs=None, **opts):
+        """kernel_matrix.
+
+        The options are passed to eden.kernel.block_kernel_matrix.
+        """
         x = self.transform(graphs)
-        return metrics.pairwise.pairwise_kernels(x, metric='linear')
+        y = None
+        if other_graphs is not None:
+            y = self.transform(other_graphs)
+        return block_kernel_matrix(x, y, **opts)
 
     def fit(self, graphs, targets, randomize=True):
         """fit."""
@@ -265,3 +289,26 @@ def _eval_params(graphs, targets, param_distr):
 
 def _eval(data):
     return _eval_params(*data)
+
+
+def _single_pass_scores(graphs, targets, param_distr, n_iter):
+    # vectorize once with the largest parameters, then evaluate the
+    # sampled configurations in parallel on the assembled matrices
+    largest = dict((key, max(values)) for key, values in param_distr.items())
+    feature_blocks = EdenEstimator(**largest).vectorizer.transform_blocks(
+        graphs)
+    params_list = [_sample_params(param_distr) for i in range(n_iter)]
+    return list(concat(block_pmap(_eval_feature_blocks,
+                                  (feature_blocks, np.asarray(targets)),
+                                  params_list, n_jobs=-1, block_size=1)))
+
+
+def _eval_feature_blocks(data, params_list):
+    feature_blocks, targets = data
+    scores = []
+    for params in params_list:
+        est = EdenEstimator(**params)
+        x = est.vectorizer.assemble(feature_blocks)
+        scores.append((np.mean(cross_val_score(
+            est.model, x, targets, cv=5, scoring='roc_auc')), params))
+    return scores
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""Provides per-stage timers and counters for the vectorizer pipelines.
+
+A PipelineStats object accumulates the time spent in each stage of a
+pipeline, the number of times each stage was run, and a set of counters.
+The vectorizers own one in their stats attribute, that records only when
+they are built with profile=True, so that the instrumentation costs
+nothing otherwise. The stats of worker processes are merged in the stats
+of the parent.
+
+A Watchdog times each instance, records the slow ones and can skip or
+degrade the instances that exceed a time or ring size budget.
+
+>>> stats = PipelineStats()
+>>> with stats.stage('ring_index'):
+...     stats.count('bfs_visited', 10)
+>>> other = PipelineStats()
+>>> other.count('bfs_visited', 5)
+>>> stats.merge(other)
+>>> stats.as_dict()['counters']
+{'bfs_visited': 15}
+>>> stats.as_dict()['stages']['ring_index']['calls']
+1
+>>> print(other.to_prometheus())
+# TYPE eden_bfs_visited_total counter
+eden_bfs_visited_total 5
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import json
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PipelineStats(object):
+    """Cumulative time and calls per stage, and counters.
+
+    Parameters
+    ----------
+    enabled : bool (default True)
+        If False, stage and count do nothing.
+    """
+
+    def __init__(self, enabled=True):
+        """Constructor."""
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Set all times and counters to zero."""
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    def stage(self, name):
+        """Return a context manager that times a run of the stage."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._timed_stage(name)
+
+    @contextmanager
+    def _timed_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        """Add seconds and calls to the stage."""
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, value=1):
+        """Add value to the counter."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def merge(self, other):
+        """Add the times and counters of other (stats or dict) to these."""
+        if isinstance(other, PipelineStats):
+            other = other.as_dict()
+        for name, stage in other['stages'].items():
+            self.add_time(name, stage['seconds'], stage['calls'])
+        for name, value in other['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """Return the times and counters as a dict.
+
+        The dict has the keys 'stages', with the seconds and calls of each
+        stage, and 'counters'.
+        """
+        stages = dict((name, dict(seconds=self.seconds[name],
+                                  calls=self.calls[name]))
+                      for name in self.seconds)
+        return dict(stages=stages, counters=dict(self.counters))
+
+    def to_json(self, **kwargs):
+        """Return the dict of as_dict as a json string."""
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+    def to_prometheus(self, prefix='eden', labels=None):
+        """Return the stats in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix : string (default 'eden')
+            The prefix of the metric names.
+
+        labels : dict (default None)
+            Labels added to all the samples, e.g. dict(dataset='train').
+        """
+        labels = labels or {}
+        lines = []
+        if self.seconds:
+            for metric, values in (('stage_seconds_total', self.seconds),
+                                   ('stage_calls_total', self.calls)):
+                lines.append('# TYPE %s_%s counter' % (prefix, metric))
+                for name in sorted(values):
+                    lines.append('%s_%s%s %r' % (
+                        prefix, metric,
+                        _format_labels(dict(labels, stage=name)),
+                        values[name]))
+        for name in sorted(self.counters):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total%s %d' % (prefix, name,
+                                               _format_labels(labels),
+                                               self.counters[name]))
+        return '\n'.join(lines)
+
+
+class Watchdog(object):
+    """Record the instances that are slow to vectorize, and enforce budgets.
+
+    Each instance vectorized by a vectorizer with a watchdog is timed. The
+    instances that take more than threshold seconds, or that exceed a
+    budget, are recorded in the list records and logged as a warning with
+    their index (the number of instances vectorized with the watchdog
+    before them), id, numbers of nodes and edges, largest ring size at each
+    distance, time of each stage and action. The index counts only the
+    graphs that are actually vectorized, i.e. not those found in a cache.
+
+    Parameters
+    ----------
+    threshold : float (default 1.0)
+        The instances that take more than threshold seconds are recorded.
+
+    time_budget : float (default None)
+        If the preprocessing of an instance is not completed within
+        time_budget seconds, the instance is skipped or degraded. The
+        budget is checked between the stages, a running stage is not
+        interrupted.
+
+    max_ring_size : int (default None)
+        If at some distance a vertex has more than max_ring_size vertices,
+        the instance is skipped or degraded before its neighborhoods are
+        hashed.
+
+    on_budget : string (default 'skip')
+        With 'skip' the feature vector of an instance over budget is
+        empty. With 'degrade' the instance is vectorized with the minimal
+        radius and distance (min_r, min_d) of the vectorizer.
+
+    dump_dir : string (default None)
+        If not None each recorded instance is written in this directory,
+        in the file instance_<index>.json or instance_<index>.gspan.
+
+    dump_format : string (default 'node_link')
+        The format of the dumped instances: 'node_link' or 'gspan'.
+    """
+
+    def __init__(self,
+                 threshold=1.0,
+                 time_budget=None,
+                 max_ring_size=None,
+                 on_budget='skip',
+                 dump_dir=None,
+                 dump_format='node_link'):
+        """Constructor."""
+        if on_budget not in ('skip', 'degrade'):
+            raise Exception('ERROR: unknown on_budget action: %s' %
+                            on_budget)
+        if dump_format not in _DUMP_EXTENSIONS:
+            raise Exception('ERROR: unknown dump format: %s' % dump_format)
+        self.threshold = threshold
+        self.time_budget = time_budget
+        self.max_ring_size = max_ring_size
+        self.on_budget = on_budget
+        self.dump_dir = dump_dir
+        self.dump_format = dump_format
+        # in a worker process the records are sent to the parent, that
+        # logs and dumps them
+        self.deferred = False
+        self.reset()
+        self._start = None
+
+    def reset(self):
+        """Forget the records and restart the index of the instances."""
+        self.records = []
+        self.n_instances = 0
+
+    def start(self):
+        """Start timing an instance."""
+        self._start = time.perf_counter()
+        self._ring_sizes = None
+
+    def check(self, ring_index=None):
+        """Raise BudgetExceeded if the current instance is over budget.
+
+        ring_index is the list of rings of the instance (see
+        eden.graph._ring_index) once it is known. Nothing is checked if no
+        instance is being timed.
+        """
+        if self._start is None:
+            return
+        if ring_index is not None:
+            # the rings of the nodes are at even distances in the edge to
+            # vertex expanded graph
+            self._ring_sizes = [int(np.diff(ring_indptr).max())
+                                for ring_indptr, _ in ring_index[::2]]
+            if self.max_ring_size is not None and \
+                    max(self._ring_sizes) > self.max_ring_size:
+                raise BudgetExceeded('ring size %d > %d' % (
+                    max(self._ring_sizes), self.max_ring_size))
+        seconds = time.perf_counter() - self._start
+        if self.time_budget is not None and seconds > self.time_budget:
+            raise BudgetExceeded('time %.3fs > %.3fs' % (seconds,
+                                                         self.time_budget))
+
+    def stop(self, graph, stats, action=None, reason=None):
+        """Stop timing the instance graph and record it if needed.
+
+        stats are the PipelineStats of the instance, action and reason
+        describe what was done with an instance over budget.
+        """
+        seconds = time.perf_counter() - self._start
+        self._start = None
+        index = self.n_instances
+        self.n_instances += 1
+        if seconds <= self.threshold and action is None:
+            return
+        stages = dict((name, stage['seconds']) for name, stage
+                      in stats.as_dict()['stages'].items())
+        record = dict(index=index,
+                      id=graph.graph.get('id', None),
+                      n_nodes=graph.number_of_nodes(),
+                      n_edges=graph.number_of_edges(),
+                      max_ring_sizes=self._ring_sizes,
+                      seconds=seconds,
+                      stages=stages,
+                      action=action,
+                      reason=reason)
+        if self.dump_dir is not None:
+            record['graph'] = graph
+        self._add(record)
+
+    def as_dict(self):
+        """Return the number of instances and the records as a dict."""
+        return dict(n_instances=self.n_instances, records=list(self.records))
+
+    def merge(self, other):
+        """Add the instances and records of other (watchdog or dict).
+
+        The records of other follow the instances of this watchdog.
+        """
+        if isinstance(other, Watchdog):
+            other = other.as_dict()
+        for record in other['records']:
+            record = dict(record, index=record['index'] + self.n_instances)
+            self._add(record)
+        self.n_instances += other['n_instances']
+
+    def worker_copy(self):
+        """Return an empty watchdog with the same settings and deferred
+        records, for a worker process."""
+        watchdog = copy.copy(self)
+        watchdog.deferred = True
+        watchdog.reset()
+        return watchdog
+
+    def _add(self, record):
+        if not self.deferred:
+            graph = record.pop('graph', None)
+            if graph is not None:
+                record['dump'] = self._dump(graph, record['index'])
+            logger.warning('slow instance: %s' % json.dumps(
+                record, sort_keys=True, default=str))
+        self.records.append(record)
+
+    def _dump(self, graph, index):
+        from eden.io.gspan import eden_to_gspan
+        from eden.io.node_link_data import eden_to_node_link_file
+        filename = os.path.join(
+            self.dump_dir,
+            'instance_%d%s' % (index, _DUMP_EXTENSIONS[self.dump_format]))
+        try:
+            if self.dump_format == 'gspan':
+                eden_to_gspan([graph], filename)
+            else:
+                eden_to_node_link_file([graph], filename)
+        except Exception as e:
+            logger.warning('could not write %s: %s' % (filename, e))
+            return None
+        return filename
+
+
+class BudgetExceeded(Exception):
+    """Raised by Watchdog.check when an instance is over budget."""
+
+
+# -------------------------------------------------------------------
+
+_DUMP_EXTENSIONS = {'node_link': '.json', 'gspan': '.gspan'}
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key in sorted(labels))
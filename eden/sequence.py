@@ -5,12 +5,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
+import copy
 import numpy as np
-import math
-from scipy.sparse import csr_matrix
-from eden import fast_hash_vec, fast_hash_2, fast_hash_4
+from scipy.sparse import vstack
 from eden import AbstractVectorizer
+from eden import FeatureAccumulator
+from eden import _sort_order
+from eden.hashing import get_hasher, hash_tuples, hash_windows
+from eden.hashing import hash_symbol_windows, hash_kmers
+from eden.profiling import PipelineStats
+from eden.util import block_pmap
+from toolz import partition_all
 
 import logging
 
@@ -65,7 +70,13 @@ class Vectorizer(AbstractVectorizer):
                  auto_weights=False,
                  nbits=20,
                  normalization=True,
-                 inner_normalization=True):
+                 inner_normalization=True,
+                 hashing='python',
+                 alphabet=None,
+                 collisions='last',
+                 profile=False,
+                 n_jobs=1,
+                 block_size=100):
         """Constructor.
 
         Parameters
@@ -106,6 +117,47 @@ class Vectorizer(AbstractVectorizer):
             radius and distance size to have unit euclidean norm.
             When used together with the 'normalization' flag it will be applied
             first and then the resulting feature vector will be normalized.
+
+        hashing : string (default 'python')
+            The backend used to hash the characters. With 'python' the
+            builtin hash function is used and the feature ids depend on
+            PYTHONHASHSEED. With 'stable' the feature ids are reproducible
+            across processes and machines (see eden.hashing).
+
+        alphabet : string (default None)
+            The characters of the sequences, e.g. 'ACGU' or 'ACGTN'. With
+            an alphabet of at most 16 characters the sequences are encoded
+            as arrays of one byte indices, and the hashes of the kmers are
+            read from tables with one entry per kmer of the alphabet
+            instead of being computed at each position (see
+            eden.hashing.hash_symbol_windows). The features are the same
+            as without alphabet: the sequences with other characters, and
+            the kmers too long for a table, are hashed as usual.
+
+        collisions : string (default 'last')
+            How the values of a feature id that is generated by several
+            (radius, distance) blocks of a sequence (a hash collision) are
+            merged. With 'last' the feature takes the value of the last
+            block, in the order in which the blocks are first generated
+            along the sequence, as in previous versions. With 'sum' the
+            values of the blocks are summed.
+
+        profile : bool (default False)
+            If True the time spent in each stage of the vectorization and
+            the number of sequences, positions, emitted features and merged
+            duplicate features are recorded in the attribute stats, a
+            PipelineStats (see eden.profiling).
+
+        n_jobs : int (default 1)
+            The number of worker processes used by transform,
+            transform_iter, predict and similarity. If 1 the sequences are
+            processed in the current process. If -1 all available cores
+            are used. With hashing='python' the workers must share the
+            hash seed of the parent process (see eden.graph.Vectorizer).
+
+        block_size : int (default 100)
+            The number of sequences that are vectorized, and scored by
+            predict and similarity, at once.
         """
         if complexity is not None:
             self.r = complexity
@@ -123,6 +175,13 @@ class Vectorizer(AbstractVectorizer):
         self.inner_normalization = inner_normalization
         self.bitmask = pow(2, nbits) - 1
         self.feature_size = self.bitmask + 2
+        self.hashing = hashing
+        self.alphabet = alphabet
+        self.collisions = collisions
+        self.profile = profile
+        self.stats = PipelineStats(enabled=profile)
+        self.n_jobs = n_jobs
+        self.block_size = block_size
 
     def set_params(self, **args):
         """Set the parameters of the vectorizer."""
@@ -145,6 +204,19 @@ class Vectorizer(AbstractVectorizer):
             self.normalization = args['normalization']
         if args.get('inner_normalization', None) is not None:
             self.inner_normalization = args['inner_normalization']
+        if args.get('hashing', None) is not None:
+            self.hashing = args['hashing']
+        if args.get('alphabet', None) is not None:
+            self.alphabet = args['alphabet']
+        if args.get('collisions', None) is not None:
+            self.collisions = args['collisions']
+        if args.get('profile', None) is not None:
+            self.profile = args['profile']
+            self.stats.enabled = self.profile
+        if args.get('n_jobs', None) is not None:
+            self.n_jobs = args['n_jobs']
+        if args.get('block_size', None) is not None:
+            self.block_size = args['block_size']
 
     def __repr__(self):
         """Pretty print of vectorizer parameters."""
@@ -168,22 +240,72 @@ class Vectorizer(AbstractVectorizer):
                   list of id, seq tuples or
                   list of id, seq, list of weight tuples
         """
-        feature_rows = []
-        for seq in seq_list:
-            feature_rows.append(self._transform(seq))
-        return self._convert_dict_to_sparse_matrix(feature_rows)
+        if self.n_jobs != 1:
+            blocks = list(self.transform_iter(seq_list))
+            if len(blocks) == 0:
+                raise Exception('ERROR: something went wrong, '
+                                'empty features.')
+            return vstack(blocks, format='csr')
+        return self._transform_features(seq_list)
+
+    def _transform_features(self, seq_list):
+        features = FeatureAccumulator()
+        n_rows = 0
+        seqs = (self._get_sequence_and_weights(seq) for seq in seq_list)
+        for batch in _batches(seqs):
+            features.row = n_rows
+            self._transform(batch, features)
+            n_rows += len(batch)
+        return self._to_csr(features, n_rows,
+                            inner_normalization=self.inner_normalization,
+                            normalization=self.normalization)
+
+    def transform_iter(self, seq_list, block_size=None,
+                       return_offsets=False):
+        """Transform a stream of sequences into a stream of matrices.
+
+        The sequences are consumed lazily and the feature vectors are
+        yielded in sparse matrices of block_size rows (the last one can be
+        shorter), in the order of the input. If n_jobs is not 1 the blocks
+        are vectorized by worker processes.
+
+        Parameters
+        ----------
+        seq_list: iterator over sequence strings or
+                  id, seq tuples or
+                  id, seq, list of weight tuples
 
-    def _convert_dict_to_sparse_matrix(self, feature_rows):
-        if len(feature_rows) == 0:
+        block_size : int (default None)
+            The number of sequences in each block. If None, the block_size
+            of the vectorizer is used.
+
+        return_offsets : bool (default False)
+            If True yield pairs (offset, data_matrix) where offset is the
+            position in the input of the sequence in the first row.
+
+        >>> seqs = ('ACGU' * i for i in range(1, 6))
+        >>> v = Vectorizer()
+        >>> [x.shape[0] for x in v.transform_iter(seqs, block_size=2)]
+        [2, 2, 1]
+        """
+        offset = 0
+        for data_matrix in self._map_blocks(_transform_block, seq_list,
+                                            block_size):
+            if return_offsets:
+                yield offset, data_matrix
+            else:
+                yield data_matrix
+            offset += data_matrix.shape[0]
+
+    def _to_csr(self, features, n_rows,
+                inner_normalization=False, normalization=False):
+        if n_rows == 0:
             raise Exception('ERROR: something went wrong, empty features.')
-        data, row, col = [], [], []
-        for i, feature_row in enumerate(feature_rows):
-            for feature in feature_row:
-                row.append(i)
-                col.append(feature)
-                data.append(feature_row[feature])
-        shape = (max(row) + 1, self.feature_size)
-        return csr_matrix((data, (row, col)), shape=shape)
+        return features.to_csr(n_rows, self.feature_size,
+                               inner_normalization=inner_normalization,
+                               normalization=normalization,
+                               collisions=self.collisions,
+                               stats=self.stats)
 
     def _get_sequence_and_weights(self, seq):
         if seq is None or len(seq) == 0:
@@ -201,141 +323,445 @@ class Vectorizer(AbstractVectorizer):
             raise Exception('ERROR: something went wrong,\
              unrecognized input type for: %s' % seq)
 
-    def _transform(self, orig_seq):
-        seq, weights = self._get_sequence_and_weights(orig_seq)
-        # extract kmer hash codes for all kmers up to r in all positions in seq
-        seq_len = len(seq)
-        neigh_hash_cache = [self._compute_neighborhood_hash(seq, pos)
-                            for pos in range(seq_len)]
-        neighborhood_weight_cache = None
-        if weights:
-            if len(weights) != seq_len:
-                raise Exception('ERROR: sequence and weights \
-                    must be same length.')
-            neighborhood_weight_cache = \
-                [self._compute_neighborhood_weight(weights, pos)
-                 for pos in range(seq_len)]
+    def _transform(self, batch, features):
+        # the (seq, weights) pairs of the batch are vectorized at once in
+        # consecutive rows of the accumulator, from the current row
+        stats = self.stats
+        neighborhoods, neigh_weights, lengths, bounds = \
+            self._hash_batch(batch)
         # construct features as pairs of kmers up to distance d
         # for all radii up to r
-        feature_list = defaultdict(lambda: defaultdict(float))
-        for pos in range(seq_len):
+        n_features = len(features) if stats.enabled else 0
+        with stats.stage('pair_emission'):
+            positions = np.arange(lengths.sum())
+            rows = np.repeat(features.row + np.arange(len(batch)),
+                             lengths).astype(np.int32)
             for radius in range(self.min_r, self.r + 1):
-                if radius < len(neigh_hash_cache[pos]):
-                    self._transform_distance(feature_list,
-                                             pos,
-                                             radius,
-                                             seq_len,
-                                             neigh_hash_cache,
-                                             neighborhood_weight_cache)
-        return self._normalization(
-            feature_list,
-            inner_normalization=self.inner_normalization,
-            normalization=self.normalization)
-
-    def _transform_distance(self,
-                            feature_list=None,
-                            pos=None,
-                            radius=None,
-                            seq_len=None,
-                            neigh_hash_cache=None,
-                            neighborhood_weight_cache=None):
+                self._emit_pairs(features, radius, positions, rows, bounds,
+                                 neighborhoods, neigh_weights)
+        if stats.enabled:
+            stats.count('features_emitted', len(features) - n_features)
+
+    def _hash_batch(self, batch):
+        # the sequences of the batch are concatenated: return the
+        # neighborhoods (see _neighborhoods) and the weights, or None, of
+        # the kmers up to r at all their positions, the lengths of the
+        # sequences and the bounds of the sequence of each position
+        stats = self.stats
+        lengths = np.array([len(seq) for seq, weights in batch])
+        stats.count('sequences', len(batch))
+        stats.count('positions', lengths.sum())
+        # extract kmer hash codes for all kmers up to r in all positions
+        with stats.stage('label_hashing'):
+            codes = self._encode([seq for seq, weights in batch])
+        with stats.stage('neighborhood_hashing'):
+            neighborhoods = self._neighborhoods(codes)
+        neigh_weights = None
+        if batch[0][1]:
+            for seq, weights in batch:
+                if len(weights) != len(seq):
+                    raise Exception('ERROR: sequence and weights \
+                        must be same length.')
+            with stats.stage('weight_preprocessing'):
+                neigh_weights = self._compute_neighborhood_weights(
+                    np.concatenate([weights for seq, weights in batch]))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        bounds = (np.repeat(offsets[:-1], lengths),
+                  np.repeat(offsets[1:], lengths))
+        return neighborhoods, neigh_weights, lengths, bounds
+
+    def _encode(self, seqs):
+        # the concatenated sequences as an array of indices in the
+        # alphabet if they only have characters of the alphabet, as the
+        # items hashed by the backend otherwise
+        symbols = [self._symbols(seq) for seq in seqs]
+        if all(part is not None for part in symbols):
+            return np.concatenate(symbols) if len(symbols) > 1 \
+                else symbols[0]
+        hasher = get_hasher(self.hashing)
+        return _concatenate([hasher.encode(seq) for seq in seqs])
+
+    def _symbols(self, seq):
+        # the indices in the alphabet of the characters of seq, or None
+        if self.alphabet is None or len(self.alphabet) > _MAX_ALPHABET_SIZE:
+            return None
+        try:
+            chars = np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)
+            lookup = _symbol_lookup(self.alphabet)
+        except UnicodeEncodeError:
+            return None
+        symbols = lookup[chars]
+        if len(symbols) > 0 and symbols.max() == _NO_SYMBOL:
+            return None
+        return symbols
+
+    def _join(self, codes, other_codes):
+        # the concatenation of two encoded sequences
+        if isinstance(codes, np.ndarray) and \
+                isinstance(other_codes, np.ndarray):
+            return np.concatenate((codes, other_codes))
+        return _concatenate([self._items(codes), self._items(other_codes)])
+
+    def _items(self, codes):
+        # the items hashed by the backend of encoded characters
+        if not isinstance(codes, np.ndarray):
+            return codes
+        chars = np.frombuffer(self.alphabet.encode('latin-1'),
+                              dtype=np.uint8)[codes]
+        return get_hasher(self.hashing).encode(
+            chars.tobytes().decode('latin-1'))
+
+    def _neighborhoods(self, codes):
+        # the pair (neigh_hashes, kmer_codes) for the kmers up to r at all
+        # positions of the codes: the hashes of the kmers, and for the
+        # encoded sequences the kmers as integers in base the size of the
+        # alphabet, up to the size whose pair features fit in a table
+        # (see _pair_table); neigh_hashes is None if all the kmers fit
+        if not isinstance(codes, np.ndarray):
+            return hash_windows(codes, self.r + 1, self.bitmask), None
+        n_codes = 0
+        while n_codes <= self.r and \
+                len(self.alphabet) ** (2 * n_codes + 2) * (self.d + 1) <= \
+                _MAX_PAIR_TABLE_SIZE:
+            n_codes += 1
+        kmer_codes = None
+        if n_codes > 0:
+            kmer_codes = _kmer_codes(codes, len(self.alphabet), n_codes)
+        if n_codes > self.r:
+            return None, kmer_codes
+        alphabet = get_hasher(self.hashing).encode(self.alphabet)
+        neigh_hashes = hash_symbol_windows(codes, alphabet, self.r + 1,
+                                           self.bitmask)
+        return neigh_hashes, kmer_codes
+
+    def _pair_table(self, radius):
+        # the feature codes of the pairs of kmers of size radius + 1 over
+        # the alphabet, at each distance up to d, indexed by the distance
+        # and by the codes of the kmers
+        key = (self.hashing, self.alphabet, radius, self.d, self.bitmask)
+        table = _pair_tables.get(key, None)
+        if table is None:
+            alphabet = get_hasher(self.hashing).encode(self.alphabet)
+            kmer_hashes = hash_kmers(alphabet, radius + 1, self.bitmask)
+            n_kmers = len(kmer_hashes)
+            first = np.repeat(kmer_hashes, n_kmers)
+            second = np.tile(kmer_hashes, n_kmers)
+            table = np.stack([hash_tuples([first, second,
+                                           np.full(len(first), radius),
+                                           np.full(len(first), distance)],
+                                          self.bitmask)
+                              for distance in range(self.d + 1)])
+            table = table.reshape(self.d + 1, n_kmers, n_kmers)
+            _pair_tables[key] = table
+        return table
+
+    def _distances(self):
         distances = list(range(self.min_d, self.d + 1))
         distances += list(range(-self.d, -self.min_d))
-        for distance in distances:
-            end = pos + distance
-            # Note: after having computed pos, we now treat
-            # distance as the positive value only
-            distance = abs(distance)
-            cond1 = self.weights_dict is None
-            if cond1 or self.weights_dict.get((radius, distance), 0) != 0:
-                if end >= 0 and end + radius < seq_len:
-                    pfeat = neigh_hash_cache[pos][radius]
-                    efeat = neigh_hash_cache[end][radius]
-                    feature_code = fast_hash_4(pfeat,
-                                               efeat,
-                                               radius,
-                                               distance,
-                                               self.bitmask)
-                    key = fast_hash_2(radius, distance, self.bitmask)
-                    if neighborhood_weight_cache:
-                        pw = neighborhood_weight_cache[pos][radius]
-                        feature_list[key][feature_code] += pw
-                        ew = neighborhood_weight_cache[end][radius]
-                        feature_list[key][feature_code] += ew
-                    else:
-                        feature_list[key][feature_code] += 1
-
-    def _normalization(self, feature_list,
-                       inner_normalization=False, normalization=False):
-        # inner normalization per radius-distance
-        feature_vector = {}
-        for features in feature_list.values():
-            norm = 0
-            for count in features.values():
-                norm += count * count
-            sqrt_norm = math.sqrt(norm)
-            for feature, count in features.items():
-                feature_vector_key = feature
-                if inner_normalization:
-                    feature_vector_value = float(count) / sqrt_norm
-                else:
-                    feature_vector_value = count
-                feature_vector[feature_vector_key] = feature_vector_value
-        # global normalization
-        if normalization:
-            normalized_feature_vector = {}
-            total_norm = 0.0
-            for feature, value in feature_vector.items():
-                total_norm += value * value
-            sqrt_total_norm = math.sqrt(float(total_norm))
-            for feature, value in feature_vector.items():
-                normalized_feature_vector[feature] = value / sqrt_total_norm
-            return normalized_feature_vector
-        else:
-            return feature_vector
+        return distances
+
+    def _emit_pairs(self, features, radius, starts, rows, bounds,
+                    neighborhoods, neigh_weights=None):
+        # the features of the pairs of kmers of size radius + 1 where the
+        # first kmer starts in one of the positions starts, in the given
+        # rows of the accumulator
+        pairs = self._pairs(radius, starts, bounds, neighborhoods)
+        if pairs is None:
+            return
+        index, end, distance, feature_code = pairs
+        pos, rows = starts[index], rows[index]
+        # one block per distance
+        block_distances = np.flatnonzero(np.bincount(distance))
+        lookup = np.zeros(self.d + 1, dtype=np.int64)
+        lookup[block_distances] = np.arange(len(block_distances))
+        blocks = lookup[distance]
+        keys = [(radius, block_distance)
+                for block_distance in block_distances.tolist()]
+        if neigh_weights is None:
+            features.extend_blocks(keys, blocks, feature_code, 1, rows=rows)
+            return
+        # the feature is counted with the weight of each kmer
+        values = np.stack([neigh_weights[pos, radius],
+                           neigh_weights[end, radius]], axis=1).ravel()
+        features.extend_blocks(keys, np.repeat(blocks, 2),
+                               np.repeat(feature_code, 2), values,
+                               rows=np.repeat(rows, 2))
 
-    def _compute_neighborhood_hash(self, seq, pos):
-        subseq = seq[pos:pos + self.r + 1]
-        return fast_hash_vec(subseq, self.bitmask)
+    def _pairs(self, radius, starts, bounds, neighborhoods):
+        # the pairs of kmers of size radius + 1 where the first kmer starts
+        # in one of the positions starts; the kmers of position i must lie
+        # in [bounds[0][i], bounds[1][i]); all the (start, distance) pairs
+        # are hashed at once. Return the indices in starts of the first
+        # kmers, the positions of the second kmers, the distances and the
+        # feature codes, or None if there are no pairs
+        lower, upper = bounds[0][starts], bounds[1][starts]
+        index = np.flatnonzero(starts + radius < upper)
+        distances = self._distances()
+        if self.weights_dict is not None:
+            weights = self.weights_dict
+            distances = [distance for distance in distances
+                         if weights.get((radius, abs(distance)), 0) != 0]
+        if len(index) == 0 or len(distances) == 0:
+            return None
+        distances = np.array(distances, dtype=np.int64)
+        distance = np.tile(distances, len(index))
+        index = np.repeat(index, len(distances))
+        pos = starts[index]
+        end = pos + distance
+        valid = (end >= lower[index]) & (end + radius < upper[index])
+        index, pos, end = index[valid], pos[valid], end[valid]
+        distance = np.abs(distance[valid])
+        neigh_hashes, kmer_codes = neighborhoods
+        if kmer_codes is not None and radius < kmer_codes.shape[1]:
+            # the encoded kmers index a table of the pair features
+            feature_code = self._pair_table(radius)[
+                distance, kmer_codes[pos, radius], kmer_codes[end, radius]]
+        else:
+            feature_code = hash_tuples([neigh_hashes[pos, radius],
+                                        neigh_hashes[end, radius],
+                                        np.full(len(pos), radius),
+                                        distance], self.bitmask)
+        return index, end, distance, feature_code
 
-    def _compute_neighborhood_weight(self, weights, pos):
-        """TODO."""
-        weight_list = []
-        curr_weight = 0
-        for w in weights[pos:pos + self.r + 1]:
-            curr_weight += w
-            weight_list.append(curr_weight)
-        return weight_list
+    def _compute_neighborhood_weights(self, weights):
+        # the sum of the weights of the kmer of size k + 1 that starts at
+        # position i, for all i and k <= r
+        weights = np.asarray(weights, dtype=np.float64)
+        seq_len = len(weights)
+        neigh_weights = np.zeros((seq_len, self.r + 1))
+        running_weight = np.zeros(seq_len)
+        for j in range(min(self.r + 1, seq_len)):
+            running_weight[:seq_len - j] += weights[j:]
+            neigh_weights[:seq_len - j, j] = running_weight[:seq_len - j]
+        return neigh_weights
 
     def predict(self, seqs, estimator):
         """Predict.
 
-        Takes an iterator over graphs and a fit estimator, and returns
-        an iterator over predictions.
+        Takes an iterator over sequences and a fit estimator, and returns
+        an iterator over predictions. The sequences are vectorized and
+        scored in blocks of block_size (in worker processes if n_jobs is
+        not 1), the predictions are yielded lazily in input order.
+
+        >>> from sklearn.linear_model import SGDClassifier
+        >>> vectorizer = Vectorizer(r=1, d=1, block_size=2)
+        >>> seqs = ['GATTACA', 'MATTACA', 'MAULATA', 'BAULATA']
+        >>> estimator = SGDClassifier(random_state=1).fit(
+        ...     vectorizer.transform(seqs), [1, 1, -1, -1])
+        >>> margins = list(vectorizer.predict(seqs, estimator))
+        >>> [bool(margin > 0) for margin in margins]
+        [True, True, False, False]
         """
-        for seq in seqs:
-            if len(seq) == 0:
-                raise Exception('ERROR: something went wrong, empty instance.')
-            # extract feature vector
-            x = self._convert_dict_to_sparse_matrix(self._transform(seq))
-            margins = estimator.decision_function(x)
-            yield margins[0]
+        for margins in self._map_blocks(_predict_block, seqs, None,
+                                        estimator):
+            for margin in margins:
+                yield margin
 
     def similarity(self, seqs, ref_instance=None):
         """Similarity.
 
-        Takes an iterator over graphs and a reference graph, and returns
-        an iterator over similarity evaluations.
+        Takes an iterator over sequences and a reference sequence, and
+        returns an iterator over similarity evaluations. The similarities
+        of each block of block_size sequences are computed with one
+        sparse product (in worker processes if n_jobs is not 1), and are
+        yielded lazily in input order.
+
+        >>> vectorizer = Vectorizer(r=1, d=1)
+        >>> sims = vectorizer.similarity(['GATTACA', 'MAULATA'], 'GATTACA')
+        >>> [round(float(sim), 6) for sim in sims][0]
+        1.0
         """
-        reference_vec = self._convert_dict_to_sparse_matrix(
-            self._transform(ref_instance))
-        for seq in seqs:
-            if len(seq) == 0:
-                raise Exception('ERROR: something went wrong, empty instance.')
-            # extract feature vector
-            x = self._convert_dict_to_sparse_matrix(self._transform(seq))
-            res = reference_vec.dot(x.T).todense()
-            yield res[0, 0]
+        reference_vec = self.transform([ref_instance])
+        for similarities in self._map_blocks(_similarity_block, seqs, None,
+                                             reference_vec):
+            for similarity in similarities:
+                yield similarity
+
+    def _map_blocks(self, func, seqs, block_size, *args):
+        # yield func(vectorizer, block, *args) for the blocks of seqs, in
+        # input order, computed in worker processes if n_jobs is not 1
+        if block_size is None:
+            block_size = self.block_size
+        if self.n_jobs == 1:
+            for block in partition_all(block_size, seqs):
+                yield func(self, list(block), *args)
+            return
+        vectorizer = self
+        if self.stats.enabled:
+            # the stats of the workers are sent back with each result
+            vectorizer = copy.copy(self)
+            vectorizer.stats = PipelineStats()
+        for result, stats in block_pmap(_run_block,
+                                        (func, vectorizer, args), seqs,
+                                        n_jobs=self.n_jobs,
+                                        block_size=block_size):
+            self.stats.merge(stats)
+            yield result
+
+    def scan(self, seq, estimator, window_size=100, stride=1):
+        """Score the windows of a long sequence.
+
+        The windows are the substrings [start, start + window_size) for
+        start = 0, stride, 2 * stride, ... that fit in the sequence (a
+        sequence shorter than window_size gives one window over the whole
+        sequence). The score of a window is the decision function of the
+        linear estimator on the vectorization of the window, as in
+        predict(seq[start:end]), but the neighborhood hashes and the
+        features are computed only once over the sequence: the feature
+        counts, norms and dot products of a window are derived from those
+        of the previous window by adding the features of the kmer pairs
+        that enter it and subtracting those of the pairs that leave it.
+
+        The sequence is consumed in segments, so that the memory used
+        depends on the window size and on nbits, not on the length of the
+        sequence: the sequence can be a string or an iterator over the
+        consecutive pieces of a sequence, e.g. the pieces of a record of
+        eden.io.fasta.load_mmap.
+
+        Parameters
+        ----------
+        seq : string or iterator over strings
+            The sequence, or its consecutive pieces.
+
+        estimator : scikit-learn linear predictor
+            A fitted estimator with the attributes coef_ and intercept_,
+            trained on the vectors of this vectorizer.
+
+        window_size : int (default 100)
+            The length of the windows.
+
+        stride : int (default 1)
+            The offset between the starts of consecutive windows.
+
+        Returns
+        -------
+        records : iterator over triples (start, end, score)
+            The score is a float for binary classifiers and regressors,
+            an array with one score per class otherwise.
+
+        >>> from sklearn.linear_model import SGDClassifier
+        >>> vectorizer = Vectorizer(r=1, d=2)
+        >>> seq = 'GATTACAGATTACACCGGCCGG'
+        >>> estimator = SGDClassifier(random_state=1).fit(
+        ...     vectorizer.transform(['GATTACA', 'CCGGCCGG']), [1, -1])
+        >>> records = list(vectorizer.scan(seq, estimator, window_size=8,
+        ...                                stride=4))
+        >>> [(start, end) for start, end, score in records]
+        [(0, 8), (4, 12), (8, 16), (12, 20)]
+        >>> scores = list(vectorizer.predict(
+        ...     [seq[start:end] for start, end, score in records], estimator))
+        >>> bool(np.allclose([score for _, _, score in records], scores))
+        True
+        """
+        if window_size < 1 or stride < 1:
+            raise Exception('ERROR: window_size and stride must be '
+                            'positive.')
+        block_ids = self._scan_block_ids()
+        scorer = _WindowScorer(self, estimator, int(block_ids.max()) + 1)
+        if isinstance(seq, str):
+            seq = [seq]
+        pieces = iter(seq)
+        # the longest span of a pair of kmers
+        margin = self.r + self.d + 1
+        # codes[pos:] are the codes of the positions from offset on, events
+        # the pending events of the windows from next_window on
+        codes, pos, offset = self._encode(['']), 0, 0
+        events = _no_events()
+        next_window = 0
+        exhausted = False
+        while True:
+            if not exhausted and len(codes) - pos < _SCAN_POSITIONS + margin:
+                codes, pos = codes[pos:], 0
+                while not exhausted and \
+                        len(codes) < _SCAN_POSITIONS + margin:
+                    piece = next(pieces, None)
+                    if piece is None:
+                        exhausted = True
+                    elif len(piece) > 0:
+                        codes = self._join(codes, self._encode([piece]))
+            last = exhausted and len(codes) - pos <= _SCAN_POSITIONS
+            n_segment = len(codes) - pos if last else _SCAN_POSITIONS
+            segment = codes[pos:pos + n_segment + margin]
+            with self.stats.stage('scan_events'):
+                events = _merge_events(events, self._scan_events(
+                    segment, offset, n_segment, block_ids, window_size,
+                    stride))
+            end = offset + n_segment
+            last_window = (end - window_size) // stride
+            if last and next_window == 0 and last_window < 0 and end > 0:
+                # a sequence shorter than the window
+                last_window = 0
+            if last_window >= next_window:
+                n_applied = np.searchsorted(events[0], last_window,
+                                            side='right')
+                applied = [array[:n_applied] for array in events]
+                events = [array[n_applied:] for array in events]
+                with self.stats.stage('scan_scores'):
+                    scores = scorer.scores(applied[0] - next_window,
+                                           applied[1], applied[2],
+                                           applied[3],
+                                           last_window - next_window + 1)
+                self.stats.count('windows', len(scores))
+                for i, score in enumerate(scores):
+                    start = (next_window + i) * stride
+                    yield start, min(start + window_size, end), score
+                next_window = last_window + 1
+            if last:
+                return
+            pos += n_segment
+            offset = end
+
+    def _scan_block_ids(self):
+        # the index of the block (radius, distance) of the features in the
+        # window scores, as a (r + 1) x (d + 1) array
+        block_ids = np.zeros((self.r + 1, self.d + 1), dtype=np.int64)
+        n_blocks = 0
+        for radius in range(self.min_r, self.r + 1):
+            for distance in sorted(set(abs(distance) for distance
+                                       in self._distances())):
+                block_ids[radius, distance] = n_blocks
+                n_blocks += 1
+        return block_ids
+
+    def _scan_events(self, segment, offset, n_segment, block_ids,
+                     window_size, stride):
+        # the pairs of kmers of the segment whose leftmost position is
+        # among its first n_segment positions; a pair that spans the
+        # positions [left, right) is in the windows from k_in, the first
+        # one that ends after right, to k_out - 1, the last one that
+        # starts before left: the pair gives an event that adds its
+        # feature at k_in and one that subtracts it at k_out
+        n_positions = len(segment)
+        self.stats.count('positions', min(n_segment, n_positions))
+        with self.stats.stage('neighborhood_hashing'):
+            neighborhoods = self._neighborhoods(segment)
+        starts = np.arange(n_positions)
+        bounds = (np.zeros(n_positions, dtype=np.int64),
+                  np.full(n_positions, n_positions, dtype=np.int64))
+        parts = []
+        for radius in range(self.min_r, self.r + 1):
+            pairs = self._pairs(radius, starts, bounds, neighborhoods)
+            if pairs is None:
+                continue
+            index, end, distance, feature_code = pairs
+            left = np.minimum(index, end)
+            right = np.maximum(index, end) + radius + 1
+            valid = (left < n_segment) & (right - left <= window_size)
+            left, right = left + offset, right + offset
+            k_in = np.maximum(0, -((window_size - right) // stride))
+            k_out = left // stride + 1
+            valid &= k_in < k_out
+            blocks = block_ids[radius, distance[valid]]
+            feature_code = feature_code[valid]
+            n_pairs = len(feature_code)
+            parts.append((np.concatenate((k_in[valid], k_out[valid])),
+                          np.tile(blocks, 2),
+                          np.tile(feature_code, 2),
+                          np.repeat(np.array([1, -1], dtype=np.int64),
+                                    n_pairs)))
+        if len(parts) == 0:
+            return _no_events()
+        return [np.concatenate(arrays) for arrays in zip(*parts)]
 
     def annotate(self, seqs, estimator=None, relabel=False):
         """Annotate.
@@ -362,9 +788,14 @@ class Vectorizer(AbstractVectorizer):
 
             If relabel is True: for each input sequence a triplet: 1) the input
             string, 2) a list of real  numbers with size equal to the number of
-            characters in each input sequence, 3) a list with  size equal to
-            the number of characters in each input sequence, of sparse vectors
-            each corresponding to the vertex induced features.
+            characters in each input sequence, 3) a sparse matrix with one row
+            per character in each input sequence, where the row i is the
+            sparse vector of the features induced by the i-th character.
+
+        The positions of the sequences are vectorized in batches, as in
+        transform, with one estimator call per batch: for a linear estimator
+        the margins are a single product of the feature vectors of the
+        positions with the coefficients.
 
         >>> # annotate importance of positions
         >>> vectorizer = Vectorizer(r=0, d=0)
@@ -380,8 +811,8 @@ class Vectorizer(AbstractVectorizer):
         >>> # check length of returned tuple
         >>> len(next(vectorizer.annotate(['GATTACA'], relabel=True)))
         3
-        >>> # check length of feature list
-        >>> len(next(vectorizer.annotate(['GATTACA'], relabel=True))[2])
+        >>> # check number of rows of the feature matrix
+        >>> next(vectorizer.annotate(['GATTACA'], relabel=True))[2].shape[0]
         7
         >>> # access importance of position 0
         >>> next(vectorizer.annotate(['GATTACA'], relabel=True))[1]
@@ -436,78 +867,375 @@ class Vectorizer(AbstractVectorizer):
         """
         self.estimator = estimator
         self.relabel = relabel
+        seqs = (self._get_sequence_and_weights(seq) for seq in seqs)
+        for batch in _batches(seqs):
+            for result in self._annotate(batch):
+                yield result
 
-        for seq in seqs:
-            yield self._annotate(seq)
-
-    def _annotate(self, seq):
-        seq, weights = self._get_sequence_and_weights(seq)
-        # extract per vertex feature representation
-        data_matrix = self._compute_vertex_based_features(seq, weights)
-        # extract importance information
-        score, vec = self._annotate_importance(seq, data_matrix)
-        # extract list of chars
-        out_sequence = [c for c in seq]
-        # add or update label information
-        if self.relabel:
-            return out_sequence, score, vec
-        else:
-            return out_sequence, score
+    def _annotate(self, batch):
+        # the positions of all the sequences of the batch are vectorized
+        # and scored at once, one row per position
+        data_matrix = self._compute_vertex_based_features(batch)
+        margins = self._annotate_importance(data_matrix)
+        offsets = np.cumsum([0] + [len(seq) for seq, weights in batch])
+        for (seq, weights), start, end in zip(batch, offsets[:-1],
+                                              offsets[1:]):
+            # extract list of chars
+            out_sequence = [c for c in seq]
+            # add or update label information
+            if self.relabel:
+                yield out_sequence, margins[start:end], \
+                    data_matrix[start:end]
+            else:
+                yield out_sequence, margins[start:end]
 
-    def _annotate_importance(self, seq, data_matrix):
+    def _annotate_importance(self, data_matrix):
         # compute distance from hyperplane as proxy of vertex importance
         if self.estimator is None:
             # if we do not provide an estimator then consider default margin of
             # 1 for all vertices
-            margins = np.array([1] * data_matrix.shape[0])
-        else:
-            margins = self.estimator.decision_function(data_matrix)
-        # compute the list of sparse vectors representation
-        vec = []
-        for i in range(data_matrix.shape[0]):
-            vec.append(data_matrix.getrow(i))
-        return margins, vec
-
-    def _compute_vertex_based_features(self, seq, weights=None):
-        if seq is None or len(seq) == 0:
-            raise Exception('ERROR: something went wrong, empty instance.')
-        # extract kmer hash codes for all kmers up to r in all positions in seq
-        vertex_features = []
-        seq_len = len(seq)
-        neighborhood_weight_cache = None
-        if weights:
-            if len(weights) != seq_len:
-                raise Exception('ERROR: sequence and weights \
-                    must be same length.')
-            neighborhood_weight_cache = \
-                [self._compute_neighborhood_weight(weights, pos)
-                 for pos in range(seq_len)]
-        neigh_hash_cache = [self._compute_neighborhood_hash(seq, pos)
-                            for pos in range(seq_len)]
-        for pos in range(seq_len):
-            # construct features as pairs of kmers up to distance d
-            # for all radii up to r
-            local_features = defaultdict(lambda: defaultdict(float))
+            return np.ones(data_matrix.shape[0], dtype=int)
+        if not hasattr(self.estimator, 'coef_') or \
+                not hasattr(self.estimator, 'intercept_'):
+            return self.estimator.decision_function(data_matrix)
+        # for a linear estimator, a single product with the coefficients
+        coef = np.asarray(self.estimator.coef_, dtype=np.float64)
+        margins = np.asarray(data_matrix.dot(np.atleast_2d(coef).T)) + \
+            np.ravel(self.estimator.intercept_)
+        if margins.shape[1] == 1:
+            return margins.ravel()
+        return margins
+
+    def _compute_vertex_based_features(self, batch):
+        # one row per position of the concatenated sequences of the batch,
+        # with the features of the pairs of kmers that start or end there
+        neighborhoods, neigh_weights, lengths, bounds = \
+            self._hash_batch(batch)
+        features = FeatureAccumulator()
+        with self.stats.stage('pair_emission'):
+            positions = np.arange(lengths.sum())
             for radius in range(self.min_r, self.r + 1):
-                if radius < len(neigh_hash_cache[pos]):
-                    self._transform_distance(local_features,
-                                             pos,
-                                             radius,
-                                             seq_len,
-                                             neigh_hash_cache,
-                                             neighborhood_weight_cache)
-                    # Note: we must consider also kmers that are on
-                    # the left of pos
-                    if pos - radius >= 0:
-                        self._transform_distance(local_features,
-                                                 pos - radius,
-                                                 radius,
-                                                 seq_len,
-                                                 neigh_hash_cache,
-                                                 neighborhood_weight_cache)
-            vertex_features.append(self._normalization(
-                local_features,
-                inner_normalization=False,
-                normalization=self.normalization))
-        data_matrix = self._convert_dict_to_sparse_matrix(vertex_features)
-        return data_matrix
+                self._emit_pairs(features, radius, positions, positions,
+                                 bounds, neighborhoods, neigh_weights)
+                # Note: we must consider also kmers that are on
+                # the left of pos
+                inside = positions - radius >= bounds[0]
+                inside &= positions + radius < bounds[1]
+                ends = positions[inside]
+                self._emit_pairs(features, radius, ends - radius, ends,
+                                 bounds, neighborhoods, neigh_weights)
+        return self._to_csr(features, len(positions),
+                            inner_normalization=False,
+                            normalization=self.normalization)
+
+
+# -------------------------------------------------------------------
+
+def _run_block(job, block):
+    # in a worker process, apply the function and send back the stats
+    func, vectorizer, args = job
+    result = func(vectorizer, block, *args)
+    stats = vectorizer.stats.as_dict()
+    vectorizer.stats.reset()
+    return result, stats
+
+
+def _transform_block(vectorizer, seqs):
+    return vectorizer._transform_features(seqs)
+
+
+def _predict_block(vectorizer, seqs, estimator):
+    return estimator.decision_function(vectorizer._transform_features(seqs))
+
+
+def _similarity_block(vectorizer, seqs, reference_vec):
+    data_matrix = vectorizer._transform_features(seqs)
+    return reference_vec.dot(data_matrix.T).toarray().ravel()
+
+
+# the number of positions of the sequences that are vectorized at once
+_BATCH_POSITIONS = 2 ** 16
+
+# the number of positions of the segments of a scanned sequence
+_SCAN_POSITIONS = 2 ** 12
+
+
+def _batches(seqs, max_positions=_BATCH_POSITIONS):
+    # group the (seq, weights) pairs in lists with at most max_positions
+    # positions (or a single sequence), with or without weights
+    batch, n_positions = [], 0
+    for seq, weights in seqs:
+        full = n_positions + len(seq) > max_positions
+        if batch and (full or bool(weights) != bool(batch[0][1])):
+            yield batch
+            batch, n_positions = [], 0
+        batch.append((seq, weights))
+        n_positions += len(seq)
+    if batch:
+        yield batch
+
+
+# the largest alphabet whose characters are encoded as indices
+_MAX_ALPHABET_SIZE = 16
+
+# the index of the characters that are not in the alphabet
+_NO_SYMBOL = 255
+
+# the largest number of entries of the tables of pair features
+_MAX_PAIR_TABLE_SIZE = 2 ** 20
+
+_symbol_lookups = {}
+
+_pair_tables = {}
+
+
+def _symbol_lookup(alphabet):
+    # the index in the alphabet of each latin-1 character, or _NO_SYMBOL
+    lookup = _symbol_lookups.get(alphabet, None)
+    if lookup is None:
+        chars = np.frombuffer(alphabet.encode('latin-1'), dtype=np.uint8)
+        lookup = np.full(256, _NO_SYMBOL, dtype=np.uint8)
+        lookup[chars] = np.arange(len(chars), dtype=np.uint8)
+        _symbol_lookups[alphabet] = lookup
+    return lookup
+
+
+def _kmer_codes(symbols, size, width):
+    # the kmers of up to width symbols that start at each position, as
+    # integers in base size (the first symbol is the most significant
+    # digit); the kmers that go beyond the end are set to 0
+    n_symbols = len(symbols)
+    kmer_codes = np.zeros((n_symbols, width), dtype=np.int64)
+    running_code = np.zeros(n_symbols, dtype=np.int64)
+    for j in range(min(width, n_symbols)):
+        n_active = n_symbols - j
+        running_code[:n_active] = running_code[:n_active] * size + \
+            symbols[j:]
+        kmer_codes[:n_active, j] = running_code[:n_active]
+    return kmer_codes
+
+
+def _concatenate(parts):
+    # the concatenation of strings or of lists of items
+    if all(isinstance(part, str) for part in parts):
+        return ''.join(parts)
+    return [item for part in parts for item in part]
+
+
+def _no_events():
+    # the (window, block, feature, sign) arrays of no events
+    return [np.zeros(0, dtype=np.int64) for _ in range(4)]
+
+
+def _merge_events(events, new_events):
+    # the events sorted by window, in order of arrival within a window
+    events = [np.concatenate(arrays) for arrays in zip(events, new_events)]
+    order = _sort_order(events[0])
+    return [array[order] for array in events]
+
+
+class _WindowScorer(object):
+    # the feature counts of the current window in each block, with their
+    # gram matrix between the blocks (the diagonal has the squared norms
+    # of the blocks) and the dot products of the blocks with the
+    # coefficients of the estimator; the counts are integers, so the
+    # updates of the gram matrix are exact. The gram matrix is diagonal
+    # unless a feature id is shared by several blocks (a hash collision):
+    # for each feature the number of blocks where it is counted is kept,
+    # and only the events of such features update the off diagonal entries.
+    # With collisions='last' a shared feature counts only in its last
+    # block, the one with the largest id (the ids are in the order in which
+    # the blocks of a sequence are generated, see _scan_block_ids): the
+    # dot products and the squared norms of the features whose last block
+    # is each block are kept instead of the gram matrix
+
+    def __init__(self, vectorizer, estimator, n_blocks):
+        if not hasattr(estimator, 'coef_') or \
+                not hasattr(estimator, 'intercept_'):
+            raise Exception('ERROR: the estimator must be linear, with '
+                            'the attributes coef_ and intercept_.')
+        coef = np.asarray(estimator.coef_, dtype=np.float64)
+        # one column per output (one for binary classifiers and regressors)
+        self.coef = np.ascontiguousarray(np.atleast_2d(coef).T)
+        if self.coef.shape[0] != vectorizer.feature_size:
+            raise Exception('ERROR: the estimator has %d features, the '
+                            'vectorizer %d' % (self.coef.shape[0],
+                                               vectorizer.feature_size))
+        self.intercept = np.ravel(
+            np.asarray(estimator.intercept_, dtype=np.float64))
+        self.normalization = vectorizer.normalization
+        self.inner_normalization = vectorizer.inner_normalization
+        self.collisions = vectorizer.collisions
+        if self.collisions not in ('last', 'sum'):
+            raise Exception('ERROR: unknown collisions mode: %s' %
+                            self.collisions)
+        self.counts = np.zeros((n_blocks, vectorizer.feature_size),
+                               dtype=np.int32)
+        self.n_feature_blocks = np.zeros(vectorizer.feature_size,
+                                         dtype=np.int32)
+        self.gram = np.zeros((n_blocks, n_blocks))
+        self.last_squares = np.zeros(n_blocks)
+        self.dots = np.zeros((n_blocks, self.coef.shape[1]))
+
+    def scores(self, windows, blocks, features, signs, n_windows):
+        # apply the events, sorted by window, and return the scores of
+        # the n_windows windows
+        n_blocks = len(self.gram)
+        size = n_windows * n_blocks
+        delta_gram = np.zeros((n_windows, n_blocks, n_blocks))
+        delta_last = np.zeros((n_windows, n_blocks))
+        delta_dots = np.zeros((n_windows, n_blocks, self.coef.shape[1]))
+        if len(signs) > 0:
+            # group the events by (block, feature), in order of time
+            # within a group
+            keys = blocks * self.counts.shape[1] + features
+            order = _sort_order(keys)
+            windows, blocks = windows[order], blocks[order]
+            features, signs, keys = features[order], signs[order], \
+                keys[order]
+            first = np.flatnonzero(np.diff(keys, prepend=-1))
+            sizes = np.diff(np.append(first, len(keys)))
+            base = self.counts[blocks[first], features[first]]
+            # the count of the feature in its block just before each event
+            cumulated = np.cumsum(signs)
+            offsets = np.repeat(cumulated[first] - signs[first] - base,
+                                sizes)
+            before = cumulated - signs - offsets
+            slots = windows * n_blocks + blocks
+            # adding s to a count c changes the squared norm by 2sc + 1
+            diagonal = np.arange(n_blocks)
+            delta_gram[:, diagonal, diagonal] = np.bincount(
+                slots, weights=2 * signs * before + 1,
+                minlength=size).reshape(n_windows, n_blocks)
+            delta_last += delta_gram[:, diagonal, diagonal]
+            coef = self.coef[features]
+            delta_dots += np.stack([np.bincount(slots,
+                                                weights=signs * column,
+                                                minlength=size)
+                                    for column in coef.T], axis=1).reshape(
+                n_windows, n_blocks, -1)
+            shared = self._shared_events(windows, blocks, features, signs,
+                                         order, first, base)
+            if shared is not None and self.collisions == 'sum':
+                self._collisions(delta_gram, *shared)
+            elif shared is not None:
+                self._last_collisions(delta_last, delta_dots, *shared)
+            # update the counts and the number of blocks of the features
+            after = base + np.add.reduceat(signs, first)
+            self.counts[blocks[first], features[first]] = after
+            present = (after != 0).astype(np.int32)
+            np.add.at(self.n_feature_blocks, features[first],
+                      present - (base != 0).astype(np.int32))
+        grams = self.gram + np.cumsum(delta_gram, axis=0)
+        last_squares = self.last_squares + np.cumsum(delta_last, axis=0)
+        dots = self.dots + np.cumsum(delta_dots, axis=0)
+        self.gram, self.dots = grams[-1].copy(), dots[-1].copy()
+        self.last_squares = last_squares[-1].copy()
+        scale = np.ones((n_windows, n_blocks))
+        if self.inner_normalization:
+            squared_norms = np.diagonal(grams, axis1=1, axis2=2)
+            nonzero = squared_norms > 0
+            scale = np.zeros((n_windows, n_blocks))
+            scale[nonzero] = 1 / np.sqrt(squared_norms[nonzero])
+        scores = np.einsum('wb,wbo->wo', scale, dots)
+        if self.normalization and self.collisions == 'sum':
+            squared_norms = np.einsum('wb,wbc,wc->w', scale, grams, scale)
+        elif self.normalization:
+            squared_norms = np.einsum('wb,wb->w', scale * scale,
+                                      last_squares)
+        if self.normalization:
+            nonzero = squared_norms > 0
+            scores[nonzero] /= np.sqrt(squared_norms[nonzero])[:, None]
+        scores += self.intercept
+        if scores.shape[1] == 1:
+            return scores[:, 0]
+        return scores
+
+    def _shared_events(self, windows, blocks, features, signs, times, first,
+                       base):
+        # the events of the features that are counted in another block
+        # before the events or that have events in several blocks, grouped
+        # by feature in order of time, with the counts of the feature in
+        # all the blocks just before each event, or None; the events are
+        # grouped by (block, feature), first are the starts of the groups
+        # and times the indices of the events in order of time
+        n_blocks = len(self.gram)
+        other_blocks = self.n_feature_blocks[features[first]] - (base != 0)
+        group_features = features[first]
+        unique_features, n_groups = np.unique(group_features,
+                                              return_counts=True)
+        shared = unique_features[n_groups > 1]
+        shared = np.union1d(shared, group_features[other_blocks > 0])
+        if len(shared) == 0:
+            return None
+        selected = np.isin(features, shared)
+        windows, blocks = windows[selected], blocks[selected]
+        features, signs = features[selected], signs[selected]
+        # the counts of the feature in all the blocks just before each
+        # event, with the events grouped by feature in order of time
+        order = _sort_order(features, times[selected])
+        windows, blocks = windows[order], blocks[order]
+        features, signs = features[order], signs[order]
+        n_events = len(signs)
+        steps = np.zeros((n_events, n_blocks))
+        steps[np.arange(n_events), blocks] = signs
+        cumulated = np.zeros((n_events + 1, n_blocks))
+        np.cumsum(steps, axis=0, out=cumulated[1:])
+        starts = np.flatnonzero(np.diff(features, prepend=-1))
+        group_starts = np.repeat(starts, np.diff(np.append(starts,
+                                                           n_events)))
+        counts = cumulated[:-1] - cumulated[group_starts] + \
+            self.counts[:, features].T
+        return windows, blocks, features, signs, counts
+
+    def _collisions(self, delta_gram, windows, blocks, features, signs,
+                    counts):
+        # add the off diagonal changes of the gram matrix due to the shared
+        # events (see _shared_events)
+        n_blocks = len(self.gram)
+        n_events = len(signs)
+        # adding s to the count of a feature in block b changes the entries
+        # (b, c) and (c, b) of the gram matrix by s times its count in c
+        counts = counts.copy()
+        counts[np.arange(n_events), blocks] = 0
+        slots = windows * n_blocks + blocks
+        size = len(delta_gram) * n_blocks
+        rows = np.stack([np.bincount(slots, weights=signs * column,
+                                     minlength=size)
+                         for column in counts.T], axis=1)
+        rows = rows.reshape(len(delta_gram), n_blocks, n_blocks)
+        delta_gram += rows + rows.transpose(0, 2, 1)
+
+    def _last_collisions(self, delta_last, delta_dots, windows, blocks,
+                         features, signs, counts):
+        # replace the changes of the shared events (see _shared_events) in
+        # their own block with the changes in the last block of the feature
+        # before and after each event
+        n_blocks = len(self.gram)
+        events = np.arange(len(signs))
+        after = counts.copy()
+        after[events, blocks] += signs
+        size = len(delta_last) * n_blocks
+        changes = []
+        for sign, block_counts in ((-1, counts), (1, after)):
+            last = n_blocks - 1 - np.argmax(block_counts[:, ::-1] != 0,
+                                            axis=1)
+            changes.append((windows * n_blocks + last, sign,
+                            block_counts[events, last]))
+        own = counts[events, blocks]
+        slots = windows * n_blocks + blocks
+        squares = np.bincount(slots, weights=-(2 * signs * own + 1),
+                              minlength=size)
+        for last_slots, weight, values in changes:
+            squares += np.bincount(last_slots, weights=weight * values ** 2,
+                                   minlength=size)
+        delta_last += squares.reshape(len(delta_last), n_blocks)
+        coef = self.coef[features]
+        for i, column in enumerate(coef.T):
+            dots = np.bincount(slots, weights=-signs * column,
+                               minlength=size)
+            for last_slots, weight, values in changes:
+                dots += np.bincount(last_slots,
+                                    weights=weight * column * values,
+                                    minlength=size)
+            delta_dots[:, :, i] += dots.reshape(len(delta_last), n_blocks)
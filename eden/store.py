@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""Provides an on-disk store for large sparse feature matrices.
+
+A FeatureStore is a directory that holds the rows of a CSR matrix in
+shards: each appended block of rows is written as three numpy files (data,
+indices and indptr) and is listed in a json manifest. The shards are opened
+as memory-mapped arrays, so that only the rows that are accessed are read
+from disk.
+
+>>> import tempfile
+>>> import networkx as nx
+>>> from eden.graph import Vectorizer
+>>> def get_path_graph(length=4):
+...     g = nx.path_graph(length)
+...     for n,d in g.nodes(data=True):
+...         d['label'] = 'C'
+...     for a,b,d in g.edges(data=True):
+...         d['label'] = '1'
+...     return g
+>>> graphs = [get_path_graph(length) for length in range(2, 12)]
+>>> store = FeatureStore(tempfile.mkdtemp())
+>>> store.shape, store[0:0].shape
+((0, 0), (0, 0))
+>>> store.extend(Vectorizer().transform_iter(graphs, block_size=4))
+>>> store.shape
+(10, 65537)
+>>> x = Vectorizer().transform(graphs)
+>>> bool(abs(store[2:7] - x[2:7]).max() == 0)
+True
+>>> bool(abs(store[[9, 0, 4]] - x[[9, 0, 4]]).max() == 0)
+True
+>>> [block.shape[0] for block in store.iter_blocks(block_size=3)]
+[3, 3, 3, 1]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+import logging
+logger = logging.getLogger(__name__)
+
+_MANIFEST = 'manifest.json'
+
+
+class FeatureStore(object):
+    """Sharded, memory-mapped store of the rows of a CSR matrix.
+
+    Parameters
+    ----------
+    path : string
+        The directory of the store. It is created if it does not exist,
+        otherwise the existing store is opened and new rows are appended
+        to it.
+    """
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_path = os.path.join(path, _MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            self.n_features = manifest['n_features']
+            self.shards = manifest['shards']
+        else:
+            self.n_features = None
+            self.shards = []
+        self._arrays = {}
+        self._update_offsets()
+
+    @property
+    def shape(self):
+        """The shape of the stored matrix, (0, 0) if it is empty."""
+        if self.n_features is None:
+            return (0, 0)
+        return (self.n_rows, self.n_features)
+
+    def __len__(self):
+        """Number of rows."""
+        return self.n_rows
+
+    def append(self, data_matrix):
+        """Append the rows of a sparse matrix as a new shard."""
+        data_matrix = csr_matrix(data_matrix)
+        if data_matrix.shape[0] == 0:
+            return
+        if self.n_features is None:
+            self.n_features = data_matrix.shape[1]
+        if data_matrix.shape[1] != self.n_features:
+            raise Exception('ERROR: the matrix has %d columns, the store %d' %
+                            (data_matrix.shape[1], self.n_features))
+        data_matrix.sum_duplicates()
+        # indices and indptr share the same type, so that scipy can use
+        # the memory-mapped arrays without converting them
+        index_type = np.int32
+        if max(data_matrix.nnz, self.n_features) >= np.iinfo(np.int32).max:
+            index_type = np.int64
+        name = 'shard_%06d' % len(self.shards)
+        arrays = dict(data=data_matrix.data.astype(np.float64),
+                      indices=data_matrix.indices.astype(index_type),
+                      indptr=data_matrix.indptr.astype(index_type))
+        for kind, array in arrays.items():
+            np.save(self._file_name(name, kind), array)
+        self.shards.append(dict(name=name,
+                                n_rows=data_matrix.shape[0],
+                                nnz=int(data_matrix.nnz)))
+        self._update_offsets()
+        self._write_manifest()
+
+    def extend(self, data_matrices):
+        """Append each matrix of an iterable (e.g. from transform_iter)."""
+        for data_matrix in data_matrices:
+            if isinstance(data_matrix, tuple):
+                # pairs (offset, data_matrix) from transform_iter
+                data_matrix = data_matrix[1]
+            self.append(data_matrix)
+
+    def rows(self, start, stop):
+        """Return the rows in [start, stop) as a csr_matrix.
+
+        When the rows are in a single shard the data and indices arrays of
+        the result are views of the memory-mapped files.
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_rows)
+        stop = max(start, stop)
+        if start == stop:
+            return csr_matrix((0, self.shape[1]))
+        first = np.searchsorted(self._offsets, start, side='right') - 1
+        last = np.searchsorted(self._offsets, stop, side='left') - 1
+        blocks = []
+        for shard in range(first, last + 1):
+            offset = self._offsets[shard]
+            begin = max(start, offset) - offset
+            end = min(stop, self._offsets[shard + 1]) - offset
+            data, indices, indptr = self._shard_arrays(shard)
+            row_indptr = indptr[begin:end + 1] - indptr[begin]
+            blocks.append(csr_matrix(
+                (data[indptr[begin]:indptr[end]],
+                 indices[indptr[begin]:indptr[end]],
+                 row_indptr), shape=(end - begin, self.n_features)))
+        if len(blocks) == 1:
+            return blocks[0]
+        return vstack(blocks, format='csr')
+
+    def take(self, ids):
+        """Return the rows with the given positions, in the given order."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return csr_matrix((0, self.shape[1]))
+        ids = np.where(ids < 0, ids + self.n_rows, ids)
+        if ids.min() < 0 or ids.max() >= self.n_rows:
+            raise IndexError('row index out of range')
+        shards = np.searchsorted(self._offsets, ids, side='right') - 1
+        order = np.argsort(shards, kind='stable')
+        blocks = []
+        for shard in np.unique(shards):
+            selected = order[shards[order] == shard]
+            data, indices, indptr = self._shard_arrays(shard)
+            shard_matrix = csr_matrix(
+                (data, indices, indptr),
+                shape=(len(indptr) - 1, self.n_features))
+            blocks.append(shard_matrix[ids[selected] - self._offsets[shard]])
+        data_matrix = vstack(blocks, format='csr')
+        # restore the requested order
+        inverse = np.empty(len(ids), dtype=np.int64)
+        inverse[order] = np.arange(len(ids))
+        return data_matrix[inverse]
+
+    def __getitem__(self, key):
+        """Return rows by position, slice (with step 1) or list of ids."""
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                start, stop, step = key.indices(self.n_rows)
+                return self.take(np.arange(start, stop, step))
+            return self.rows(key.start, key.stop)
+        if np.isscalar(key):
+            if key < 0:
+                key += self.n_rows
+            if not 0 <= key < self.n_rows:
+                raise IndexError('row index out of range')
+            return self.rows(key, key + 1)
+        return self.take(key)
+
+    def iter_blocks(self, block_size=1000, return_offsets=False):
+        """Yield the rows in consecutive blocks of block_size rows.
+
+        If return_offsets is True yield pairs (offset, data_matrix) where
+        offset is the position of the first row of the block.
+        """
+        for start in range(0, self.n_rows, block_size):
+            data_matrix = self.rows(start, start + block_size)
+            if return_offsets:
+                yield start, data_matrix
+            else:
+                yield data_matrix
+
+    def _file_name(self, name, kind):
+        return os.path.join(self.path, '%s.%s.npy' % (name, kind))
+
+    def _shard_arrays(self, shard):
+        arrays = self._arrays.get(shard, None)
+        if arrays is None:
+            name = self.shards[shard]['name']
+            arrays = tuple(np.load(self._file_name(name, kind), mmap_mode='r')
+                           for kind in ('data', 'indices', 'indptr'))
+            self._arrays[shard] = arrays
+        return arrays
+
+    def _update_offsets(self):
+        self._offsets = np.cumsum(
+            [0] + [shard['n_rows'] for shard in self.shards])
+        self.n_rows = int(self._offsets[-1])
+
+    def _write_manifest(self):
+        # write and rename, so that a reader never sees a partial manifest
+        manifest_path = os.path.join(self.path, _MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(dict(n_features=self.n_features, shards=self.shards),
+                      f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        logger.debug('Written %d rows in %s' % (self.n_rows, self.path))
@@ -20,10 +20,13 @@ import multiprocessing as mp
 import time
 
 from toolz.curried import concat
+from toolz import partition_all
 
 import logging
 logger = logging.getLogger(__name__)
 
+_block_worker_state = {}
+
 
 def timeit(method):
     """Time decorator."""
@@ -51,6 +54,47 @@ def ppipe(iterable, func, chunk_size=1):
     return list(concat(out))
 
 
+def _init_block_worker(obj):
+    _block_worker_state['obj'] = obj
+
+
+def _run_block_worker(func, block):
+    return func(_block_worker_state['obj'], block)
+
+
+def block_pmap(func, obj, iterable, n_jobs=-1, block_size=100,
+               max_blocks_in_flight=None):
+    """Multi-core map over blocks of an iterable, in input order.
+
+    The iterable is consumed lazily and split in lists of block_size items.
+    Each block is processed as func(obj, block) in a pool of n_jobs worker
+    processes. The object obj is shipped once to each worker when the pool
+    starts, so only the blocks travel between processes. At most
+    max_blocks_in_flight blocks (default 2 * n_jobs) are pending at any
+    time, which bounds the memory used by the pipeline.
+    The results are yielded as soon as they are available, in the same
+    order as the blocks in the input.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = mp.cpu_count()
+    if max_blocks_in_flight is None:
+        max_blocks_in_flight = 2 * n_jobs
+    pool = mp.Pool(n_jobs, initializer=_init_block_worker, initargs=(obj,))
+    try:
+        pending = deque()
+        for block in partition_all(block_size, iterable):
+            pending.append(pool.apply_async(_run_block_worker,
+                                            (func, list(block))))
+            if len(pending) >= max_blocks_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def configure_logging(logger, verbosity=0, filename=None):
     """Utility to configure the logging aspects.
 
@@ -248,6 +292,10 @@ def store_matrix(matrix='',
         np.save(full_out_file_name, matrix)
     elif output_format == "joblib":
         joblib.dump(matrix, full_out_file_name)
+    elif output_format == "store":
+        # append the rows to a memory-mapped feature store
+        from eden.store import FeatureStore
+        FeatureStore(full_out_file_name).append(matrix)
     elif output_format == "text":
         with open(full_out_file_name, "w") as f:
             if len(matrix.shape) == 1:
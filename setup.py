@@ -99,7 +99,8 @@ setup(
     packages=['eden',
               'eden.ml',
               'eden.display',
-              'eden.io'
+              'eden.io',
+              'eden.benchmark'
               ],
     scripts=[],
     include_package_data=True,